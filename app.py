@@ -1,33 +1,119 @@
 import os
 import json
+import re
 import openai
 import base64
+import ast
+import operator
 import requests
-from flask import Flask, render_template, request, jsonify, Response
+import httpx
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, get_encoding_from_headers
+import urllib3
+from urllib3.util.retry import Retry
+from flask import Flask, render_template, request, jsonify, Response, current_app
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
-import traceback
-import io # Added for image editing
+import logging
 from typing import Dict, List, Any, Optional
 import uuid
+import tempfile
+import copy
+import hashlib
+import heapq
+import functools
+import itertools
+import ipaddress
+import socket
 import threading
 import time
 from datetime import datetime, timedelta
-from collections import defaultdict
+from urllib.parse import urlparse
+from collections import defaultdict, OrderedDict, Counter, deque
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import orjson
+except ImportError:  # Optional: JSON helpers fall back to the stdlib json module
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:  # Optional: token estimates fall back to ~4 characters per token
+    tiktoken = None
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:  # Optional: LLM calls stay on pooled HTTP/1.1 connections
+    HTTP2_AVAILABLE = False
+
 # Load environment variables
 load_dotenv()
 
+# Logging (set LOG_LEVEL=DEBUG for per-request diagnostics)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
 # Initialize Flask app
-app = Flask(__name__)
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """Serve jsonify()/request.get_json() through orjson when it is installed."""
+    def _orjson_dumps(self, obj, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+    
+    def dumps(self, obj, **kwargs):
+        # Other formatting options and types orjson rejects use the stdlib path
+        if orjson is not None and not kwargs:
+            try:
+                return self._orjson_dumps(obj).decode()
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
+    
+    def response(self, *args, **kwargs):
+        # jsonify() always passes separators/indent to dumps(), so build the body here
+        if orjson is not None:
+            if args and kwargs:
+                raise TypeError("app.json.response() takes either args or kwargs, not both")
+            obj = args[0] if len(args) == 1 else (dict(kwargs) or list(args) or None)
+            indent = (self.compact is None and current_app.debug) or self.compact is False
+            try:
+                body = self._orjson_dumps(obj, indent=indent) + b"\n"
+            except TypeError:  # e.g. integers wider than 64 bits
+                pass
+            else:
+                return current_app.response_class(body, mimetype=self.mimetype)
+        return super().response(*args, **kwargs)
+    
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
 
-# Background task storage
-BACKGROUND_TASKS = {}
-TASK_LOCK = threading.Lock()
+app = Flask(__name__)
+app.json = OrjsonJSONProvider(app)
+
+# Background task storage. Single-key dict operations are atomic, so routes read and
+# insert without a global lock; each task guards its own chunk list. Ordered so the
+# least recently finished tasks can be evicted first.
+BACKGROUND_TASKS = OrderedDict()
+TASK_EVICTION_LOCK = threading.Lock()
+MAX_STORED_TASKS = 1000  # Finished tasks beyond this are evicted, oldest first
 TASK_EXECUTOR = ThreadPoolExecutor(max_workers=5)
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=6)  # Fan-out for concurrent web searches
+TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=8)  # Parallel tool calls within one agent turn
+TAVILY_FALLBACK_EXECUTOR = ThreadPoolExecutor(max_workers=4)  # Speculative Tavily fallbacks; never submits further work
+SEARCH_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2)  # Soft refreshes of hot cache entries; kept off the task and search pools
 TASK_CLEANUP_INTERVAL = 300  # Clean up old tasks every 5 minutes
+TASK_STREAM_KEEPALIVE = 15  # Seconds of silence before a task stream sends a keepalive comment
 MAX_TASK_AGE = 3600  # Keep tasks for 1 hour
+SUMMARY_LENGTH = 500  # Characters of streamed content kept for the task summary
 
 # Task status enum
 class TaskStatus:
@@ -37,6 +123,8 @@ class TaskStatus:
     FAILED = "failed"
     CANCELLED = "cancelled"
 
+FINISHED_TASK_STATUSES = frozenset([TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED])
+
 # Background task class
 class BackgroundTask:
     def __init__(self, task_id, model, query, **kwargs):
@@ -53,12 +141,33 @@ class BackgroundTask:
         self.chunks = []
         self.metadata = kwargs
         self.cancel_requested = False
+        self.lock = threading.Lock()
+        self.updated = threading.Condition(self.lock)  # Notified when chunks or status change
+    
+    def add_chunk(self, chunk):
+        """Append a streamed chunk and wake any clients streaming this task."""
+        with self.updated:
+            self.chunks.append(chunk)
+            self.updated.notify_all()
+    
+    def notify(self):
+        """Wake streaming clients after a status change."""
+        with self.updated:
+            self.updated.notify_all()
+    
+    def wait_for_update(self, seen_chunks, timeout):
+        """Block until there are more than seen_chunks chunks or the task is done; False on timeout."""
+        with self.updated:
+            return self.updated.wait_for(
+                lambda: len(self.chunks) > seen_chunks or self.cancel_requested or self.status in FINISHED_TASK_STATUSES,
+                timeout=timeout
+            )
         
     def to_dict(self):
         return {
             "id": self.id,
             "model": self.model,
-            "query": self.query[:100] + "..." if len(self.query) > 100 else self.query,
+            "query": clip_text(self.query, 100),
             "status": self.status,
             "created_at": self.created_at.isoformat(),
             "started_at": self.started_at.isoformat() if self.started_at else None,
@@ -75,28 +184,209 @@ def cleanup_old_tasks():
     """Clean up old tasks periodically"""
     while True:
         time.sleep(TASK_CLEANUP_INTERVAL)
-        with TASK_LOCK:
-            current_time = datetime.now()
-            tasks_to_remove = []
-            for task_id, task in BACKGROUND_TASKS.items():
-                if (current_time - task.created_at).total_seconds() > MAX_TASK_AGE:
-                    tasks_to_remove.append(task_id)
-            
-            for task_id in tasks_to_remove:
-                del BACKGROUND_TASKS[task_id]
-                print(f"Cleaned up old task: {task_id}")
+        current_time = datetime.now()
+        tasks_to_remove = []
+        # Iterate over a snapshot: routes insert tasks concurrently without a lock
+        for task_id, task in list(BACKGROUND_TASKS.items()):
+            if (current_time - task.created_at).total_seconds() > MAX_TASK_AGE:
+                tasks_to_remove.append(task_id)
+        
+        for task_id in tasks_to_remove:
+            BACKGROUND_TASKS.pop(task_id, None)
+            logger.info("Cleaned up old task: %s", task_id)
+
+def retire_finished_task(task_id):
+    """
+    Mark a task as the most recently finished one and evict the least recently
+    finished tasks once more than MAX_STORED_TASKS are stored. Queued and running
+    tasks are never evicted.
+    """
+    with TASK_EVICTION_LOCK:
+        if task_id in BACKGROUND_TASKS:
+            BACKGROUND_TASKS.move_to_end(task_id)
+        excess = len(BACKGROUND_TASKS) - MAX_STORED_TASKS
+        if excess <= 0:
+            return
+        for old_task_id, old_task in list(BACKGROUND_TASKS.items()):
+            if excess <= 0:
+                break
+            if old_task.status in FINISHED_TASK_STATUSES:
+                BACKGROUND_TASKS.pop(old_task_id, None)
+                excess -= 1
 
 # Start cleanup thread
 cleanup_thread = threading.Thread(target=cleanup_old_tasks, daemon=True)
 cleanup_thread.start()
 
+# --- Response Cache ---
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a per-entry TTL (seconds)."""
+    def __init__(self, max_size=1000, default_ttl=1800):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (cached_at, ttl, value)
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """Return a copy of the cached value, or None on a miss or expired entry."""
+        cached = self.get_with_meta(key)
+        return cached[0] if cached is not None else None
+
+    def get_with_meta(self, key):
+        """Return (value, cached_at, ttl) for a live entry, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] + entry[1] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            cached_at, ttl, value = entry
+        return copy.deepcopy(value), cached_at, ttl
+
+    def set(self, key, value, ttl=None):
+        """Store a copy of value, evicting the least recently used entries past max_size."""
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), ttl or self.default_ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+def make_cache_key(*parts):
+    """Build a compact cache key from the normalized call arguments."""
+    return hashlib.md5("|".join(str(part) for part in parts).encode()).hexdigest()
+
+# Cache for Tavily-backed tool results (search_web_tool, research_topic)
+SEARCH_CACHE = TTLCache(max_size=1000, default_ttl=1800)
+SEARCH_CACHE_BASE_TTL = 600  # seconds
+SEARCH_TYPE_TTL_MULTIPLIERS = {
+    "news": 0.1,     # News goes stale within minutes
+    "general": 1.0,
+    "deep": 3.0,     # In-depth analysis changes slowly
+}
+VOLATILE_QUERY_WORDS = frozenset(["today", "now", "breaking"])
+STABLE_QUERY_WORDS = frozenset(["history", "definition"])
+SOFT_REFRESH_RATIO = 0.8  # Refresh hot entries once 80% of their TTL has elapsed
+SEARCH_REFRESH_IN_FLIGHT = set()
+SEARCH_REFRESH_LOCK = threading.Lock()
+
+QUERY_WORD_RE = re.compile(r"[a-z]+")
+
+def query_words(text):
+    """Lowercased word set of a query, for O(1) keyword membership checks."""
+    return set(QUERY_WORD_RE.findall(text.lower()))
+
+# Keyword classification only looks at the start of a query, so pasted documents
+# don't get scanned (or held as lru_cache keys) in full
+QUERY_CLASSIFY_MAX_CHARS = 2048
+
+@functools.lru_cache(maxsize=1024)
+def query_terms(query_lower):
+    """Cached word set of an already-lowercased query, shared by the per-request classifiers."""
+    return frozenset(QUERY_WORD_RE.findall(query_lower))
+
+def compute_ttl(query, search_type):
+    """Pick a cache TTL (seconds) from the search type and time-sensitive wording in the query."""
+    ttl = SEARCH_CACHE_BASE_TTL * SEARCH_TYPE_TTL_MULTIPLIERS.get(search_type, 1.0)
+    words = query_words(query)
+    if words & VOLATILE_QUERY_WORDS:
+        ttl *= 0.5
+    if words & STABLE_QUERY_WORDS:
+        ttl *= 2
+    return ttl
+
+def should_refresh(cached_at, ttl, threshold=SOFT_REFRESH_RATIO):
+    """True once a cached entry is old enough to be repopulated ahead of expiry."""
+    return time.monotonic() - cached_at >= ttl * threshold
+
 # Configure API keys
 openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
 openai_api_key = os.getenv("OPENAI_API_KEY") # For direct OpenAI (e.g., gpt-image-1)
 tavily_api_key = os.getenv("TAVILY_API_KEY") # For web search
 
+# OpenRouter provider routing preference: "throughput", "latency" or "price" (anything else disables it)
+OPENROUTER_PROVIDER_SORTS = {"throughput", "latency", "price"}
+OPENROUTER_PROVIDER_SORT = os.getenv("OPENROUTER_PROVIDER_SORT", "throughput").strip().lower()
+
+# --- Outbound HTTP Connection Pools ---
+# Keep-alive pools shared by every request thread, so repeated Tavily and
+# OpenRouter/OpenAI calls reuse warm TLS connections instead of handshaking each time.
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 50
+HTTP_KEEPALIVE_EXPIRY = 60  # seconds
+LLM_CONNECT_TIMEOUT = 5.0   # seconds; fail fast when OpenRouter/OpenAI is unreachable
+LLM_READ_TIMEOUT = 120.0    # seconds; non-streaming reasoning calls can take a while
+
+# Tavily searches are read-only, so POSTs are safe to retry on transient gateway errors
+TAVILY_RETRY = Retry(
+    total=2,
+    backoff_factor=0.3,
+    status_forcelist=[500, 502, 503, 504],
+    allowed_methods=frozenset(["POST"]),
+    raise_on_status=False  # Let raise_for_status() map the final status as before
+)
+
+tavily_session = requests.Session()
+tavily_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_MAX_KEEPALIVE, max_retries=TAVILY_RETRY))
+
+# With h2 installed, concurrent OpenRouter calls (e.g. parallel web-search tools)
+# multiplex over a few HTTP/2 connections instead of one socket per in-flight request.
+llm_http_client = openai.DefaultHttpxClient(
+    http2=HTTP2_AVAILABLE,
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    ),
+    # The SDK adopts a custom client's timeout, replacing its 10-minute default
+    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+)
+
 # Initialize OpenAI client (recommended way) for direct OpenAI calls
-openai_client = openai.OpenAI(api_key=openai_api_key) if openai_api_key else None
+openai_client = openai.OpenAI(api_key=openai_api_key, http_client=llm_http_client) if openai_api_key else None
+
+# Shared OpenRouter client. The sync client is thread-safe, so concurrent
+# streams on Flask's worker threads reuse one connection pool.
+_openrouter_client = None
+_openrouter_client_lock = threading.Lock()
+
+def get_openrouter_client():
+    """Return the process-wide OpenRouter client, creating it on first use."""
+    global _openrouter_client
+    if _openrouter_client is None:
+        with _openrouter_client_lock:
+            if _openrouter_client is None:
+                _openrouter_client = openai.OpenAI(
+                    base_url="https://openrouter.ai/api/v1",
+                    api_key=openrouter_api_key,
+                    http_client=llm_http_client,
+                    default_headers={
+                        "HTTP-Referer": os.getenv("APP_SITE_URL", "http://localhost:8080"),
+                        "X-Title": os.getenv("APP_SITE_TITLE", "Comet AI Search")
+                    }
+                )
+    return _openrouter_client
 
 # Allowed models
 OPENROUTER_MODELS = {
@@ -115,6 +405,63 @@ OPENROUTER_MODELS = {
 ALLOWED_MODELS = OPENROUTER_MODELS.copy()
 ALLOWED_MODELS.add("gpt-image-1")
 
+# --- Server-Sent Events ---
+SSE_PREFIX = b"data: "
+SSE_PREFIX_LEN = len(SSE_PREFIX)
+SSE_SUFFIX = b"\n\n"
+
+def json_dumps_bytes(payload):
+    """Serialize payload to UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload)
+        except TypeError:  # e.g. integers wider than 64 bits
+            pass
+    return json.dumps(payload).encode()
+
+def json_dumps(payload):
+    """Serialize payload to a JSON string, using orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload).decode()
+        except TypeError:  # e.g. integers wider than 64 bits
+            pass
+    return json.dumps(payload)
+
+def json_loads(data):
+    """Parse JSON from str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def clip_text(text, limit):
+    """Truncate text to limit characters, appending "..." when anything was cut."""
+    return text if len(text) <= limit else text[:limit] + "..."
+
+def sse_event(payload):
+    """Encode a payload as a complete SSE data frame, ready to write to the response."""
+    return SSE_PREFIX + json_dumps_bytes(payload) + SSE_SUFFIX
+
+CHUNK_FRAME_PREFIX = SSE_PREFIX + b'{"chunk":'
+CHUNK_FRAME_SUFFIX = b"}" + SSE_SUFFIX
+
+def chunk_frame(text):
+    """SSE frame for a content chunk; only the text itself is JSON-encoded."""
+    return CHUNK_FRAME_PREFIX + json_dumps_bytes(text) + CHUNK_FRAME_SUFFIX
+
+@functools.lru_cache(maxsize=64)
+def reasoning_frame(text):
+    """SSE frame for a fixed reasoning/status message, encoded once and reused."""
+    return sse_event({'reasoning': text})
+
+@functools.lru_cache(maxsize=32)
+def error_frame(text):
+    """SSE frame for a fixed error message, encoded once and reused."""
+    return sse_event({'error': text})
+
+END_OF_STREAM_FRAME = sse_event({'end_of_stream': True})
+SSE_KEEPALIVE = b": ping\n\n"  # SSE comment line; ignored by EventSource clients
+
 # --- Background Streaming for OpenRouter ---
 def stream_openrouter_background(task_id, query, model_name_with_suffix, reasoning_config=None, uploaded_file_data=None, file_type=None, web_search_enabled=False):
     """
@@ -123,7 +470,7 @@ def stream_openrouter_background(task_id, query, model_name_with_suffix, reasoni
     """
     task = BACKGROUND_TASKS.get(task_id)
     if not task:
-        print(f"Background task {task_id} not found")
+        logger.warning("Background task %s not found", task_id)
         return
     
     try:
@@ -143,27 +490,31 @@ def stream_openrouter_background(task_id, query, model_name_with_suffix, reasoni
         
         # Process the stream and collect chunks
         chunk_count = 0
-        total_content = ""
+        content_length = 0
+        summary_parts = [] # Only the first SUMMARY_LENGTH chars are retained
         
         for chunk_data in generator:
             if task.cancel_requested:
                 task.status = TaskStatus.CANCELLED
                 task.completed_at = datetime.now()
-                print(f"Task {task_id} cancelled")
+                task.notify()
+                logger.info("Task %s cancelled", task_id)
                 return
             
             # Parse the SSE data
-            if chunk_data.startswith("data: "):
+            if chunk_data.startswith(SSE_PREFIX):
                 try:
-                    json_data = json.loads(chunk_data[6:].strip())
+                    json_data = json_loads(chunk_data[SSE_PREFIX_LEN:])
                     
                     # Store the chunk
-                    task.chunks.append(json_data)
+                    task.add_chunk(json_data)
                     chunk_count += 1
                     
                     # Extract content for summary
                     if 'chunk' in json_data:
-                        total_content += json_data['chunk']
+                        if content_length <= SUMMARY_LENGTH:
+                            summary_parts.append(json_data['chunk'])
+                        content_length += len(json_data['chunk'])
                     
                     # Update progress (estimate based on typical response length)
                     if chunk_count < 50:
@@ -176,12 +527,14 @@ def stream_openrouter_background(task_id, query, model_name_with_suffix, reasoni
                         task.progress = 100
                         task.status = TaskStatus.COMPLETED
                         task.completed_at = datetime.now()
+                        summary = "".join(summary_parts)
                         task.result = {
                             "total_chunks": chunk_count,
-                            "content_length": len(total_content),
-                            "summary": total_content[:500] + "..." if len(total_content) > 500 else total_content
+                            "content_length": content_length,
+                            "summary": summary[:SUMMARY_LENGTH] + "..." if content_length > SUMMARY_LENGTH else summary
                         }
-                        print(f"Task {task_id} completed successfully")
+                        task.notify()
+                        logger.info("Task %s completed successfully", task_id)
                         return
                     
                     # Handle errors
@@ -189,23 +542,28 @@ def stream_openrouter_background(task_id, query, model_name_with_suffix, reasoni
                         task.status = TaskStatus.FAILED
                         task.error = json_data['error']
                         task.completed_at = datetime.now()
-                        print(f"Task {task_id} failed: {json_data['error']}")
+                        task.notify()
+                        logger.warning("Task %s failed: %s", task_id, json_data['error'])
                         return
                         
                 except json.JSONDecodeError as e:
-                    print(f"Error parsing chunk for task {task_id}: {e}")
+                    logger.warning("Error parsing chunk for task %s: %s", task_id, e)
                     continue
         
         # If we reach here, the stream ended without explicit completion
         task.status = TaskStatus.COMPLETED
         task.completed_at = datetime.now()
         task.progress = 100
+        task.notify()
         
     except Exception as e:
-        print(f"Error in background task {task_id}: {e}")
+        logger.exception("Error in background task %s", task_id)
         task.status = TaskStatus.FAILED
         task.error = str(e)
         task.completed_at = datetime.now()
+        task.notify()
+    finally:
+        retire_finished_task(task_id)
 
 # --- Error Handling ---
 def check_api_keys(model_name):
@@ -221,65 +579,102 @@ def check_api_keys(model_name):
     return missing
 
 # --- Enhanced Web Search Function ---
-def search_web_tavily(query, max_results=10):
-    """Performs enhanced web search using Tavily API with improved source diversity and quality filtering."""
+# Quality score thresholds for search result labels
+HIGH_QUALITY_SCORE = 200
+MEDIUM_QUALITY_SCORE = 100
+
+def get_quality_level(quality_score):
+    """Map a search result's quality score to its HIGH/MEDIUM/STANDARD label."""
+    if quality_score > HIGH_QUALITY_SCORE:
+        return "HIGH"
+    if quality_score > MEDIUM_QUALITY_SCORE:
+        return "MEDIUM"
+    return "STANDARD"
+
+# Query wording that picks Tavily's topic/depth/time window (whole words, plus multi-word phrases)
+TAVILY_NEWS_WORDS = frozenset(['news', 'latest', 'recent', 'recently', 'today', 'current', 'currently', 'breaking'])
+TAVILY_TUTORIAL_WORDS = frozenset([
+    'tutorial', 'tutorials', 'guide', 'guides', 'guided', 'learn', 'learning', 'learned', 'learns',
+    'course', 'courses'
+])
+TAVILY_TUTORIAL_PHRASES = ('how to',)
+TAVILY_REVIEW_WORDS = frozenset([
+    'review', 'reviews', 'reviewed', 'reviewer', 'reviewers', 'comparison', 'comparisons',
+    'vs', 'versus', 'best'
+])
+
+# Request pieces that are the same for every Tavily search
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+TAVILY_HEADERS = {
+    "Authorization": f"Bearer {tavily_api_key}",
+    "Content-Type": "application/json"
+}
+TAVILY_BASE_PAYLOAD = {
+    "include_answer": True,
+    "include_raw_content": False,
+    "include_images": False,
+    "include_image_descriptions": False,
+    "include_domains": [],
+    "exclude_domains": ["pinterest.com", "instagram.com", "facebook.com", "twitter.com"]
+}
+
+# Raw Tavily responses, shared by the chat search path and the search tools
+TAVILY_CACHE = TTLCache(max_size=512, default_ttl=600)
+TAVILY_NEWS_TTL = 60  # seconds; news results go stale quickly
+
+@functools.lru_cache(maxsize=1024)
+def classify_tavily_search(query_lower):
+    """Pick Tavily's (topic, search_depth, time_range) from the query's wording."""
+    words = query_terms(query_lower)
+    if words & TAVILY_NEWS_WORDS:
+        return "news", "advanced", "week"
+    if words & TAVILY_TUTORIAL_WORDS or any(phrase in query_lower for phrase in TAVILY_TUTORIAL_PHRASES):
+        return "general", "basic", "year"  # Broader timeframe for educational content
+    if words & TAVILY_REVIEW_WORDS:
+        return "general", "advanced", "month"  # Medium timeframe for reviews
+    return "general", "advanced", None
+
+def search_web_tavily(query, max_results=10, query_lower=None, max_age=None):
+    """
+    Performs enhanced web search using Tavily API with improved source diversity and quality filtering.
+    Pass query_lower when the caller has already lowercased the query, and max_age to only
+    reuse a cached response younger than that many seconds (0 always searches).
+    """
     if not tavily_api_key:
         return {"error": "Tavily API key not configured"}
     
     try:
-        url = "https://api.tavily.com/search"
-        
         # Enhanced search strategy based on query type
-        query_lower = query.lower()
-        search_depth = "advanced"
-        topic = "general"
-        time_range = None
-        days = None
-        
-        # Adjust search parameters based on query characteristics
-        if any(word in query_lower for word in ['news', 'latest', 'recent', 'today', 'current', 'breaking']):
-            topic = "news"
-            time_range = "week"
-            search_depth = "advanced"
-        elif any(word in query_lower for word in ['tutorial', 'guide', 'how to', 'learn', 'course']):
-            time_range = "year"  # Broader timeframe for educational content
-            search_depth = "basic"
-        elif any(word in query_lower for word in ['review', 'comparison', 'vs', 'versus', 'best']):
-            time_range = "month"  # Medium timeframe for reviews
-            search_depth = "advanced"
-        
-        # Prepare payload according to Tavily API documentation
+        if query_lower is None:
+            query_lower = query.lower()
+        topic, search_depth, time_range = classify_tavily_search(query_lower[:QUERY_CLASSIFY_MAX_CHARS])
+        
+        cache_key = make_cache_key("tavily", query_lower.strip(), max_results, topic)
+        cached = TAVILY_CACHE.get_with_meta(cache_key) if max_age != 0 else None
+        if cached is not None and (max_age is None or time.monotonic() - cached[1] <= max_age):
+            logger.debug("Tavily cache hit for query: %r", query)
+            return cached[0]
+        
+        # Prepare payload according to Tavily API documentation; optional keys are only set when used
         payload = {
+            **TAVILY_BASE_PAYLOAD,
             "query": query,
             "topic": topic,
             "search_depth": search_depth,
-            "chunks_per_source": 3 if search_depth == "advanced" else None,
-            "max_results": min(max_results, 20),  # API limit is 20
-            "time_range": time_range,
-            "include_answer": True,
-            "include_raw_content": False,
-            "include_images": False,
-            "include_image_descriptions": False,
-            "include_domains": [],
-            "exclude_domains": ["pinterest.com", "instagram.com", "facebook.com", "twitter.com"]
+            "max_results": min(max_results, 20)  # API limit is 20
         }
+        if search_depth == "advanced":
+            payload["chunks_per_source"] = 3
+        if time_range:
+            payload["time_range"] = time_range
         
         # Add days parameter only for news topic
         if topic == "news":
             payload["days"] = 7
         
-        # Remove None values from payload
-        payload = {k: v for k, v in payload.items() if v is not None}
-        
-        # Proper headers according to API documentation
-        headers = {
-            "Authorization": f"Bearer {tavily_api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        print(f"Performing web search with strategy: topic={topic}, depth={search_depth}, time_range={time_range}")
+        logger.debug("Performing web search with strategy: topic=%s, depth=%s, time_range=%s", topic, search_depth, time_range)
         
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = tavily_session.post(TAVILY_SEARCH_URL, json=payload, headers=TAVILY_HEADERS, timeout=30)
         response.raise_for_status()
         
         data = response.json()
@@ -287,11 +682,11 @@ def search_web_tavily(query, max_results=10):
         # Enhanced result processing and quality filtering
         if "results" in data and data["results"]:
             original_count = len(data["results"])
-            print(f"Tavily returned {original_count} sources for query: {query}")
+            logger.debug("Tavily returned %d sources for query: %r", original_count, query)
             
             # Filter and enhance results
             filtered_results = []
-            seen_domains = set()
+            domain_counts = Counter()  # Accepted results per domain
             
             for result in data["results"]:
                 # Extract domain for diversity checking
@@ -303,18 +698,18 @@ def search_web_tavily(query, max_results=10):
                 # Quality filters
                 title = result.get("title", "").strip()
                 content = result.get("content", "").strip()
-                url = result.get("url", "")
+                result_url = result.get("url", "")
                 score = result.get("score", 0)  # Tavily provides relevance score
                 
                 # Skip low-quality results
                 if (len(title) < 10 or len(content) < 50 or 
-                    not url or "404" in title.lower() or "error" in title.lower()):
+                    not result_url or "404" in title.lower() or "error" in title.lower()):
                     continue
                 
                 # Promote domain diversity (max 2 results per domain)
-                domain_count = sum(1 for r in filtered_results if r.get("domain") == domain)
-                if domain_count >= 2:
+                if domain_counts[domain] >= 2:
                     continue
+                domain_counts[domain] += 1
                 
                 # Add domain info and enhanced quality score
                 result["domain"] = domain
@@ -324,54 +719,54 @@ def search_web_tavily(query, max_results=10):
                 
                 filtered_results.append(result)
             
-            # Sort by quality score (Tavily score + our enhancements)
-            filtered_results.sort(key=lambda x: x.get("quality_score", 0), reverse=True)
+            # Keep the top results by quality score (Tavily score + our enhancements)
+            data["results"] = heapq.nlargest(max_results, filtered_results, key=operator.itemgetter("quality_score"))
             
-            # Update data with filtered results
-            data["results"] = filtered_results[:max_results]
-            
-            print(f"Filtered to {len(data['results'])} high-quality sources from {len(set(r['domain'] for r in data['results']))} different domains")
+            logger.debug("Filtered to %d high-quality sources", len(data['results']))
             
             # If we have very few results, try fallback strategies
             if len(data["results"]) < 3:
-                print(f"Only got {len(data['results'])} sources, trying fallback strategies...")
+                logger.debug("Only got %d sources, trying fallback strategies", len(data['results']))
                 
-                # Strategy 1: Broader time window
-                if time_range and time_range != "year":
-                    broader_payload = payload.copy()
-                    broader_payload["time_range"] = "year"
-                    broader_payload["search_depth"] = "basic"
-                    broader_payload["exclude_domains"] = []  # Remove domain restrictions
-                    
+                def fallback_search(fallback_payload, label):
+                    """Run one fallback search; failures just leave the current results in place."""
                     try:
-                        broader_response = requests.post(url, json=broader_payload, headers=headers, timeout=30)
-                        broader_response.raise_for_status()
-                        broader_data = broader_response.json()
-                        
-                        if "results" in broader_data and len(broader_data["results"]) > len(data["results"]):
-                            print(f"Broader search returned {len(broader_data['results'])} sources")
-                            data = broader_data
+                        fallback_response = tavily_session.post(TAVILY_SEARCH_URL, json=fallback_payload, headers=TAVILY_HEADERS, timeout=30)
+                        fallback_response.raise_for_status()
+                        return fallback_response.json()
                     except Exception as e:
-                        print(f"Broader search failed: {e}")
+                        logger.warning("%s search failed: %s", label, e)
+                        return None
                 
-                # Strategy 2: Remove time restrictions entirely
+                # Strategy 2 is only needed when the primary search is nearly empty, so start it
+                # alongside strategy 1 instead of waiting for the broader search to come back
+                unrestricted_future = None
                 if len(data["results"]) < 2:
                     unrestricted_payload = payload.copy()
                     unrestricted_payload.pop("time_range", None)
                     unrestricted_payload.pop("days", None)
                     unrestricted_payload["search_depth"] = "basic"
                     unrestricted_payload["exclude_domains"] = []
+                    unrestricted_future = TAVILY_FALLBACK_EXECUTOR.submit(fallback_search, unrestricted_payload, "Unrestricted")
+                
+                # Strategy 1: Broader time window
+                if time_range and time_range != "year":
+                    broader_payload = payload.copy()
+                    broader_payload["time_range"] = "year"
+                    broader_payload["search_depth"] = "basic"
+                    broader_payload["exclude_domains"] = []  # Remove domain restrictions
                     
-                    try:
-                        unrestricted_response = requests.post(url, json=unrestricted_payload, headers=headers, timeout=30)
-                        unrestricted_response.raise_for_status()
-                        unrestricted_data = unrestricted_response.json()
-                        
-                        if "results" in unrestricted_data and len(unrestricted_data["results"]) > len(data["results"]):
-                            print(f"Unrestricted search returned {len(unrestricted_data['results'])} sources")
-                            data = unrestricted_data
-                    except Exception as e:
-                        print(f"Unrestricted search failed: {e}")
+                    broader_data = fallback_search(broader_payload, "Broader")
+                    if broader_data and "results" in broader_data and len(broader_data["results"]) > len(data["results"]):
+                        logger.debug("Broader search returned %d sources", len(broader_data['results']))
+                        data = broader_data
+                
+                # Strategy 2: Remove time restrictions entirely
+                if unrestricted_future is not None and len(data["results"]) < 2:
+                    unrestricted_data = unrestricted_future.result()
+                    if unrestricted_data and "results" in unrestricted_data and len(unrestricted_data["results"]) > len(data["results"]):
+                        logger.debug("Unrestricted search returned %d sources", len(unrestricted_data['results']))
+                        data = unrestricted_data
         
         # Add search metadata
         data["search_metadata"] = {
@@ -384,13 +779,17 @@ def search_web_tavily(query, max_results=10):
             "response_time": data.get("response_time", "N/A")
         }
         
+        # The cached copy leaves out this request's latency, which hits would misreport
+        cached_data = {key: value for key, value in data.items() if key != "response_time"}
+        cached_data["search_metadata"] = {key: value for key, value in data["search_metadata"].items() if key != "response_time"}
+        TAVILY_CACHE.set(cache_key, cached_data, ttl=TAVILY_NEWS_TTL if topic == "news" else None)
         return data
         
     except requests.exceptions.Timeout:
-        print(f"Tavily API timeout for query: {query}")
+        logger.warning("Tavily API timeout for query: %r", query)
         return {"error": "Web search timed out. Please try again."}
     except requests.exceptions.RequestException as e:
-        print(f"Tavily API request error: {e}")
+        logger.warning("Tavily API request error: %s", e)
         # Handle specific HTTP status codes
         if hasattr(e, 'response') and e.response is not None:
             status_code = e.response.status_code
@@ -406,12 +805,29 @@ def search_web_tavily(query, max_results=10):
                 return {"error": f"Web search failed with status {status_code}. Please try again."}
         return {"error": f"Web search failed: {str(e)}"}
     except Exception as e:
-        print(f"Tavily API error: {e}")
+        logger.exception("Tavily API error")
         return {"error": f"Web search error: {str(e)}"}
 
 # --- Citation Processing for Perplexity Models ---
 # Perplexity citation processing function removed
 
+def extract_perplexity_sources(chunk):
+    """Return sources/citations attached to a Perplexity stream chunk, if any."""
+    choice = chunk.choices[0]
+    candidates = (
+        getattr(getattr(choice, 'message', None), 'metadata', None),
+        getattr(choice.delta, 'metadata', None),
+        getattr(chunk, 'metadata', None),
+    )
+    sources = None
+    for metadata in candidates:
+        if metadata:
+            if 'sources' in metadata:
+                sources = metadata['sources']
+            elif 'citations' in metadata:
+                sources = metadata['citations']
+    return sources
+
 def extract_domain(url):
     """Extract domain from URL for display purposes."""
     if not url:
@@ -425,107 +841,361 @@ def extract_domain(url):
         return url
 
 # --- Streaming Generator for OpenRouter ---
+# System prompt for OpenRouter chat responses
+OPENROUTER_SYSTEM_PROMPT = (
+    "You are Comet, an advanced AI assistant that provides clear, helpful, and accurate responses. "
+    "Your responses should be exceptionally well-formatted and reader-friendly:\n\n"
+
+    "**FORMATTING EXCELLENCE:**\n"
+    "1. **Structure**: Use clear headings (##, ###) to organize your response\n"
+    "2. **Paragraphs**: Keep paragraphs focused and digestible (3-5 sentences max)\n"
+    "3. **Lists**: Use bullet points and numbered lists for clarity\n"
+    "4. **Emphasis**: Use **bold** for key points and *italics* for subtle emphasis\n"
+    "5. **White Space**: Leave space between sections for better readability\n"
+    "6. **Progressive Disclosure**: Start with key points, then dive deeper\n\n"
+
+    "**CONTENT QUALITY:**\n"
+    "1. **Clear and Organized**: Lead with the main answer, then provide context\n"
+    "2. **Concise yet Thorough**: Be comprehensive but avoid unnecessary verbosity\n"
+    "3. **Accurate**: Base responses on factual information and indicate uncertainties\n"
+    "4. **Helpful**: Provide actionable insights and practical solutions\n"
+    "5. **Accessible**: Explain complex topics in understandable terms\n\n"
+
+    "**RESPONSE STRUCTURE:**\n"
+    "- **Direct Answer First**: Lead with the key information\n"
+    "- **Supporting Details**: Provide relevant context and examples\n"
+    "- **Practical Applications**: Include helpful tips or warnings when applicable\n"
+    "- **Clear Conclusion**: End with a summary or next steps when appropriate\n\n"
+
+    "**SPECIAL CONSIDERATIONS:**\n"
+    "- For mobile readers: Use shorter paragraphs and clear section breaks\n"
+    "- For complex topics: Break down into digestible steps or components\n"
+    "- For comparisons: Use tables or structured layouts when helpful\n"
+    "- For instructions: Provide clear, numbered steps\n\n"
+
+    "**CRITICAL CITATION INSTRUCTIONS FOR PERPLEXITY MODELS:**\n"
+    "When using external sources, include clickable citations using this format:\n"
+    "- [descriptive text](URL) - Example: According to [recent research](https://example.com/study)\n"
+    "- Make citations natural within the text\n"
+    "- Use multiple citations when referencing different sources\n\n"
+
+    "Always aim to create responses that are a pleasure to read and exceed user expectations in both content and presentation."
+)
+
+# Appended to the system prompt when the user enables web search
+OPENROUTER_WEB_SEARCH_NOTE = (
+    "\n\n**CRITICAL WEB SEARCH INSTRUCTIONS**: "
+    "The user has enabled web search for the most recent and relevant results. You will receive current, real-time web search results from Tavily's advanced search engine with topic-based filtering and relevance scoring. "
+    "When using information from these sources:\n"
+    "1. **EMBED clickable source links** directly in your response using markdown format: [descriptive text](URL)\n"
+    "2. **Make link text natural and descriptive** - integrate seamlessly into sentence flow\n"
+    "3. **PRIORITIZE HIGH-QUALITY SOURCES** - sources are ranked by Tavily's relevance score combined with quality indicators\n"
+    "4. **Reference multiple sources** when possible to provide comprehensive coverage\n"
+    "5. **PRIORITIZE RECENT INFORMATION** - search is optimized for recency based on query type (news, general, etc.)\n"
+    "6. **Include diverse perspectives** - sources are filtered for domain diversity and quality\n"
+    "7. **ONLY USE PROVIDED SOURCES** - do not reference sources that are not explicitly provided in the search results\n"
+    "8. **Clearly distinguish** between information from search results vs. your knowledge\n"
+    "9. **Use the Quick Answer** as a starting point but expand with detailed analysis from individual sources\n"
+    "10. **Cite sources naturally** - Example: 'According to [recent TechCrunch analysis](https://techcrunch.com/...)' or '[industry experts report](https://example.com)'\n"
+    "11. **Leverage search metadata** - consider the search topic, time filter, and domain diversity when crafting your response\n"
+    "12. **Quality indicators** - higher quality sources (with better relevance scores) should be given more weight in your analysis"
+)
+OPENROUTER_WEB_SEARCH_SYSTEM_PROMPT = OPENROUTER_SYSTEM_PROMPT + OPENROUTER_WEB_SEARCH_NOTE
+
+# Models whose provider supports prompt caching via cache_control breakpoints
+PROMPT_CACHE_MODEL_PREFIXES = ("anthropic/",)
+
+@functools.lru_cache(maxsize=32)
+def get_system_message(prompt, model_name):
+    """
+    Build the system message for a prompt once and reuse the dict across requests.
+    For prompt-caching providers the static prompt is marked as a cache breakpoint.
+    """
+    if model_name.startswith(PROMPT_CACHE_MODEL_PREFIXES):
+        return {
+            "role": "system",
+            "content": [{"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}]
+        }
+    return {"role": "system", "content": prompt}
+
+CACHE_BREAKPOINT_ROLES = ("user", "tool", "system")
+
+def with_cache_breakpoints(messages, model_name, count=2):
+    """
+    Return a per-request copy of messages with ephemeral cache breakpoints on the last
+    `count` text messages, so each agent turn reads the prefix cached by the previous one.
+    The stored history is left untouched, keeping the breakpoint count within provider limits.
+    """
+    if not model_name.startswith(PROMPT_CACHE_MODEL_PREFIXES):
+        return messages
+    marked = list(messages)
+    remaining = count
+    for i in range(len(marked) - 1, 0, -1):  # Index 0 is the system prompt, marked by get_system_message
+        if remaining == 0:
+            break
+        message = marked[i]
+        content = message.get("content")
+        if message.get("role") in CACHE_BREAKPOINT_ROLES and isinstance(content, str) and content:
+            marked[i] = {
+                **message,
+                "content": [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            }
+            remaining -= 1
+    return marked
+
+@functools.lru_cache(maxsize=1)
+def get_token_encoding():
+    """Load the tokenizer used for input-size estimates (cl100k_base as a proxy for all models)."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("Could not load tiktoken encoding, using character heuristic: %s", e)
+        return None
+
+def estimate_tokens(text):
+    """Estimate the number of tokens in text."""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) // 4  # Rough estimate: 1 token ≈ 4 characters
+    return len(encoding.encode(text, disallowed_special=()))
+
+# Models that get OpenRouter's pdf-text file parser for PDF uploads
+PDF_TEXT_PARSER_MODELS = {"openai/o4-mini-high", "openai/gpt-4.1"}
+
+# Response token budget per model; other models get DEFAULT_MAX_TOKENS
+DEFAULT_MAX_TOKENS = 30000
+MODEL_MAX_TOKENS = {
+    "perplexity/sonar-reasoning-pro": 60000,  # 128,000 total context; increased for more comprehensive reasoning
+    "openai/gpt-4.1": min(1047576 - 8192, 80000),  # 1,047,576 token context window; reserve 8192 tokens for prompt
+    "openai/gpt-4o-search-preview": 16384,  # Stated 16,384 generation capacity
+    "openai/gpt-4.5-preview": min(128000 - 8192, 60000),  # 128,000 token context window; reserve 8192 tokens for prompt
+    "openai/o4-mini-high": min(200000 - 8192, 80000),  # 200,000 token context window; reserve 8192 tokens for prompt
+    "openai/o3": min(200000 - 8192, 80000),  # 200,000 token context window; reserve 8192 tokens for prompt
+    "deepseek/deepseek-r1:free": 163800,  # Reduced slightly to accommodate prompt tokens
+    "deepseek/deepseek-r1-0528": min(163840 - 8192, 70000),  # 163,840 token context window; reserve 8192 tokens for prompt
+    "google/gemini-2.5-flash-preview:thinking": 80000,  # Increased for deeper thinking
+    "openai/o3-mini-high": 100000,
+    "anthropic/claude-opus-4": min(200000 - 8192, 80000),  # 200,000 token context window; reserve 8192 tokens for prompt
+    "anthropic/claude-sonnet-4": min(200000 - 8192, 80000),  # 200,000 token context window; reserve 8192 tokens for prompt
+    "google/gemini-2.5-flash-preview-05-20:thinking": min(1048576 - 8192, 100000),  # 1,048,576 token context window; allow extensive thinking
+    "google/gemini-2.5-pro-preview": min(1048576 - 8192, 100000),  # 1,048,576 token context window; allow extensive responses
+    "openai/codex-mini": min(200000 - 8192, 60000),  # 200,000 token context window; allow detailed code responses
+}
+
+# Reasoning settings sent to every :thinking / reasoning model
+FULL_REASONING_CONFIG = {
+    "effort": "high",
+    "exclude": False,
+    "depth": "comprehensive",
+    "analysis_depth": "thorough",
+    "step_by_step": True,
+    "consider_alternatives": True,
+    "verify_reasoning": True
+}
+
+# Models that don't support the top_p parameter
+MODELS_WITHOUT_TOP_P = frozenset([
+    "openai/codex-mini",
+    # Add more models here if they don't support top_p
+])
+
+# Models that accept a temperature parameter
+MODELS_WITH_TEMPERATURE = frozenset([
+    "perplexity/sonar-reasoning-pro",
+    "openai/gpt-4.1",
+    "openai/gpt-4.5-preview",
+    "anthropic/claude-sonnet-4",
+    "anthropic/claude-opus-4",
+    "openai/o4-mini-high",
+    "openai/o3-mini-high",
+    # Add more as needed
+])
+
+def ensure_pdf_text_parser(extra_body_params):
+    """Add (or update) the file-parser plugin so PDFs use the pdf-text engine."""
+    plugins = extra_body_params.setdefault("plugins", [])
+    for plugin in plugins:
+        if plugin.get("id") == "file-parser":
+            plugin.setdefault("pdf", {})["engine"] = "pdf-text"
+            return
+    plugins.append({
+        "id": "file-parser",
+        "pdf": {
+            "engine": "pdf-text" # Free and good for text-based PDFs
+        }
+    })
+
+class DeltaCoalescer:
+    """Buffers small streamed deltas and releases them as larger batches."""
+    def __init__(self, max_chars=256, max_delay=0.25):
+        self.max_chars = max_chars
+        self.max_delay = max_delay  # Seconds a batch may wait before it is released
+        self.parts = []
+        self.length = 0
+        self.started_at = 0.0
+
+    def add(self, text):
+        """Buffer text and return the joined batch once it is due, otherwise None."""
+        if not self.parts:
+            self.started_at = time.monotonic()
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.max_chars or time.monotonic() - self.started_at >= self.max_delay:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Return everything buffered so far (or None) and reset."""
+        if not self.parts:
+            return None
+        text = "".join(self.parts)
+        self.parts = []
+        self.length = 0
+        return text
+
+# Markers the model wraps around inline Chart.js configs
+CHART_START_MARKER = "[[CHARTJS_CONFIG_START]]"
+CHART_END_MARKER = "[[CHARTJS_CONFIG_END]]"
+CHART_START_MARKER_LEN = len(CHART_START_MARKER)
+CHART_END_MARKER_LEN = len(CHART_END_MARKER)
+
+WEB_SEARCH_HINT = "\n\nNote: Web search is enabled. Prioritize recent information from search results and cite sources appropriately."
+
+# Query profiles: (keywords, phrases, context hint, top_p, temperature). First match wins.
+# Keywords are matched as whole words; phrases are multi-word substrings.
+QUERY_PROFILES = (
+    (frozenset([
+        'creative', 'creatively', 'story', 'stories', 'storytelling', 'imagine', 'imagined', 'imagines',
+        'brainstorm', 'brainstorming', 'ideas'
+    ]), (),
+     "", 0.95, 0.9),  # More creative
+    (frozenset([
+        'code', 'codes', 'coded', 'coder', 'coders', 'coding', 'codebase',
+        'program', 'programs', 'programmed', 'programmer', 'programmers', 'programming', 'programmatically',
+        'function', 'functions', 'script', 'scripts', 'scripting', 'javascript', 'typescript',
+        'debug', 'debugging', 'debugger', 'error', 'errors'
+    ]), (),
+     "\n\nNote: This appears to be a coding-related question. Please provide code examples with syntax highlighting and clear explanations.",
+     0.9, 0.3),  # More precise
+    (frozenset(['technical', 'technically', 'precise', 'precisely', 'exact', 'exactly', 'calculate', 'calculated', 'calculates']), (),
+     "", 0.9, 0.3),
+    (frozenset(['explain', 'explained', 'explaining', 'explains', 'why', 'define', 'defined', 'defines']), ('what is', 'how does'),
+     "\n\nNote: This appears to be an explanatory question. Please provide a comprehensive yet accessible explanation with examples.",
+     0.92, 0.5),  # Balanced
+    (frozenset(['compare', 'compared', 'compares', 'comparison', 'difference', 'differences', 'versus', 'vs', 'better']), (),
+     "\n\nNote: This appears to be a comparison question. Consider using a table or structured format to clearly show differences.",
+     0.95, 0.7),
+    (frozenset(['list', 'lists', 'listed', 'listing', 'steps', 'guide', 'guides', 'guided', 'tutorial', 'tutorials']), ('how to',),
+     "\n\nNote: This appears to be a procedural question. Please provide clear, numbered steps or bullet points.",
+     0.95, 0.7),
+    (frozenset([
+        'analyze', 'analyzed', 'analyzes', 'analyse', 'analysed', 'review', 'reviews', 'reviewed', 'reviewing',
+        'evaluate', 'evaluated', 'evaluates', 'assess', 'assessed', 'assessing', 'assessment',
+        'summarize', 'summarized', 'summarizes', 'summarise'
+    ]), (),
+     "\n\nNote: This appears to be an analytical question. Please provide a thorough analysis with pros, cons, and recommendations.",
+     0.92, 0.5),
+)
+DEFAULT_QUERY_PROFILE = ("", 0.95, 0.7)  # Default balanced creativity
+
+# Supported image types for multimodal input (jpg is a common alias for jpeg, GIFs must be non-animated)
+SUPPORTED_IMAGE_MIMES = frozenset(["image/png", "image/jpeg", "image/jpg", "image/webp", "image/gif"])
+DATA_URL_HEADER_MAX_CHARS = 100  # "data:<mime>;base64" always fits; the payload is never scanned
+
+def parse_data_url_header(data_url):
+    """Return (mime, is_base64) from a data URL's header, or (None, False) if it isn't a data URL."""
+    comma = data_url.find(",", 0, DATA_URL_HEADER_MAX_CHARS)
+    if comma < 0 or not data_url.startswith("data:"):
+        return None, False
+    mime, _, params = data_url[5:comma].partition(";")
+    return mime, params == "base64"
+
+@functools.lru_cache(maxsize=1024)
+def classify_query_profile(query_lower):
+    """Pick the context hint and sampling parameters for a query in a single pass."""
+    words = query_terms(query_lower)
+    for keywords, phrases, context_hint, top_p, temperature in QUERY_PROFILES:
+        if words & keywords or any(phrase in query_lower for phrase in phrases):
+            return context_hint, top_p, temperature
+    return DEFAULT_QUERY_PROFILE
+
 def stream_openrouter(query, model_name_with_suffix, reasoning_config=None, uploaded_file_data=None, file_type=None, web_search_enabled=False):
     """Generator for responses from OpenRouter with enhanced web search integration."""
     if not openrouter_api_key:
-        yield f"data: {json.dumps({'error': 'OpenRouter API key not configured.'})}\n\n"
+        yield error_frame('OpenRouter API key not configured.')
         return
 
+    # Lowercased once for the web search and the prompt profile
+    query_lower = query.lower()
+
+    # Validate any upload first, so a bad file fails fast without spending a web search
+    file_part = None
+    if uploaded_file_data and file_type:
+        # Validation only reads the short header; the multi-MB base64 body is passed through untouched
+        upload_mime, upload_is_base64 = parse_data_url_header(uploaded_file_data)
+        if file_type == "image":
+            # Validate against supported image types for general multimodal input
+            if upload_mime not in SUPPORTED_IMAGE_MIMES or not upload_is_base64:
+                yield error_frame('Invalid image data format. Expected PNG, JPEG, WEBP, or GIF data URL.')
+                return
+
+            file_part = {
+                "type": "image_url",
+                "image_url": {
+                    "url": uploaded_file_data,
+                    "detail": "high"
+                }
+            }
+            logger.debug("Image data included for OpenRouter. Type: %s, Detail: high, Data starts with: %.50s...", file_type, uploaded_file_data)
+        elif file_type == "pdf":
+            if upload_mime != "application/pdf":
+                # Basic check
+                yield error_frame('Invalid PDF data format. Expected data URL.')
+                return
+            file_part = {
+                "type": "file",
+                "file": {
+                    "filename": "uploaded_document.pdf", # Generic filename for now
+                    "file_data": uploaded_file_data
+                }
+            }
+            logger.debug("PDF data included for OpenRouter. Type: %s, Data starts with: %.50s...", file_type, uploaded_file_data)
+        else:
+            yield error_frame('Unsupported file_type for multimodal input.')
+            return
+
     # Enhanced system prompt for better responses with web search
-    web_search_note = ""
-    if web_search_enabled:
-        web_search_note = (
-            "\n\n**CRITICAL WEB SEARCH INSTRUCTIONS**: "
-            "The user has enabled web search for the most recent and relevant results. You will receive current, real-time web search results from Tavily's advanced search engine with topic-based filtering and relevance scoring. "
-            "When using information from these sources:\n"
-            "1. **EMBED clickable source links** directly in your response using markdown format: [descriptive text](URL)\n"
-            "2. **Make link text natural and descriptive** - integrate seamlessly into sentence flow\n"
-            "3. **PRIORITIZE HIGH-QUALITY SOURCES** - sources are ranked by Tavily's relevance score combined with quality indicators\n"
-            "4. **Reference multiple sources** when possible to provide comprehensive coverage\n"
-            "5. **PRIORITIZE RECENT INFORMATION** - search is optimized for recency based on query type (news, general, etc.)\n"
-            "6. **Include diverse perspectives** - sources are filtered for domain diversity and quality\n"
-            "7. **ONLY USE PROVIDED SOURCES** - do not reference sources that are not explicitly provided in the search results\n"
-            "8. **Clearly distinguish** between information from search results vs. your knowledge\n"
-            "9. **Use the Quick Answer** as a starting point but expand with detailed analysis from individual sources\n"
-            "10. **Cite sources naturally** - Example: 'According to [recent TechCrunch analysis](https://techcrunch.com/...)' or '[industry experts report](https://example.com)'\n"
-            "11. **Leverage search metadata** - consider the search topic, time filter, and domain diversity when crafting your response\n"
-            "12. **Quality indicators** - higher quality sources (with better relevance scores) should be given more weight in your analysis"
-        )
-    
-    enhanced_openrouter_system_prompt = (
-        "You are Comet, an advanced AI assistant that provides clear, helpful, and accurate responses. "
-        "Your responses should be exceptionally well-formatted and reader-friendly:\n\n"
-        
-        "**FORMATTING EXCELLENCE:**\n"
-        "1. **Structure**: Use clear headings (##, ###) to organize your response\n"
-        "2. **Paragraphs**: Keep paragraphs focused and digestible (3-5 sentences max)\n"
-        "3. **Lists**: Use bullet points and numbered lists for clarity\n"
-        "4. **Emphasis**: Use **bold** for key points and *italics* for subtle emphasis\n"
-        "5. **White Space**: Leave space between sections for better readability\n"
-        "6. **Progressive Disclosure**: Start with key points, then dive deeper\n\n"
-        
-        "**CONTENT QUALITY:**\n"
-        "1. **Clear and Organized**: Lead with the main answer, then provide context\n"
-        "2. **Concise yet Thorough**: Be comprehensive but avoid unnecessary verbosity\n"
-        "3. **Accurate**: Base responses on factual information and indicate uncertainties\n"
-        "4. **Helpful**: Provide actionable insights and practical solutions\n"
-        "5. **Accessible**: Explain complex topics in understandable terms\n\n"
-        
-        "**RESPONSE STRUCTURE:**\n"
-        "- **Direct Answer First**: Lead with the key information\n"
-        "- **Supporting Details**: Provide relevant context and examples\n"
-        "- **Practical Applications**: Include helpful tips or warnings when applicable\n"
-        "- **Clear Conclusion**: End with a summary or next steps when appropriate\n\n"
-        
-        "**SPECIAL CONSIDERATIONS:**\n"
-        "- For mobile readers: Use shorter paragraphs and clear section breaks\n"
-        "- For complex topics: Break down into digestible steps or components\n"
-        "- For comparisons: Use tables or structured layouts when helpful\n"
-        "- For instructions: Provide clear, numbered steps\n\n"
-        
-        "**CRITICAL CITATION INSTRUCTIONS FOR PERPLEXITY MODELS:**\n"
-        "When using external sources, include clickable citations using this format:\n"
-        "- [descriptive text](URL) - Example: According to [recent research](https://example.com/study)\n"
-        "- Make citations natural within the text\n"
-        "- Use multiple citations when referencing different sources\n\n"
-
-        "Always aim to create responses that are a pleasure to read and exceed user expectations in both content and presentation."
-        + web_search_note
-    )
+    system_prompt = OPENROUTER_WEB_SEARCH_SYSTEM_PROMPT if web_search_enabled else OPENROUTER_SYSTEM_PROMPT
     
     # Perform web search if enabled
     web_search_results = None
     web_search_sources = []
     if web_search_enabled:
-        print(f"Performing web search for query: {query}")
-        web_search_results = search_web_tavily(query, max_results=10)  # Increased back to 10 for more sources
+        logger.debug("Performing web search for query: %s", query)
+        web_search_results = search_web_tavily(query, max_results=10, query_lower=query_lower)  # Increased back to 10 for more sources
         if "error" in web_search_results:
             # Graceful degradation - continue without web search
-            print(f"Web search failed: {web_search_results['error']}")
+            logger.warning("Web search failed: %s", web_search_results['error'])
             web_search_enabled = False
             web_search_results = None
         else:
             # Send web search results as a separate event for frontend handling
             if web_search_results and "results" in web_search_results:
-                search_data = {
-                    "web_search_results": {
-                        "answer": web_search_results.get("answer", ""),
-                        "results": []
-                    }
-                }
-                
+                # Compact wire format: {"wsr": {"a": answer, "r": [[title, url, content], ...]}}
+                packed_sources = []
                 for i, result in enumerate(web_search_results["results"][:10], 1):  # Process up to 10 sources
-                    source_data = {
-                        "title": result.get("title", "No title"),
-                        "url": result.get("url", ""),
-                        "content": result.get("content", "")[:250] + "..." if len(result.get("content", "")) > 250 else result.get("content", "")
-                    }
-                    search_data["web_search_results"]["results"].append(source_data)
-                    web_search_sources.append(f"Source {i}: {source_data['title']} - {source_data['url']}")
+                    title = result.get("title", "No title")
+                    url = result.get("url", "")
+                    content = clip_text(result.get("content", ""), 250)
+                    packed_sources.append([title, url, content])
+                    web_search_sources.append(f"Source {i}: {title} - {url}")
+                search_data = {"wsr": {"a": web_search_results.get("answer", ""), "r": packed_sources}}
                 
                 # Send web search results to frontend
-                print(f"Sending {len(search_data['web_search_results']['results'])} sources to frontend")
-                yield f"data: {json.dumps(search_data)}\n\n"
+                logger.debug("Sending %d sources to frontend", len(packed_sources))
+                yield sse_event(search_data)
     
 
     
@@ -535,41 +1205,46 @@ def stream_openrouter(query, model_name_with_suffix, reasoning_config=None, uplo
     
     # Add web search context if available
     if web_search_enabled and web_search_results and "results" in web_search_results:
-        search_context = "\n\n**CURRENT WEB SEARCH RESULTS** (Embed source links in your response):\n"
+        # Collect fragments and join once instead of growing one string with +=
+        search_context_parts = ["\n\n**CURRENT WEB SEARCH RESULTS** (Embed source links in your response):\n"]
         
         # Add Tavily's answer if available
         if "answer" in web_search_results and web_search_results["answer"]:
-            search_context += f"**Quick Answer:** {web_search_results['answer']}\n\n"
+            search_context_parts.append(f"**Quick Answer:** {web_search_results['answer']}\n\n")
         
         # Add numbered search results for easy reference
-        search_context += "**Sources:**\n"
-        ai_sources_count = len(web_search_results["results"][:10])
-        print(f"Sending {ai_sources_count} sources to AI context")
-        for i, result in enumerate(web_search_results["results"][:10], 1):  # Process up to 10 sources
+        search_context_parts.append("**Sources:**\n")
+        ai_results = web_search_results["results"][:10]  # Process up to 10 sources
+        ai_sources_count = len(ai_results)
+        logger.debug("Sending %d sources to AI context", ai_sources_count)
+        for i, result in enumerate(ai_results, 1):
             title = result.get("title", "No title")
             url = result.get("url", "")
-            content = result.get("content", "")[:200] + "..." if len(result.get("content", "")) > 200 else result.get("content", "")
+            content = clip_text(result.get("content", ""), 200)
             domain = result.get("domain", "unknown")
-            quality_score = result.get("quality_score", 0)
-            quality_level = "HIGH" if quality_score > 200 else "MEDIUM" if quality_score > 100 else "STANDARD"
+            quality_level = get_quality_level(result.get("quality_score", 0))
             
-            search_context += f"{i}. **{title}** [{quality_level} QUALITY]\n"
-            search_context += f"   Domain: {domain}\n"
-            search_context += f"   URL: {url}\n"
-            search_context += f"   Content: {content}\n\n"
+            search_context_parts.append(
+                f"{i}. **{title}** [{quality_level} QUALITY]\n"
+                f"   Domain: {domain}\n"
+                f"   URL: {url}\n"
+                f"   Content: {content}\n\n"
+            )
         
         # Add search metadata for AI context
         metadata = web_search_results.get("search_metadata", {})
-        search_context += f"**SEARCH METADATA:**\n"
-        search_context += f"- Search Strategy: {metadata.get('search_depth', 'advanced')} search\n"
-        search_context += f"- Time Filter: {metadata.get('time_range', 'all time')} time range\n"
-        search_context += f"- Source Diversity: {metadata.get('unique_domains', 'N/A')} unique domains\n"
-        search_context += f"- Total Quality Sources: {ai_sources_count}\n\n"
+        search_context_parts.append(
+            f"**SEARCH METADATA:**\n"
+            f"- Search Strategy: {metadata.get('search_depth', 'advanced')} search\n"
+            f"- Time Filter: {metadata.get('time_range', 'all time')} time range\n"
+            f"- Source Diversity: {metadata.get('unique_domains', 'N/A')} unique domains\n"
+            f"- Total Quality Sources: {ai_sources_count}\n\n"
+        )
         
         # Create a list of valid URLs for the AI to reference
-        valid_urls = [result.get("url", "") for result in web_search_results["results"][:10]]
-        search_context += f"**CRITICAL CONSTRAINT**: You have access to EXACTLY {len(web_search_results['results'][:10])} sources listed above. DO NOT reference any sources beyond these {len(web_search_results['results'][:10])} sources. ONLY use URLs from this exact list: {valid_urls}. Instead of using [Source X] citations, embed clickable source links directly in your response using markdown format: [descriptive text](URL). Make the link text descriptive and natural within the sentence flow. These are the most recent results available, prioritize this information over older knowledge. DO NOT use any URLs not in the provided list. Pay attention to quality levels - prioritize HIGH and MEDIUM quality sources over STANDARD quality sources when possible.\n"
-        context_additions.append(search_context)
+        valid_urls = [result.get("url", "") for result in ai_results]
+        search_context_parts.append(f"**CRITICAL CONSTRAINT**: You have access to EXACTLY {ai_sources_count} sources listed above. DO NOT reference any sources beyond these {ai_sources_count} sources. ONLY use URLs from this exact list: {valid_urls}. Instead of using [Source X] citations, embed clickable source links directly in your response using markdown format: [descriptive text](URL). Make the link text descriptive and natural within the sentence flow. These are the most recent results available, prioritize this information over older knowledge. DO NOT use any URLs not in the provided list. Pay attention to quality levels - prioritize HIGH and MEDIUM quality sources over STANDARD quality sources when possible.\n")
+        context_additions.append("".join(search_context_parts))
     
 
     
@@ -577,144 +1252,30 @@ def stream_openrouter(query, model_name_with_suffix, reasoning_config=None, uplo
     if context_additions:
         enhanced_query = f"{query}{''.join(context_additions)}"
     
-    user_content_parts = [{"type": "text", "text": enhanced_query}]
-    
-    # Add context-aware prompting based on query type
-    query_lower = query.lower()
-    context_hint = ""
-    
-    if any(word in query_lower for word in ['code', 'program', 'function', 'script', 'debug', 'error']):
-        context_hint = "\n\nNote: This appears to be a coding-related question. Please provide code examples with syntax highlighting and clear explanations."
-    elif any(word in query_lower for word in ['explain', 'what is', 'how does', 'why', 'define']):
-        context_hint = "\n\nNote: This appears to be an explanatory question. Please provide a comprehensive yet accessible explanation with examples."
-    elif any(word in query_lower for word in ['compare', 'difference', 'versus', 'vs', 'better']):
-        context_hint = "\n\nNote: This appears to be a comparison question. Consider using a table or structured format to clearly show differences."
-    elif any(word in query_lower for word in ['list', 'steps', 'how to', 'guide', 'tutorial']):
-        context_hint = "\n\nNote: This appears to be a procedural question. Please provide clear, numbered steps or bullet points."
-    elif any(word in query_lower for word in ['analyze', 'review', 'evaluate', 'assess']):
-        context_hint = "\n\nNote: This appears to be an analytical question. Please provide a thorough analysis with pros, cons, and recommendations."
-    elif web_search_enabled:
-        context_hint = "\n\nNote: Web search is enabled. Prioritize recent information from search results and cite sources appropriately."
+    # Add context-aware prompting and sampling parameters based on query type
+    context_hint, top_p_value, temperature_value = classify_query_profile(query_lower[:QUERY_CLASSIFY_MAX_CHARS])
+    if not context_hint and web_search_enabled:
+        context_hint = WEB_SEARCH_HINT
     
     # Append context hint to the query if applicable
-    if context_hint:
-        user_content_parts[0]["text"] += context_hint
-
-    if uploaded_file_data and file_type:
-        if file_type == "image":
-            # Validate against supported image types for general multimodal input
-            is_valid_image_type = False
-            supported_image_prefixes = [
-                "data:image/png;base64,",
-                "data:image/jpeg;base64,",
-                "data:image/jpg;base64,", # Common alternative for jpeg
-                "data:image/webp;base64,",
-                "data:image/gif;base64,"  # Non-animated GIF
-            ]
-            for prefix in supported_image_prefixes:
-                if uploaded_file_data.startswith(prefix):
-                    is_valid_image_type = True
-                    break
-            
-            if not is_valid_image_type:
-                yield f"data: {json.dumps({'error': 'Invalid image data format. Expected PNG, JPEG, WEBP, or GIF data URL.'})}\n\n"
-                return
+    final_query_text = enhanced_query + context_hint if context_hint else enhanced_query
+    user_content_parts = [{"type": "text", "text": final_query_text}]
+    if file_part is not None:
+        user_content_parts.append(file_part)
 
-            user_content_parts.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": uploaded_file_data,
-                    "detail": "high"
-                }
-            })
-            print(f"Image data included for OpenRouter. Type: {file_type}, Detail: high, Data starts with: {uploaded_file_data[:50]}...")
-        elif file_type == "pdf":
-            if not uploaded_file_data.startswith("data:application/pdf"):
-                # Basic check
-                yield f"data: {json.dumps({'error': 'Invalid PDF data format. Expected data URL.'})}\n\n"
-                return
-            user_content_parts.append({
-                "type": "file",
-                "file": {
-                    "filename": "uploaded_document.pdf", # Generic filename for now
-                    "file_data": uploaded_file_data
-                }
-            })
-            print(f"PDF data included for OpenRouter. Type: {file_type}, Data starts with: {uploaded_file_data[:50]}...")
-        else:
-            yield f"data: {json.dumps({'error': 'Unsupported file_type for multimodal input.'})}\n\n"
-            return
-        
     messages = [
-        {"role": "system", "content": enhanced_openrouter_system_prompt},
+        get_system_message(system_prompt, model_name_with_suffix),
         {"role": "user", "content": user_content_parts}
     ]
 
-    try:
-        site_url = os.getenv("APP_SITE_URL", "http://localhost:8080")
-        site_title = os.getenv("APP_SITE_TITLE", "Comet AI Search")
-
-        openrouter_client_instance = openai.OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=openrouter_api_key,
-            default_headers={ 
-                "HTTP-Referer": site_url,
-                "X-Title": site_title
-            }
-        )
-    except Exception as e:
-        print(f"Failed to initialize OpenRouter client: {e}")
-        yield f"data: {json.dumps({'error': 'Failed to initialize OpenRouter client.'})}\n\n"
-        return
-
     actual_model_name_for_sdk = model_name_with_suffix
-    max_tokens_val = 30000 # Default value for most models
-
     # Adjust max_tokens based on model specifics - Enhanced for better AI thinking
-    if actual_model_name_for_sdk == "perplexity/sonar-reasoning-pro": # 128,000 total context
-        max_tokens_val = 60000 # Increased for more comprehensive reasoning
-    elif actual_model_name_for_sdk == "openai/gpt-4.1": # 1,047,576 token context window
-        max_tokens_val = min(1047576 - 8192, 80000)  # Reserve 8192 tokens for prompt, allow comprehensive responses
-    elif actual_model_name_for_sdk == "openai/gpt-4o-search-preview": # Stated 16,384 generation capacity
-        max_tokens_val = 16384
-    elif actual_model_name_for_sdk == "openai/gpt-4.5-preview": # 128,000 token context window
-        max_tokens_val = min(128000 - 8192, 60000)  # Reserve 8192 tokens for prompt, allow detailed responses
-    elif actual_model_name_for_sdk == "openai/o4-mini-high": # 200,000 token context window
-        max_tokens_val = min(200000 - 8192, 80000)  # Reserve 8192 tokens for prompt, allow comprehensive responses
-    elif actual_model_name_for_sdk == "openai/o3": # 200,000 token context window
-        max_tokens_val = min(200000 - 8192, 80000)  # Reserve 8192 tokens for prompt, allow comprehensive responses
-    elif actual_model_name_for_sdk == "deepseek/deepseek-r1:free":
-        max_tokens_val = 163800 # Reduced slightly to accommodate prompt tokens
-    elif actual_model_name_for_sdk == "deepseek/deepseek-r1-0528": # 163,840 token context window
-        max_tokens_val = min(163840 - 8192, 70000)  # Reserve 8192 tokens for prompt, allow detailed reasoning
-    elif actual_model_name_for_sdk == "google/gemini-2.5-flash-preview:thinking":
-        max_tokens_val = 80000  # Increased for deeper thinking
-    elif actual_model_name_for_sdk == "openai/o3-mini-high":
-        max_tokens_val = 100000
-    elif actual_model_name_for_sdk == "anthropic/claude-opus-4": # 200,000 token context window
-        max_tokens_val = min(200000 - 8192, 80000)  # Reserve 8192 tokens for prompt, allow comprehensive responses
-    elif actual_model_name_for_sdk == "anthropic/claude-sonnet-4": # 200,000 token context window
-        max_tokens_val = min(200000 - 8192, 80000)  # Reserve 8192 tokens for prompt, allow comprehensive responses
-    elif actual_model_name_for_sdk == "google/gemini-2.5-flash-preview-05-20:thinking": # 1,048,576 token context window
-        max_tokens_val = min(1048576 - 8192, 100000)  # Reserve 8192 tokens for prompt, allow extensive thinking
-    elif actual_model_name_for_sdk == "google/gemini-2.5-pro-preview": # 1,048,576 token context window
-        max_tokens_val = min(1048576 - 8192, 100000)  # Reserve 8192 tokens for prompt, allow extensive responses
-    elif actual_model_name_for_sdk == "openai/codex-mini": # 200,000 token context window
-        max_tokens_val = min(200000 - 8192, 60000)  # Reserve 8192 tokens for prompt, allow detailed code responses
-    # For other models, max_tokens_val remains the default of 30000
+    max_tokens_val = MODEL_MAX_TOKENS.get(actual_model_name_for_sdk, DEFAULT_MAX_TOKENS)
 
     # Always enable reasoning for models that support it (e.g., :thinking or reasoning_config)
     reasoning_config_to_pass = None
-    if model_name_with_suffix.endswith(':thinking') or 'thinking' in model_name_with_suffix or 'reasoning' in model_name_with_suffix:
-        reasoning_config_to_pass = {
-            "effort": "high", 
-            "exclude": False,
-            "depth": "comprehensive",
-            "analysis_depth": "thorough",
-            "step_by_step": True,
-            "consider_alternatives": True,
-            "verify_reasoning": True
-        }
+    if 'thinking' in model_name_with_suffix or 'reasoning' in model_name_with_suffix:
+        reasoning_config_to_pass = FULL_REASONING_CONFIG
 
     sdk_params = {
         "model": actual_model_name_for_sdk,
@@ -723,97 +1284,31 @@ def stream_openrouter(query, model_name_with_suffix, reasoning_config=None, uplo
         "max_tokens": max_tokens_val,
     }
     
-    # Dynamic parameter adjustment based on query type
-    if any(word in query_lower for word in ['creative', 'story', 'imagine', 'brainstorm', 'ideas']):
-        top_p_value = 0.95
-        temperature_value = 0.9  # More creative
-    elif any(word in query_lower for word in ['code', 'technical', 'precise', 'exact', 'calculate']):
-        top_p_value = 0.9
-        temperature_value = 0.3  # More precise
-    elif any(word in query_lower for word in ['analyze', 'explain', 'summarize', 'review']):
-        top_p_value = 0.92
-        temperature_value = 0.5  # Balanced
-    else:
-        top_p_value = 0.95
-        temperature_value = 0.7  # Default balanced creativity
-
-    # Models that don't support top_p parameter
-    MODELS_WITHOUT_TOP_P = {
-        "openai/codex-mini",
-        # Add more models here if they don't support top_p
-    }
-
     # Only include top_p for models that support it
     if actual_model_name_for_sdk not in MODELS_WITHOUT_TOP_P:
         sdk_params["top_p"] = top_p_value
 
     # Only include temperature for models that support it
-    MODELS_WITH_TEMPERATURE = {
-        "perplexity/sonar-reasoning-pro",
-        "openai/gpt-4.1",
-        "openai/gpt-4.5-preview",
-        "anthropic/claude-sonnet-4",
-        "anthropic/claude-opus-4",
-        "openai/o4-mini-high",
-        "openai/o3-mini-high",
-        # Add more as needed
-    }
     if actual_model_name_for_sdk in MODELS_WITH_TEMPERATURE:
         sdk_params["temperature"] = temperature_value
 
     extra_body_params = {}
+    # Route to the fastest provider for multi-provider models
+    if OPENROUTER_PROVIDER_SORT in OPENROUTER_PROVIDER_SORTS:
+        extra_body_params["provider"] = {"sort": OPENROUTER_PROVIDER_SORT}
     # If reasoning_config is passed (e.g. for :thinking models with exclude: True)
     if reasoning_config_to_pass:
         extra_body_params["reasoning"] = reasoning_config_to_pass
 
-    # Explicitly use pdf-text parser for o4-mini-high with PDFs
-    if actual_model_name_for_sdk == "openai/o4-mini-high" and file_type == "pdf":
-        print(f"Using explicit pdf-text parser for {actual_model_name_for_sdk} with PDF.")
-        if "plugins" not in extra_body_params: # Ensure plugins is initialized
-            extra_body_params["plugins"] = []
-        
-        # Check if file-parser is already added to avoid duplicates if we extend this logic
-        parser_exists = False
-        for plugin in extra_body_params["plugins"]:
-            if plugin.get("id") == "file-parser":
-                parser_exists = True
-                if "pdf" not in plugin: # Should not happen if id is file-parser
-                    plugin["pdf"] = {}
-                plugin["pdf"]["engine"] = "pdf-text" # Ensure it's set to pdf-text
-                break
-        if not parser_exists:
-            extra_body_params["plugins"].append({
-                "id": "file-parser",
-                "pdf": {
-                    "engine": "pdf-text" # Free and good for text-based PDFs
-                }
-            })
-    # Also use pdf-text parser for gpt-4.1 with PDFs
-    elif actual_model_name_for_sdk == "openai/gpt-4.1" and file_type == "pdf":
-        print(f"Using explicit pdf-text parser for {actual_model_name_for_sdk} with PDF.")
-        if "plugins" not in extra_body_params:
-            extra_body_params["plugins"] = []
-        
-        parser_exists = False
-        for plugin in extra_body_params["plugins"]:
-            if plugin.get("id") == "file-parser":
-                parser_exists = True
-                if "pdf" not in plugin:
-                    plugin["pdf"] = {}
-                plugin["pdf"]["engine"] = "pdf-text"
-                break
-        if not parser_exists:
-            extra_body_params["plugins"].append({
-                "id": "file-parser",
-                "pdf": {
-                    "engine": "pdf-text"
-                }
-            })
+    # Explicitly use the free pdf-text parser for models that handle text-based PDFs well
+    if file_type == "pdf" and actual_model_name_for_sdk in PDF_TEXT_PARSER_MODELS:
+        logger.debug("Using explicit pdf-text parser for %s with PDF.", actual_model_name_for_sdk)
+        ensure_pdf_text_parser(extra_body_params)
 
     try:
         # Dynamic token adjustment based on input size
-        input_text_length = len(user_content_parts[0]['text'])
-        estimated_input_tokens = input_text_length // 4  # Rough estimate: 1 token ≈ 4 characters
+        input_text_length = len(final_query_text)
+        estimated_input_tokens = estimate_tokens(final_query_text)
         
         # For models with limited context, adjust max_tokens dynamically
         context_limited_models = {
@@ -829,7 +1324,7 @@ def stream_openrouter(query, model_name_with_suffix, reasoning_config=None, uplo
             available_tokens = model_context_limit - estimated_input_tokens - 2000  # 2000 token safety buffer
             if available_tokens < max_tokens_val:
                 max_tokens_val = max(available_tokens, 1000)  # Ensure at least 1000 tokens for output
-                print(f"Adjusted max_tokens for {actual_model_name_for_sdk}: {max_tokens_val} (input ~{estimated_input_tokens} tokens, context limit: {model_context_limit})")
+                logger.debug("Adjusted max_tokens for %s: %d (input ~%d tokens, context limit: %d)", actual_model_name_for_sdk, max_tokens_val, estimated_input_tokens, model_context_limit)
                 
                 # Update the SDK params with adjusted value
                 sdk_params["max_tokens"] = max_tokens_val
@@ -841,124 +1336,129 @@ def stream_openrouter(query, model_name_with_suffix, reasoning_config=None, uplo
             if credit_safe_limit < max_tokens_val:
                 max_tokens_val = credit_safe_limit
                 sdk_params["max_tokens"] = max_tokens_val
-                print(f"Applied credit-safe limit for {actual_model_name_for_sdk}: {max_tokens_val} tokens")
+                logger.debug("Applied credit-safe limit for %s: %d tokens", actual_model_name_for_sdk, max_tokens_val)
         
-        print(f"Calling OpenRouter for {actual_model_name_for_sdk}. Reasoning: {reasoning_config_to_pass}. Extra Body: {extra_body_params}")
+        logger.info("Calling OpenRouter for %s. Reasoning: %s. Extra Body: %s", actual_model_name_for_sdk, reasoning_config_to_pass, extra_body_params)
         
         # Debug: Log the enhanced query content being sent to AI
         if web_search_enabled and web_search_results:
-            print(f"Enhanced query includes web search context with {len(web_search_results.get('results', []))} sources")
-            print(f"Enhanced query length: {input_text_length} characters (~{estimated_input_tokens} tokens)")
+            logger.debug("Enhanced query includes web search context with %d sources", len(web_search_results.get('results', [])))
+            logger.debug("Enhanced query length: %d characters (~%d tokens)", input_text_length, estimated_input_tokens)
         else:
-            print(f"No web search context - query length: {input_text_length} characters (~{estimated_input_tokens} tokens)")
+            logger.debug("No web search context - query length: %d characters (~%d tokens)", input_text_length, estimated_input_tokens)
         
-        stream = openrouter_client_instance.chat.completions.create(**sdk_params, extra_body=extra_body_params)
+        # Shared, lazily built client; construction failures land in the generic handler below
+        stream = get_openrouter_client().chat.completions.create(**sdk_params, extra_body=extra_body_params)
         buffer = ""
         in_chart_config_block = False
-        chart_config_str = ""
+        chart_config_parts = [] # Joined once the end marker arrives
+        chart_possible = False # Set once the stream emits a '['
         content_received_from_openrouter = False # Flag to track content
         # Perplexity citation variables removed
 
+        # Resolve per-model stream features once instead of probing every chunk
+        is_perplexity = actual_model_name_for_sdk.startswith("perplexity/")
+        wants_reasoning = reasoning_config_to_pass is not None
+        perplexity_sources = None
+        reasoning_coalescer = DeltaCoalescer()
+
         for chunk in stream:
             # Reduced debug output - only log errors and important events
-            delta = chunk.choices[0].delta
+            choice = chunk.choices[0]
+            delta = choice.delta
             
-            # Check for reasoning/thinking content
-            if hasattr(delta, 'reasoning') and delta.reasoning is not None:
-                yield f"data: {json.dumps({'reasoning': delta.reasoning})}\n\n"
+            # Check for reasoning/thinking content (single lookup per field)
+            reasoning = getattr(delta, 'reasoning', None)
+            if reasoning is not None:
+                reasoning_batch = reasoning_coalescer.add(reasoning)
+                if reasoning_batch:
+                    yield sse_event({'reasoning': reasoning_batch})
             
             # Check for thinking content (alternative field name)
-            if hasattr(delta, 'thinking') and delta.thinking is not None:
-                yield f"data: {json.dumps({'reasoning': delta.thinking})}\n\n"
+            thinking = getattr(delta, 'thinking', None)
+            if thinking is not None:
+                reasoning_batch = reasoning_coalescer.add(thinking)
+                if reasoning_batch:
+                    yield sse_event({'reasoning': reasoning_batch})
             
-            # Check if reasoning is in the message metadata
-            if hasattr(chunk.choices[0], 'message') and hasattr(chunk.choices[0].message, 'metadata'):
-                metadata = chunk.choices[0].message.metadata
+            # Check if reasoning is in the message metadata (only reasoning-configured models send it)
+            if wants_reasoning:
+                message = getattr(choice, 'message', None)
+                metadata = getattr(message, 'metadata', None)
                 if metadata and 'reasoning' in metadata:
-                    yield f"data: {json.dumps({'reasoning': metadata['reasoning']})}\n\n"
+                    reasoning_batch = reasoning_coalescer.add(metadata['reasoning'])
+                    if reasoning_batch:
+                        yield sse_event({'reasoning': reasoning_batch})
             
             if delta.content is not None:
+                # Release pending reasoning before the answer text it precedes
+                reasoning_batch = reasoning_coalescer.flush()
+                if reasoning_batch:
+                    yield sse_event({'reasoning': reasoning_batch})
                 content_received_from_openrouter = True # Mark that content was received
-                buffer += delta.content
-                start_marker = "[[CHARTJS_CONFIG_START]]"
-                end_marker = "[[CHARTJS_CONFIG_END]]"
-
-                if not in_chart_config_block and start_marker in buffer:
-                    pre_block_content = buffer.split(start_marker, 1)[0]
-                    if pre_block_content:
-                        yield f"data: {json.dumps({'chunk': pre_block_content})}\n\n"
-                    buffer = buffer.split(start_marker, 1)[1]
-                    in_chart_config_block = True
+                content = delta.content
+                # Most responses never contain a chart; stay off the marker scan until a '[' shows up
+                if not chart_possible and '[' in content:
+                    chart_possible = True
+                buffer += content
+
+                # Cheap rejects before scanning: the marker can't fit or has no opening bracket
+                if chart_possible and not in_chart_config_block and len(buffer) >= CHART_START_MARKER_LEN and '[' in buffer:
+                    marker_idx = buffer.find(CHART_START_MARKER)
+                    if marker_idx != -1:
+                        pre_block_content = buffer[:marker_idx]
+                        if pre_block_content:
+                            yield chunk_frame(pre_block_content)
+                        buffer = buffer[marker_idx + CHART_START_MARKER_LEN:]
+                        in_chart_config_block = True
                 
                 if in_chart_config_block:
-                    if end_marker in buffer:
-                        block_content, post_block_content = buffer.split(end_marker, 1)
-                        chart_config_str += block_content
+                    marker_idx = buffer.find(CHART_END_MARKER)
+                    if marker_idx != -1:
+                        chart_config_parts.append(buffer[:marker_idx])
+                        chart_config_str = "".join(chart_config_parts)
+                        post_block_content = buffer[marker_idx + CHART_END_MARKER_LEN:]
                         try:
-                            chart_json = json.loads(chart_config_str)
-                            yield f"data: {json.dumps({'chart_config': chart_json})}\n\n"
+                            chart_json = json_loads(chart_config_str)
+                            yield sse_event({'chart_config': chart_json})
                         except json.JSONDecodeError as e:
-                            print(f"Error decoding chart_js config from OpenRouter: {e} - data: {chart_config_str}")
-                            data_to_yield = {'chunk': start_marker + chart_config_str + end_marker}
-                            yield f"data: {json.dumps(data_to_yield)}\n\n"
+                            logger.warning("Error decoding chart_js config from OpenRouter: %s - data: %s", e, chart_config_str)
+                            yield chunk_frame(CHART_START_MARKER + chart_config_str + CHART_END_MARKER)
                         
                         buffer = post_block_content
                         in_chart_config_block = False
-                        chart_config_str = ""
+                        chart_config_parts = []
                     else:
-                        chart_config_str += buffer
+                        chart_config_parts.append(buffer)
                         buffer = ""
                 
                 if not in_chart_config_block and buffer:
                     if "\n" in buffer or len(buffer) > 80:
-                        yield f"data: {json.dumps({'chunk': buffer})}\n\n"
+                        yield chunk_frame(buffer)
                         buffer = ""
             
-            # Extract sources from Perplexity models - try multiple approaches
-            if hasattr(chunk.choices[0], 'message'):
-                message = chunk.choices[0].message
-                
-                # Check message metadata
-                if hasattr(message, 'metadata') and message.metadata:
-                    if 'sources' in message.metadata:
-                        perplexity_sources = message.metadata['sources']
-                    elif 'citations' in message.metadata:
-                        perplexity_sources = message.metadata['citations']
-                
-                # Check message content for source information
-                if hasattr(message, 'content') and message.content:
-                    # Try to extract sources from content if available
-                    pass
-            
-            # Check for sources in delta metadata
-            if hasattr(delta, 'metadata') and delta.metadata:
-                if 'sources' in delta.metadata:
-                    perplexity_sources = delta.metadata['sources']
-                elif 'citations' in delta.metadata:
-                    perplexity_sources = delta.metadata['citations']
-            
-            # Check for sources in chunk metadata
-            if hasattr(chunk, 'metadata') and chunk.metadata:
-                if 'sources' in chunk.metadata:
-                    perplexity_sources = chunk.metadata['sources']
-                elif 'citations' in chunk.metadata:
-                    perplexity_sources = chunk.metadata['citations']
+            # Extract sources from Perplexity models - other models never carry them
+            if is_perplexity:
+                perplexity_sources = extract_perplexity_sources(chunk) or perplexity_sources
+
+        reasoning_batch = reasoning_coalescer.flush()
+        if reasoning_batch:
+            yield sse_event({'reasoning': reasoning_batch})
 
         if buffer: 
             if in_chart_config_block: # Means block was not properly terminated
-                 data_to_yield = {'chunk': start_marker + chart_config_str + buffer} # yield as text
-                 yield f"data: {json.dumps(data_to_yield)}\n\n"
+                 yield chunk_frame(CHART_START_MARKER + "".join(chart_config_parts) + buffer) # yield as text
             else:
-                 yield f"data: {json.dumps({'chunk': buffer})}\n\n"
+                 yield chunk_frame(buffer)
 
         if not content_received_from_openrouter:
-            print(f"Warning: OpenRouter stream for {actual_model_name_for_sdk} finished without yielding any content chunks.")
+            logger.warning("OpenRouter stream for %s finished without yielding any content chunks.", actual_model_name_for_sdk)
 
         # Perplexity citation processing removed
 
-        yield f"data: {json.dumps({'end_of_stream': True})}\n\n"
+        yield END_OF_STREAM_FRAME
     except openai.APIError as e:
-        print(f"OpenRouter API error (streaming for {model_name_with_suffix}): {e.status_code if hasattr(e, 'status_code') else 'N/A'} - {e}")
+        logger.error("OpenRouter API error (streaming for %s): %s - %s", model_name_with_suffix, getattr(e, 'status_code', 'N/A'), e)
         error_payload = {
             'message': str(e), # Default message
             'code': e.status_code if hasattr(e, 'status_code') else None
@@ -991,17 +1491,16 @@ def stream_openrouter(query, model_name_with_suffix, reasoning_config=None, uplo
                         if 'metadata' in error_detail:
                             error_payload['metadata'] = error_detail['metadata']
                 except json.JSONDecodeError:
-                    print("Could not parse e.response.text as JSON for detailed error.")
+                    logger.debug("Could not parse e.response.text as JSON for detailed error.")
 
         except Exception as parsing_exc:
-            print(f"Exception while parsing APIError details: {parsing_exc}")
+            logger.warning("Exception while parsing APIError details: %s", parsing_exc)
             # Stick with the basic error_payload if parsing fails
 
-        yield f"data: {json.dumps({'error': error_payload})}\n\n"
+        yield sse_event({'error': error_payload})
     except Exception as e:
-        print(f"Error during OpenRouter stream for {model_name_with_suffix}: {e}")
-        traceback.print_exc()
-        yield f"data: {json.dumps({'error': 'An unexpected error occurred during the OpenRouter stream.'})}\n\n"
+        logger.exception("Error during OpenRouter stream for %s", model_name_with_suffix)
+        yield error_frame('An unexpected error occurred during the OpenRouter stream.')
 
 # --- Routes --- 
 @app.route('/')
@@ -1012,7 +1511,7 @@ def index():
 @app.route('/search', methods=['POST'])
 def search():
     """Handles the search query, routing to OpenRouter or direct OpenAI for images."""
-    print("--- Request received at /search endpoint ---")
+    logger.debug("--- Request received at /search endpoint ---")
     query = request.json.get('query')
     selected_model = request.json.get('model')
     uploaded_file_data = request.json.get('uploaded_file_data')
@@ -1031,31 +1530,31 @@ def search():
         default_model_for_error = "gpt-image-1"
 
     if not selected_model or selected_model not in ALLOWED_MODELS:
-        print(f"Warning: Invalid or missing model '{selected_model}'. Defaulting to {default_model_for_error}.")
+        logger.warning("Invalid or missing model '%s'. Defaulting to %s.", selected_model, default_model_for_error)
         selected_model = default_model_for_error
     
     missing_keys = check_api_keys(selected_model)
     if missing_keys:
         key_str = " and ".join(missing_keys)
-        print(f"Error: Missing API Key(s) {key_str} for model {selected_model}")
+        logger.error("Missing API Key(s) %s for model %s", key_str, selected_model)
         return jsonify({'error': f'Missing API key(s) in .env file for model {selected_model}: {key_str}'}), 500
 
-    print(f"Received query: {query}, Model: {selected_model}")
+    logger.info("Received query: %s, Model: %s", query, selected_model)
 
     if selected_model == "gpt-image-1":
         if uploaded_file_data and file_type == 'image':
-            print(f"Routing to OpenAI Image Edit. Query: '{query}'")
+            logger.debug("Routing to OpenAI Image Edit. Query: '%s'", query)
             return edit_image(query, uploaded_file_data)
         else:
-            print(f"Routing to OpenAI Image Generation. Query: '{query}'")
+            logger.debug("Routing to OpenAI Image Generation. Query: '%s'", query)
             return generate_image(query)
     elif selected_model in OPENROUTER_MODELS:
-        print_query = query[:100] + "..." if query and len(query) > 100 else query
-        print_file_data = ""
-        if uploaded_file_data:
-            print_file_data = f", FileType: {file_type}, FileData (starts with): {uploaded_file_data[:50]}..."
-        
-        print(f"Routing to OpenRouter. Query: '{print_query}'{print_file_data}, Model: {selected_model}")
+        if logger.isEnabledFor(logging.DEBUG):
+            print_query = query[:100] + "..." if query and len(query) > 100 else query
+            print_file_data = ""
+            if uploaded_file_data:
+                print_file_data = f", FileType: {file_type}, FileData (starts with): {uploaded_file_data[:50]}..."
+            logger.debug("Routing to OpenRouter. Query: '%s'%s, Model: %s", print_query, print_file_data, selected_model)
 
         generator = stream_openrouter(
             query, 
@@ -1065,20 +1564,20 @@ def search():
             file_type=file_type,
             web_search_enabled=web_search_enabled
         )
-        return Response(generator, mimetype='text/event-stream')
+        return Response(generator, mimetype='text/event-stream', direct_passthrough=True)
     else:
-        print(f"Error: Model '{selected_model}' is in ALLOWED_MODELS but not recognized for routing logic.")
+        logger.error("Model '%s' is in ALLOWED_MODELS but not recognized for routing logic.", selected_model)
         return jsonify({'error': f"Model '{selected_model}' is not configured correctly for use."}), 500
 
 # --- Image Generation Function ---
 def generate_image(query):
     """Generates an image using OpenAI and returns base64 data or error."""
-    print("--- Entering generate_image function ---")
+    logger.debug("--- Entering generate_image function ---")
     if not openai_client: 
-         print("ERROR: generate_image - Direct OpenAI client not initialized.")
+         logger.error("generate_image - Direct OpenAI client not initialized.")
          return jsonify({'error': 'OpenAI client not initialized. Check direct OpenAI API key.'}), 500
 
-    print(f"Generating image with prompt: {query[:100]}...")
+    logger.debug("Generating image with prompt: %.100s...", query)
     try:
         result = openai_client.images.generate(
             model="gpt-image-1",
@@ -1089,14 +1588,14 @@ def generate_image(query):
         
         if result.data and result.data[0].b64_json:
             image_base64 = result.data[0].b64_json
-            print("SUCCESS: generate_image - Image generated, returning JSON (b64_json expected).")
+            logger.info("generate_image - Image generated, returning JSON (b64_json expected).")
             return jsonify({'image_base64': image_base64})
         else:
-            print("ERROR: generate_image - No b64_json data received from OpenAI.")
+            logger.error("generate_image - No b64_json data received from OpenAI.")
             return jsonify({'error': 'No b64_json data received from OpenAI API.'}), 500
 
     except openai.APIError as e:
-        print(f"ERROR: generate_image - OpenAI APIError caught: {e}")
+        logger.error("generate_image - OpenAI APIError caught: %s", e)
         err_msg = "An API error occurred."
         status_code = 500
         if hasattr(e, 'status_code') and e.status_code:
@@ -1113,7 +1612,7 @@ def generate_image(query):
             elif hasattr(e, 'message') and e.message:
                 err_msg = e.message
         except Exception as parsing_exc:
-            print(f"Exception while parsing APIError details for generate_image: {parsing_exc}")
+            logger.warning("Exception while parsing APIError details for generate_image: %s", parsing_exc)
         
         # Ensure err_msg is a string before checking substrings
         if not isinstance(err_msg, str):
@@ -1126,38 +1625,38 @@ def generate_image(query):
         
         return jsonify({'error': f'OpenAI API error during image generation: {err_msg}'}), status_code
     except Exception as e:
-        print(f"ERROR: generate_image - Unexpected Exception caught: {e}")
-        traceback.print_exc()
+        logger.exception("generate_image - Unexpected Exception caught")
         # Ensure a JSON response even for unexpected errors
         return jsonify({'error': 'An internal server error occurred during image generation. Please check server logs.'}), 500
 
 # --- Image Editing Function ---
+PNG_DATA_URL_PREFIX = "data:image/png;base64,"
+
 def edit_image(prompt, image_data_url):
     """Edits an image using OpenAI and returns base64 data or error."""
-    print(f"--- Entering edit_image function. Prompt: {prompt[:100]}... ---")
+    logger.debug("--- Entering edit_image function. Prompt: %.100s... ---", prompt)
     if not openai_client:
-        print("ERROR: edit_image - Direct OpenAI client not initialized.")
+        logger.error("edit_image - Direct OpenAI client not initialized.")
         return jsonify({'error': 'OpenAI client not initialized. Check direct OpenAI API key.'}), 500
 
     try:
         # Decode the base64 image data URL
         # Format: "data:image/png;base64,iVBORw0KGgo..."
         # For images.edit, OpenAI API requires a valid PNG file.
-        if not image_data_url.startswith("data:image/png;base64,"):
-            print("ERROR: edit_image - Invalid image data URL format. Must be a PNG base64 data URL for editing.")
+        if not image_data_url.startswith(PNG_DATA_URL_PREFIX):
+            logger.warning("edit_image - Invalid image data URL format. Must be a PNG base64 data URL for editing.")
             return jsonify({'error': 'Invalid image format for editing. Please upload a PNG image.'}), 400
         
-        header, encoded_data = image_data_url.split(',', 1)
-        image_bytes = base64.b64decode(encoded_data)
+        # Decode straight from the payload offset instead of splitting the multi-MB string
+        image_bytes = base64.b64decode(image_data_url[len(PNG_DATA_URL_PREFIX):])
         
-        # Use io.BytesIO to treat the bytes as a file
-        image_file_like = io.BytesIO(image_bytes)
-        image_file_like.name = "uploaded_image.png" # API might need a filename
+        # (filename, bytes, content type) upload tuple - no file-like wrapper needed
+        image_file = ("uploaded_image.png", image_bytes, "image/png") # API might need a filename
 
-        print(f"Editing image with gpt-image-1. Prompt: {prompt[:100]}..., Image size: {len(image_bytes)} bytes")
+        logger.debug("Editing image with gpt-image-1. Prompt: %.100s..., Image size: %d bytes", prompt, len(image_bytes))
         
         result = openai_client.images.edit(
-            image=image_file_like,
+            image=image_file,
             # mask= can be added here if we implement mask uploads
             prompt=prompt,
             model="gpt-image-1", # Explicitly use gpt-image-1
@@ -1167,21 +1666,21 @@ def edit_image(prompt, image_data_url):
 
         if result.data and result.data[0].b64_json:
             edited_image_base64 = result.data[0].b64_json
-            print("SUCCESS: edit_image - Image edited, returning JSON (b64_json expected).")
+            logger.info("edit_image - Image edited, returning JSON (b64_json expected).")
             # The response is b64_json, so it's already base64 encoded.
             return jsonify({'image_base64': edited_image_base64, 'is_edit': True}) 
         elif result.data and result.data[0].url:
             # Sometimes the API might return a URL instead, though b64_json is preferred for this flow
-            print(f"WARNING: edit_image - Image edited, but received URL: {result.data[0].url}. This app expects b64_json for direct display.")
+            logger.warning("edit_image - Image edited, but received URL: %s. This app expects b64_json for direct display.", result.data[0].url)
             # For simplicity, we'll ask the user to try again or indicate we can't load from URL directly in this flow.
             # Ideally, we'd fetch the URL and convert to base64, but that adds complexity and another request.
             return jsonify({'error': 'Image edited, but received a URL. Please try again or contact support if this persists. This version expects base64 data.'}), 500
         else:
-            print("ERROR: edit_image - No b64_json or URL data received from OpenAI edit API.")
+            logger.error("edit_image - No b64_json or URL data received from OpenAI edit API.")
             return jsonify({'error': 'No image data received from OpenAI API after edit.'}), 500
 
     except openai.APIError as e:
-        print(f"ERROR: edit_image - OpenAI APIError caught: {e}")
+        logger.error("edit_image - OpenAI APIError caught: %s", e)
         err_msg = "An API error occurred."
         status_code = 500
         if hasattr(e, 'status_code') and e.status_code:
@@ -1198,7 +1697,7 @@ def edit_image(prompt, image_data_url):
             elif hasattr(e, 'message') and e.message:
                 err_msg = e.message
         except Exception as parsing_exc:
-            print(f"Exception while parsing APIError details for edit_image: {parsing_exc}")
+            logger.warning("Exception while parsing APIError details for edit_image: %s", parsing_exc)
         
         # Ensure err_msg is a string before checking substrings
         if not isinstance(err_msg, str):
@@ -1211,31 +1710,81 @@ def edit_image(prompt, image_data_url):
         
         return jsonify({'error': f'OpenAI API error during image edit: {err_msg}'}), status_code
     except Exception as e:
-        print(f"ERROR: edit_image - Unexpected Exception caught: {e}")
-        traceback.print_exc()
+        logger.exception("edit_image - Unexpected Exception caught")
         # Ensure a JSON response even for unexpected errors
         return jsonify({'error': 'An internal server error occurred during image editing. Please check server logs.'}), 500
 
 # --- Agentic Tools Definition ---
 def get_current_time():
     """Get the current date and time."""
-    from datetime import datetime
     return {"current_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
+MATH_EXPRESSION_RE = re.compile(r'^[0-9+\-*/().\s]+$')
+MATH_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Pow: operator.pow,
+}
+MATH_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+MATH_MAX_EXPONENT = 1000  # Keeps "9**9**9" style inputs from pinning a worker
+# Integer size cap for every intermediate and final value (~3900 digits), which also
+# stays under Python's 4300-digit int-to-str limit used when the result is serialized
+MATH_MAX_INT_BITS = 13000
+
+def check_math_int_size(value):
+    """Raise ValueError if value is an integer wider than MATH_MAX_INT_BITS."""
+    if isinstance(value, int) and value.bit_length() > MATH_MAX_INT_BITS:
+        raise ValueError("Result too large")
+    return value
+
+def evaluate_math_node(node):
+    """Evaluate an arithmetic AST node without going through eval()."""
+    if isinstance(node, ast.Expression):
+        return evaluate_math_node(node.body)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return check_math_int_size(node.value)
+    if isinstance(node, ast.BinOp) and type(node.op) in MATH_BINARY_OPERATORS:
+        left = evaluate_math_node(node.left)
+        right = evaluate_math_node(node.right)
+        # Estimate integer result sizes before computing them
+        if isinstance(node.op, ast.Pow):
+            if abs(right) > MATH_MAX_EXPONENT:
+                raise ValueError(f"Exponent too large (max {MATH_MAX_EXPONENT})")
+            if isinstance(left, int) and isinstance(right, int) and right * max(1, abs(left).bit_length()) > MATH_MAX_INT_BITS:
+                raise ValueError("Result too large")
+        elif isinstance(node.op, ast.Mult) and isinstance(left, int) and isinstance(right, int):
+            if abs(left).bit_length() + abs(right).bit_length() > MATH_MAX_INT_BITS + 1:
+                raise ValueError("Result too large")
+        return check_math_int_size(MATH_BINARY_OPERATORS[type(node.op)](left, right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in MATH_UNARY_OPERATORS:
+        return MATH_UNARY_OPERATORS[type(node.op)](evaluate_math_node(node.operand))
+    raise ValueError("Unsupported expression")
+
 def calculate_math(expression):
     """Safely evaluate a mathematical expression."""
-    import re
     # Only allow safe mathematical operations
-    if re.match(r'^[0-9+\-*/().\s]+$', expression):
+    if MATH_EXPRESSION_RE.match(expression):
         try:
-            result = eval(expression)
+            result = evaluate_math_node(ast.parse(expression, mode="eval"))
             return {"result": result, "expression": expression}
         except Exception as e:
             return {"error": f"Math calculation failed: {str(e)}"}
     else:
         return {"error": "Invalid mathematical expression. Only numbers and basic operators allowed."}
 
-def search_web_tool(query, max_results=8, search_type="auto"):
+# Keyword sets for search_web_tool's automatic search type detection
+NEWS_SEARCH_KEYWORDS = frozenset(['news', 'latest', 'recent', 'today', 'current', 'breaking', 'update', 'updates'])
+GENERAL_SEARCH_KEYWORDS = frozenset(['tutorial', 'tutorials', 'guide', 'guides', 'learn', 'course', 'courses', 'documentation'])
+GENERAL_SEARCH_PHRASES = ('how to',)
+DEEP_SEARCH_KEYWORDS = frozenset(['research', 'analysis', 'detailed', 'comprehensive', 'study', 'studies'])
+
+def search_web_tool(query: str, max_results: int = 8, search_type: str = "auto") -> Dict[str, Any]:
     """
     Enhanced web search using Tavily API - tool wrapper with intelligent search strategies.
     
@@ -1246,25 +1795,43 @@ def search_web_tool(query, max_results=8, search_type="auto"):
     """
     # Intelligent search type detection if auto
     if search_type == "auto":
-        query_lower = query.lower()
-        if any(word in query_lower for word in ['news', 'latest', 'recent', 'today', 'current', 'breaking', 'update']):
+        words = query_words(query)
+        if words & NEWS_SEARCH_KEYWORDS:
             search_type = "news"
-        elif any(word in query_lower for word in ['tutorial', 'guide', 'how to', 'learn', 'course', 'documentation']):
+        elif words & GENERAL_SEARCH_KEYWORDS or any(phrase in query.lower() for phrase in GENERAL_SEARCH_PHRASES):
             search_type = "general"
-        elif any(word in query_lower for word in ['research', 'analysis', 'detailed', 'comprehensive', 'study']):
+        elif words & DEEP_SEARCH_KEYWORDS:
             search_type = "deep"
         else:
             search_type = "general"
     
-    print(f"Web search: '{query}' (type: {search_type})")
+    cache_key = make_cache_key("search_web_tool", query.lower().strip(), search_type, max_results)
+    cached = SEARCH_CACHE.get_with_meta(cache_key)
+    if cached is not None:
+        cached_result, cached_at, ttl = cached
+        logger.debug("Web search cache hit: %r (type: %s)", query, search_type)
+        if should_refresh(cached_at, ttl):
+            schedule_search_refresh(cache_key, query, max_results, search_type)
+        return cached_result
+    
+    return fetch_search_results(query, max_results, search_type, cache_key)
+
+def fetch_search_results(query: str, max_results: int, search_type: str, cache_key: str, fresh: bool = False) -> Dict[str, Any]:
+    """
+    Run the Tavily search for search_web_tool and cache the simplified result.
+    Raw Tavily responses older than this result's TTL are not reused; fresh=True skips them entirely.
+    """
+    logger.debug("Web search: %r (type: %s)", query, search_type)
+    ttl = compute_ttl(query, search_type)
+    max_age = 0 if fresh else ttl
     
     # Adjust search parameters based on type
     if search_type == "news":
-        result = search_web_tavily(query, max_results=max_results)
+        result = search_web_tavily(query, max_results=max_results, max_age=max_age)
     elif search_type == "deep":
-        result = search_web_tavily(query, max_results=min(max_results * 2, 15))  # Get more results for deep search
+        result = search_web_tavily(query, max_results=min(max_results * 2, 15), max_age=max_age)  # Get more results for deep search
     else:
-        result = search_web_tavily(query, max_results=max_results)
+        result = search_web_tavily(query, max_results=max_results, max_age=max_age)
     
     if "error" in result:
         return {"error": result["error"], "search_type": search_type}
@@ -1275,6 +1842,8 @@ def search_web_tool(query, max_results=8, search_type="auto"):
     
     # Process more results but with better filtering
     results_to_process = result.get("results", [])[:max_results]
+    # For deep search, provide more content but still manageable
+    preview_limit = 400 if search_type == "deep" else 250
     
     for i, item in enumerate(results_to_process):
         title = item.get("title", "").strip()
@@ -1283,14 +1852,7 @@ def search_web_tool(query, max_results=8, search_type="auto"):
         domain = item.get("domain", "unknown")
         quality_score = item.get("quality_score", 0)
         
-        # For deep search, provide more content but still manageable
-        if search_type == "deep":
-            content_preview = content[:400] + "..." if len(content) > 400 else content
-        else:
-            content_preview = content[:250] + "..." if len(content) > 250 else content
-        
-        # Quality indicator
-        quality_level = "HIGH" if quality_score > 200 else "MEDIUM" if quality_score > 100 else "STANDARD"
+        content_preview = clip_text(content, preview_limit)
         
         simplified_results.append({
             "rank": i + 1,
@@ -1298,7 +1860,7 @@ def search_web_tool(query, max_results=8, search_type="auto"):
             "url": url,
             "content": content_preview,
             "domain": domain,
-            "quality": quality_level,
+            "quality": get_quality_level(quality_score),
             "relevance_score": quality_score
         })
         
@@ -1306,8 +1868,9 @@ def search_web_tool(query, max_results=8, search_type="auto"):
     
     # Enhanced metadata
     search_metadata = result.get("search_metadata", {})
+    quality_counts = Counter(s["quality"] for s in simplified_results)
     
-    return {
+    tool_result = {
         "success": True,
         "query": query,
         "search_type": search_type,
@@ -1323,32 +1886,56 @@ def search_web_tool(query, max_results=8, search_type="auto"):
             "unique_domains": search_metadata.get("unique_domains", 0)
         },
         "quality_distribution": {
-            "high": len([s for s in simplified_results if s["quality"] == "HIGH"]),
-            "medium": len([s for s in simplified_results if s["quality"] == "MEDIUM"]),
-            "standard": len([s for s in simplified_results if s["quality"] == "STANDARD"])
+            "high": quality_counts["HIGH"],
+            "medium": quality_counts["MEDIUM"],
+            "standard": quality_counts["STANDARD"]
         }
     }
+    SEARCH_CACHE.set(cache_key, tool_result, ttl=ttl)
+    return tool_result
+
+def schedule_search_refresh(cache_key, query, max_results, search_type):
+    """Repopulate a hot cache entry in the background before it expires."""
+    with SEARCH_REFRESH_LOCK:
+        if cache_key in SEARCH_REFRESH_IN_FLIGHT:
+            return
+        SEARCH_REFRESH_IN_FLIGHT.add(cache_key)
+    
+    def refresh():
+        try:
+            # Bypass the raw Tavily cache, which may still hold the response being refreshed
+            fetch_search_results(query, max_results, search_type, cache_key, fresh=True)
+        except Exception as e:
+            logger.warning("Background refresh failed for %r: %s", query, e)
+        finally:
+            with SEARCH_REFRESH_LOCK:
+                SEARCH_REFRESH_IN_FLIGHT.discard(cache_key)
+    
+    SEARCH_REFRESH_EXECUTOR.submit(refresh)
+
+NOTES_DIR = tempfile.gettempdir()  # Notes are written to the temp directory for safety
+# Deletes every Latin-1 character that is not alphanumeric or one of "._-"
+NOTE_FILENAME_TRANSLATION = str.maketrans("", "", "".join(
+    c for c in map(chr, range(256)) if not (c.isalnum() or c in "._-")
+))
 
 def create_note(content, filename=None):
     """Create a simple text note file."""
-    import os
-    import tempfile
-    from datetime import datetime
-    
     # Create a safe filename
     if not filename:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"note_{timestamp}.txt"
     
     # Sanitize filename
-    filename = "".join(c for c in filename if c.isalnum() or c in "._-")
+    if filename.isascii():
+        filename = filename.translate(NOTE_FILENAME_TRANSLATION)
+    else:
+        filename = "".join(c for c in filename if c.isalnum() or c in "._-")
     if not filename.endswith('.txt'):
         filename += '.txt'
     
     try:
-        # Create in a temporary directory for safety
-        temp_dir = tempfile.gettempdir()
-        filepath = os.path.join(temp_dir, filename)
+        filepath = os.path.join(NOTES_DIR, filename)
         
         with open(filepath, 'w', encoding='utf-8') as f:
             f.write(content)
@@ -1362,6 +1949,38 @@ def create_note(content, filename=None):
     except Exception as e:
         return {"error": f"Failed to create note: {str(e)}"}
 
+# A single combined search replaces the three comprehensive-research searches
+# when it already yields this many high-quality sources
+COMBINED_RESEARCH_MAX_RESULTS = 15
+COMBINED_RESEARCH_MIN_HIGH_QUALITY = 8
+
+# Title/URL wording used to split a combined search's sources into research areas
+RESEARCH_NEWS_WORDS = frozenset([
+    "news", "latest", "update", "updates", "announces", "announced", "announcement",
+    "breaking", "today", "release", "released", "launch", "launches"
+])
+RESEARCH_ANALYSIS_WORDS = frozenset([
+    "analysis", "analyses", "analyzing", "research", "study", "studies", "report", "reports",
+    "paper", "papers", "journal", "review", "survey", "evaluation", "pdf"
+])
+RESEARCH_ANALYSIS_DOMAIN_SUFFIXES = (".edu", ".gov", "arxiv.org", "nature.com", "sciencedirect.com")
+
+def partition_research_sources(sources):
+    """
+    Split combined-search sources into the overview/news/analysis areas that the separate
+    research searches would have covered, using title/URL wording and the source domain.
+    """
+    buckets = {"overview": [], "news": [], "analysis": []}
+    for source in sources:
+        words = query_words(f"{source.get('title', '')} {source.get('url', '')}")
+        if words & RESEARCH_NEWS_WORDS:
+            buckets["news"].append(source)
+        elif words & RESEARCH_ANALYSIS_WORDS or source.get("domain", "").endswith(RESEARCH_ANALYSIS_DOMAIN_SUFFIXES):
+            buckets["analysis"].append(source)
+        else:
+            buckets["overview"].append(source)
+    return buckets
+
 def research_topic(topic, research_depth="comprehensive"):
     """
     Perform comprehensive research on a topic using multiple search strategies.
@@ -1370,7 +1989,13 @@ def research_topic(topic, research_depth="comprehensive"):
         topic: The topic to research
         research_depth: "quick", "standard", or "comprehensive"
     """
-    print(f"Starting comprehensive research on: {topic} (depth: {research_depth})")
+    cache_key = make_cache_key("research_topic", topic.lower().strip(), research_depth)
+    cached_result = SEARCH_CACHE.get(cache_key)
+    if cached_result is not None:
+        logger.debug("Research cache hit: %r (depth: %s)", topic, research_depth)
+        return cached_result
+    
+    logger.debug("Starting research on: %r (depth: %s)", topic, research_depth)
     
     research_results = {
         "topic": topic,
@@ -1381,50 +2006,55 @@ def research_topic(topic, research_depth="comprehensive"):
         "summary": ""
     }
     
+    def record_step(step_type, label, query, step_result):
+        """Merge one successful search into the research results."""
+        research_results["searches_performed"].append({
+            "type": step_type,
+            "query": query,
+            "results_count": step_result.get("returned_count", 0)
+        })
+        research_results["all_sources"].extend(step_result.get("sources", []))
+        if step_result.get("quick_answer"):
+            research_results["key_findings"].append(f"{label}: {step_result['quick_answer']}")
+    
     try:
-        # Step 1: General overview search
-        overview_query = f"{topic} overview explanation"
-        overview_result = search_web_tool(overview_query, max_results=5, search_type="general")
-        
-        if overview_result.get("success"):
-            research_results["searches_performed"].append({
-                "type": "overview",
-                "query": overview_query,
-                "results_count": overview_result.get("returned_count", 0)
-            })
-            research_results["all_sources"].extend(overview_result.get("sources", []))
-            if overview_result.get("quick_answer"):
-                research_results["key_findings"].append(f"Overview: {overview_result['quick_answer']}")
-        
-        # Step 2: Recent news/updates if comprehensive
+        # Overview always; recent news for standard+; deep analysis for comprehensive
+        searches = [("overview", "Overview", f"{topic} overview explanation", "general", 5)]
         if research_depth in ["standard", "comprehensive"]:
-            news_query = f"{topic} latest news updates 2024"
-            news_result = search_web_tool(news_query, max_results=4, search_type="news")
-            
-            if news_result.get("success"):
-                research_results["searches_performed"].append({
-                    "type": "news",
-                    "query": news_query,
-                    "results_count": news_result.get("returned_count", 0)
-                })
-                research_results["all_sources"].extend(news_result.get("sources", []))
-                if news_result.get("quick_answer"):
-                    research_results["key_findings"].append(f"Recent Updates: {news_result['quick_answer']}")
-        
-        # Step 3: Deep analysis if comprehensive
+            searches.append(("news", "Recent Updates", f"{topic} latest news updates 2024", "news", 4))
         if research_depth == "comprehensive":
-            analysis_query = f"{topic} detailed analysis research study"
-            analysis_result = search_web_tool(analysis_query, max_results=6, search_type="deep")
+            searches.append(("analysis", "Detailed Analysis", f"{topic} detailed analysis research study", "deep", 6))
             
-            if analysis_result.get("success"):
-                research_results["searches_performed"].append({
-                    "type": "analysis",
-                    "query": analysis_query,
-                    "results_count": analysis_result.get("returned_count", 0)
-                })
-                research_results["all_sources"].extend(analysis_result.get("sources", []))
-                if analysis_result.get("quick_answer"):
-                    research_results["key_findings"].append(f"Detailed Analysis: {analysis_result['quick_answer']}")
+            # Try to cover all three angles with one advanced search first; the query avoids
+            # news wording so Tavily does not narrow it to a one-week news window
+            combined_query = f"{topic} overview, 2024 developments and in-depth analysis"
+            combined_result = search_web_tool(combined_query, max_results=COMBINED_RESEARCH_MAX_RESULTS, search_type="deep")
+            if combined_result.get("success") and combined_result["quality_distribution"]["high"] >= COMBINED_RESEARCH_MIN_HIGH_QUALITY:
+                # Report the sources under the areas the separate searches would have covered
+                buckets = partition_research_sources(combined_result["sources"])
+                for step_type, label, _, _, _ in searches:
+                    if buckets[step_type]:
+                        record_step(step_type, label, combined_query, {
+                            "returned_count": len(buckets[step_type]),
+                            "sources": buckets[step_type]
+                        })
+                if combined_result.get("quick_answer"):
+                    research_results["key_findings"].append(f"Combined Research: {combined_result['quick_answer']}")
+                searches = []
+            else:
+                logger.info("Combined research search too thin for %r, falling back to separate searches", topic)
+        
+        # The searches are independent network round trips, so run them concurrently
+        futures = [
+            SEARCH_EXECUTOR.submit(search_web_tool, query, max_results=max_results, search_type=search_type)
+            for _, _, query, search_type, max_results in searches
+        ]
+        
+        # Merge in submission order so sources and findings keep a stable ordering
+        for (step_type, label, query, _, _), future in zip(searches, futures):
+            step_result = future.result()
+            if step_result.get("success"):
+                record_step(step_type, label, query, step_result)
         
         # Generate summary
         total_sources = len(research_results["all_sources"])
@@ -1432,6 +2062,9 @@ def research_topic(topic, research_depth="comprehensive"):
         
         research_results["summary"] = f"Completed {research_depth} research on '{topic}' using {len(research_results['searches_performed'])} search strategies. Found {total_sources} total sources ({high_quality_sources} high-quality). Key areas covered: {', '.join([s['type'] for s in research_results['searches_performed']])}"
         
+        # Research that includes the news step goes stale as fast as news searches
+        research_ttl = compute_ttl(topic, "general" if research_depth == "quick" else "news")
+        SEARCH_CACHE.set(cache_key, research_results, ttl=research_ttl)
         return research_results
         
     except Exception as e:
@@ -1441,18 +2074,316 @@ def research_topic(topic, research_depth="comprehensive"):
             "partial_results": research_results
         }
 
-# Tool definitions for OpenRouter function calling
-AGENTIC_TOOLS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_current_time",
-            "description": "Get the current date and time",
-            "parameters": {
-                "type": "object",
-                "properties": {},
-                "required": []
-            }
+def advanced_research_with_synthesis(topic, research_depth="comprehensive", focus_areas=None):
+    """
+    Advanced research tool that demonstrates tool chaining and context preservation.
+    Implements 2024 best practices for multi-step agentic workflows.
+    """
+    try:
+        if focus_areas is None:
+            focus_areas = ["overview", "recent_developments", "practical_applications"]
+        
+        research_results = {
+            "topic": topic,
+            "research_depth": research_depth,
+            "focus_areas": focus_areas,
+            "findings": {},
+            "synthesis": "",
+            "quality_metrics": {},
+            "timestamp": get_current_time()["current_time"]
+        }
+        
+        # Step 1: Multi-angle information gathering, one concurrent search per focus area
+        area_futures = []
+        for area in focus_areas:
+            search_query = f"{topic} {area.replace('_', ' ')}"
+            
+            # Use different search strategies for different focus areas
+            if area == "recent_developments":
+                search_type = "news"
+            elif area == "practical_applications":
+                search_type = "general"
+            else:
+                search_type = "deep"
+            
+            area_futures.append((area, SEARCH_EXECUTOR.submit(search_web_tool, search_query, max_results=5, search_type=search_type)))
+        
+        # Chain tool calls with context preservation; findings keep focus_areas order
+        for area, future in area_futures:
+            research_results["findings"][area] = future.result()
+        
+        # Step 2: Quality assessment and synthesis
+        total_sources = sum(len(findings.get("results", [])) for findings in research_results["findings"].values())
+        high_quality_sources = 0
+        
+        for area, findings in research_results["findings"].items():
+            if "results" in findings:
+                high_quality_sources += len([r for r in findings["results"] if r.get("score", 0) > 0.7])
+        
+        research_results["quality_metrics"] = {
+            "total_sources": total_sources,
+            "high_quality_sources": high_quality_sources,
+            "quality_ratio": high_quality_sources / total_sources if total_sources > 0 else 0,
+            "coverage_areas": len(focus_areas)
+        }
+        
+        # Step 3: Intelligent synthesis
+        synthesis_points = []
+        for area, findings in research_results["findings"].items():
+            if "results" in findings and findings["results"]:
+                top_result = findings["results"][0]
+                synthesis_points.append(f"**{area.replace('_', ' ').title()}**: {top_result.get('content', 'No content available')[:200]}...")
+        
+        research_results["synthesis"] = "\n\n".join(synthesis_points)
+        
+        # Step 4: Generate actionable insights
+        if research_results["quality_metrics"]["quality_ratio"] > 0.6:
+            research_results["confidence_level"] = "High"
+            research_results["recommendations"] = f"Based on {high_quality_sources} high-quality sources, this research provides reliable insights on {topic}."
+        else:
+            research_results["confidence_level"] = "Moderate"
+            research_results["recommendations"] = f"Research completed with {total_sources} sources. Consider additional verification for critical decisions."
+        
+        return research_results
+        
+    except Exception as e:
+        return {"error": f"Advanced research failed: {str(e)}", "topic": topic}
+
+WEB_SEARCH_MODEL = "perplexity/sonar-reasoning-pro"
+WEB_SEARCH_CONTEXT_SIZES = frozenset(["low", "medium", "high"])
+WEB_SEARCH_MAX_CITATIONS = 10
+WEB_SEARCH_MAX_RETRIES = 4  # SDK retries 408/409/429/5xx and connection errors with jittered backoff
+
+# Repeated Perplexity searches within the hour are answered from memory
+WEB_SEARCH_CACHE = TTLCache(max_size=1024, default_ttl=3600)
+
+# Word characters of a query; punctuation and spacing don't change the search
+SEARCH_KEY_TOKEN_RE = re.compile(r"\w+")
+
+def normalize_search_query(query):
+    """
+    Cache key form of a query: lowercased, punctuation stripped, whitespace collapsed.
+    Word order is kept, since "usd to eur" and "eur to usd" are different searches.
+    """
+    return " ".join(SEARCH_KEY_TOKEN_RE.findall(query.lower()))
+
+# Markdown links embedded in web search answers: [title](url)
+# Bounded, newline/whitespace-free classes keep matching linear on long answers
+MARKDOWN_LINK_RE = re.compile(r'\[([^\[\]\n]{1,500})\]\((https?://[^\s)]{1,2000})\)')
+
+def extract_markdown_links(content):
+    """
+    Yield (title, url) for each markdown link in content.
+    Well-formed links are sliced out with str.find; anything unusual is checked with MARKDOWN_LINK_RE.
+    """
+    start = 0
+    while True:
+        i = content.find("](http", start)
+        if i < 0:
+            return
+        open_bracket = content.rfind("[", start, i)
+        close_paren = content.find(")", i + 2)
+        if open_bracket < 0 or close_paren < 0:
+            start = i + 2
+            continue
+        title = content[open_bracket + 1:i]
+        url = content[i + 2:close_paren]
+        if (0 < len(title) <= 500 and "]" not in title and "\n" not in title
+                and url.startswith(("http://", "https://")) and 8 < len(url) <= 2000
+                and not any(map(str.isspace, url))):
+            yield title, url
+            start = close_paren + 1
+            continue
+        match = MARKDOWN_LINK_RE.match(content, open_bracket)
+        if match:
+            yield match.group(1), match.group(2)
+            start = match.end()
+        else:
+            start = i + 2
+
+# Queries that are just a URL are answered by fetching the page instead of asking Perplexity
+URL_ONLY_RE = re.compile(r'^https?://\S+$')
+PAGE_FETCH_TIMEOUT = 10  # seconds
+PAGE_FETCH_MAX_BYTES = 1_000_000
+PAGE_TEXT_MAX_CHARS = 6000
+HTML_TITLE_RE = re.compile(r'<title[^>]*>(.*?)</title>', re.I | re.S)
+HTML_SKIP_RE = re.compile(r'<(script|style|noscript|svg)\b.*?</\1\s*>', re.I | re.S)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def resolve_public_address(host, port):
+    """
+    Resolve host and return one of its addresses, or None unless every address is public,
+    so model-chosen URLs can't reach internal services.
+    """
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    except (socket.gaierror, UnicodeError):
+        return None
+    if not addresses or not all(ipaddress.ip_address(address.split("%")[0]).is_global for address in addresses):
+        return None
+    return addresses[0]
+
+def fetch_page_directly(url):
+    """Fetch a public HTML page and return (title, text), or None to fall back to a web search."""
+    parsed = urlparse(url)
+    try:
+        host = (parsed.hostname or "").encode("idna").decode("ascii")
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except (UnicodeError, ValueError):  # non-encodable host or malformed port
+        return None
+    address = resolve_public_address(host, port) if host else None
+    if address is None:
+        return None
+    host_header = f"[{host}]" if ":" in host else host
+    if parsed.port:
+        host_header += f":{parsed.port}"
+    
+    # Connect to the address that was checked rather than resolving the name again, so a
+    # rebinding DNS answer can't swap in an internal host; Host and TLS SNI/certificate
+    # checks still use the original name
+    if parsed.scheme == "https":
+        pool = urllib3.HTTPSConnectionPool(address, port, server_hostname=host, assert_hostname=host,
+                                           cert_reqs="CERT_REQUIRED", ca_certs=DEFAULT_CA_BUNDLE_PATH,
+                                           timeout=PAGE_FETCH_TIMEOUT, retries=False, maxsize=1)
+    else:
+        pool = urllib3.HTTPConnectionPool(address, port, timeout=PAGE_FETCH_TIMEOUT, retries=False, maxsize=1)
+    path = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+    headers = {"Host": host_header, "User-Agent": "Mozilla/5.0 (compatible; CometSearch/1.0)"}
+    try:
+        # Redirects are not followed: their targets would bypass the address check
+        resp = pool.urlopen("GET", path, headers=headers, redirect=False, retries=False, preload_content=False)
+        try:
+            if resp.status != 200 or "html" not in resp.headers.get("Content-Type", ""):
+                return None
+            raw = resp.read(PAGE_FETCH_MAX_BYTES, decode_content=True)
+            html = raw.decode(get_encoding_from_headers(resp.headers) or "utf-8", errors="replace")
+        finally:
+            resp.release_conn()
+    except (urllib3.exceptions.HTTPError, LookupError):  # LookupError: unknown charset
+        return None
+    finally:
+        pool.close()
+    
+    title_match = HTML_TITLE_RE.search(html)
+    title = WHITESPACE_RE.sub(" ", title_match.group(1)).strip() if title_match else url
+    text = WHITESPACE_RE.sub(" ", HTML_TAG_RE.sub(" ", HTML_SKIP_RE.sub(" ", html))).strip()
+    if not text:
+        return None
+    return title or url, text[:PAGE_TEXT_MAX_CHARS]
+
+def search_web_openrouter(query, max_results=5, search_context_size="low"):
+    """
+    Enhanced web search using OpenRouter's native web search capability.
+    Uses models with built-in web search like Perplexity or web-enabled models.
+    """
+    # A bare URL needs its page, not a reasoning model's summary of search results
+    url_query = query.strip()
+    if URL_ONLY_RE.match(url_query):
+        page = fetch_page_directly(url_query)
+        if page is not None:
+            title, text = page
+            return {
+                "success": True,
+                "query": query,
+                "content": text,
+                "citations": [{"title": title, "url": url_query, "source": "direct_fetch"}]
+            }
+    
+    if not openrouter_api_key:
+        return {"error": "OpenRouter API key not configured"}
+    
+    # Tool arguments come from the model; fall back to the cheapest context size
+    if search_context_size not in WEB_SEARCH_CONTEXT_SIZES:
+        search_context_size = "low"
+    max_results = max(1, min(int(max_results or 5), WEB_SEARCH_MAX_CITATIONS))
+    
+    cache_key = make_cache_key("search_web_openrouter", normalize_search_query(query), max_results, search_context_size, WEB_SEARCH_MODEL)
+    cached_result = WEB_SEARCH_CACHE.get(cache_key)
+    if cached_result is not None:
+        logger.debug("OpenRouter web search cache hit: %r", query)
+        return cached_result
+    
+    try:
+        openrouter_client_instance = get_openrouter_client()
+        
+        # Use a web-search enabled model like Perplexity
+        web_search_prompt = (
+            f"Search the web for comprehensive information about: {query}\n\n"
+            f"CRITICAL CITATION REQUIREMENTS:\n"
+            f"1. Provide a comprehensive answer based on current web sources\n"
+            f"2. EMBED clickable source links directly in your response using markdown format: [descriptive text](URL)\n"
+            f"3. Make link text natural and descriptive - integrate seamlessly into sentence flow\n"
+            f"4. Example: 'According to [recent MIT research](https://mit.edu/study), quantum computing has advanced significantly'\n"
+            f"5. Cite up to {max_results} high-quality sources throughout your response\n"
+            f"6. Focus on {search_context_size} level of detail\n"
+            f"7. Prioritize embedding clickable links over numbered citations like [1], [2], [3]\n"
+            f"8. Ensure all information is current and well-sourced with embedded citations"
+        )
+        
+        # Use Perplexity which has built-in web search capabilities
+        response = openrouter_client_instance.with_options(max_retries=WEB_SEARCH_MAX_RETRIES).chat.completions.create(
+            model=WEB_SEARCH_MODEL,
+            messages=[
+                {
+                    "role": "system", 
+                    "content": (
+                        "You are a web search assistant with access to real-time web information. "
+                        "CRITICAL: Always embed clickable source links directly in your response using markdown format: [descriptive text](URL). "
+                        "Make link text natural and descriptive - integrate seamlessly into sentence flow. "
+                        "Example: 'According to [recent MIT research](https://mit.edu/study)' or '[industry experts report](https://example.com)'. "
+                        "Prioritize embedding clickable links over numbered citations like [1], [2], [3]. "
+                        "Provide comprehensive, well-cited responses with embedded clickable source links."
+                    )
+                },
+                {
+                    "role": "user", 
+                    "content": web_search_prompt
+                }
+            ],
+            max_tokens=2000,
+            temperature=0.3,
+            extra_body={"web_search_options": {"search_context_size": search_context_size}}
+        )
+        
+        message = response.choices[0].message
+        content = message.content
+        
+        # Extract unique URLs from markdown links in the content, up to the requested number of sources
+        citations_by_url = {}
+        for title, url in extract_markdown_links(content):
+            if url not in citations_by_url:
+                citations_by_url[url] = {"title": title, "url": url, "source": "perplexity_web_search"}
+                if len(citations_by_url) == max_results:
+                    break
+        citations = list(citations_by_url.values())
+        
+        # Each citation's "source" already identifies the backend; counts derive from the list
+        result = {
+            "success": True,
+            "query": query,
+            "content": content,
+            "citations": citations
+        }
+        WEB_SEARCH_CACHE.set(cache_key, result)
+        return result
+        
+    except Exception as e:
+        logger.exception("OpenRouter web search error")
+        return {"error": f"OpenRouter web search failed: {str(e)}"}
+
+# Tool definitions for OpenRouter function calling
+AGENTIC_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_time",
+            "description": "Get the current date and time",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
         }
     },
     {
@@ -1542,6 +2473,61 @@ AGENTIC_TOOLS = [
                 "required": ["topic"]
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "advanced_research_with_synthesis",
+            "description": "Perform advanced multi-step research with intelligent synthesis and quality assessment. Demonstrates tool chaining and context preservation for complex topics.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "topic": {
+                        "type": "string",
+                        "description": "The topic to research comprehensively"
+                    },
+                    "research_depth": {
+                        "type": "string",
+                        "description": "Depth of research: 'quick' (basic overview), 'standard' (balanced approach), 'comprehensive' (thorough analysis)",
+                        "enum": ["quick", "standard", "comprehensive"]
+                    },
+                    "focus_areas": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "Specific areas to focus on (e.g., ['overview', 'recent_developments', 'practical_applications', 'challenges', 'future_trends'])"
+                    }
+                },
+                "required": ["topic"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_web_openrouter",
+            "description": "Search the web using OpenRouter's Perplexity model with real-time web access. Provides current information with citations and comprehensive analysis.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Search query to find current information on the web"
+                    },
+                    "max_results": {
+                        "type": "integer",
+                        "description": "Maximum number of sources to cite (default: 5, max: 10)",
+                        "minimum": 1,
+                        "maximum": 10
+                    },
+                    "search_context_size": {
+                        "type": "string",
+                        "description": "Detail level: 'low' (brief, default), 'medium' (moderate), 'high' (comprehensive)",
+                        "enum": ["low", "medium", "high"]
+                    }
+                },
+                "required": ["query"]
+            }
+        }
     }
 ]
 
@@ -1551,21 +2537,24 @@ TOOL_MAPPING = {
     "calculate_math": calculate_math,
     "search_web_tool": search_web_tool,
     "create_note": create_note,
-    "research_topic": research_topic
+    "research_topic": research_topic,
+    "advanced_research_with_synthesis": advanced_research_with_synthesis,
+    "search_web_openrouter": search_web_openrouter
 }
 
-def get_tool_response_single(response, tool_call):
-    """Process a single tool call - helper function"""
+def get_tool_response_single(response: Any, tool_call: Any, tool_args: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Process a single tool call - helper function. Pass tool_args if already parsed."""
     tool_name = tool_call.function.name
-    tool_args = json.loads(tool_call.function.arguments)
+    if tool_args is None:
+        tool_args = json_loads(tool_call.function.arguments)
     
-    print(f"Executing tool: {tool_name} with args: {tool_args}")
+    logger.debug("Executing tool: %s with args: %s", tool_name, tool_args)
     
     # Look up the correct tool locally, and call it with the provided arguments
     if tool_name in TOOL_MAPPING:
         try:
             tool_result = TOOL_MAPPING[tool_name](**tool_args)
-            print(f"Tool result: {tool_result}")
+            logger.debug("Tool result: %s", tool_result)
         except Exception as e:
             tool_result = {"error": f"Tool execution failed: {str(e)}"}
     else:
@@ -1575,18 +2564,33 @@ def get_tool_response_single(response, tool_call):
         "role": "tool",
         "tool_call_id": tool_call.id,
         "name": tool_name,
-        "content": json.dumps(tool_result),
+        "content": json_dumps(tool_result),
     }
 
-def log_agent_performance(task_plan, total_tools_used, iteration_count, success=True):
+def get_tool_responses(response: Any, tool_calls: List[Any], tool_args_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Run every tool call of one assistant turn concurrently, given each call's parsed arguments.
+    Responses come back in tool_calls order so tool_call_ids line up with the request.
+    """
+    if len(tool_calls) == 1:
+        return [get_tool_response_single(response, tool_calls[0], tool_args_list[0])]
+    return list(TOOL_EXECUTOR.map(functools.partial(get_tool_response_single, response), tool_calls, tool_args_list))
+
+# Tools that gather information from the web (used for progress heuristics and metrics)
+SEARCH_TOOL_NAMES = frozenset([
+    "search_web_tool",
+    "search_web_openrouter",
+    "research_topic",
+    "advanced_research_with_synthesis"
+])
+
+def log_agent_performance(task_plan: Dict[str, Any], tool_counts: Counter, iteration_count: int, success: bool = True) -> Optional[Dict[str, Any]]:
     """
     Log agent performance metrics for monitoring and evaluation.
+    tool_counts maps each tool name to its number of calls during the run.
     In a production system, this would integrate with OpenAI's tracing and evaluation tools.
     """
     try:
-        from datetime import datetime
-        import json
-        
         performance_data = {
             "timestamp": datetime.now().isoformat(),
             "objective": task_plan.get("objective", "")[:200],  # Truncate for logging
@@ -1594,168 +2598,221 @@ def log_agent_performance(task_plan, total_tools_used, iteration_count, success=
             "iterations_used": iteration_count,
             "max_iterations": 5,  # Current limit
             "efficiency": iteration_count / 5,  # Simple efficiency metric
-            "tools_used": list(set(total_tools_used)),
-            "tool_usage_count": len(total_tools_used),
-            "unique_tools_count": len(set(total_tools_used)),
+            "tools_used": list(tool_counts),
+            "tool_usage_count": sum(tool_counts.values()),
+            "unique_tools_count": len(tool_counts),
             "steps_completed": len(task_plan.get("steps_completed", [])),
             "final_step": task_plan.get("current_step", "unknown"),
-            "research_operations": len([s for s in task_plan.get("steps_completed", []) 
-                                      if 'search' in s.get('tool', '') or 'research' in s.get('tool', '')]),
+            "research_operations": sum(count for tool, count in tool_counts.items() if tool in SEARCH_TOOL_NAMES),
         }
         
         # In production, this would send to OpenAI's tracing system
-        print(f"Agent Performance Log: {json.dumps(performance_data, indent=2)}")
+        logger.info("Agent Performance Log: %s", performance_data)
         
         return performance_data
         
     except Exception as e:
-        print(f"Error logging agent performance: {e}")
+        logger.warning("Error logging agent performance: %s", e)
         return None
 
 # --- Agentic Loop Function ---
+# Enhanced system prompt for agentic behavior following OpenAI best practices
+AGENTIC_SYSTEM_PROMPT = (
+    "You are Comet, an advanced AI agent built with OpenAI's agentic primitives. You intelligently accomplish tasks "
+    "by reasoning, planning, and using tools to interact with the world.\n\n"
+    
+    "🧠 **CORE INTELLIGENCE & REASONING:**\n"
+    "- Think step-by-step using Chain-of-Thought reasoning\n"
+    "- Before taking action, explicitly state: 1) What you understand, 2) What you plan to do, 3) Why this approach is optimal\n"
+    "- Break down complex tasks into manageable sub-tasks with clear dependencies\n"
+    "- Use self-consistency: consider multiple approaches and choose the most reliable\n"
+    "- Learn from tool results and adapt your strategy accordingly\n"
+    "- Practice self-reflection: after each tool use, evaluate if the result meets expectations\n\n"
+    
+    "🛠️ **AVAILABLE TOOLS & CAPABILITIES:**\n"
+    "🕒 **get_current_time**: Get current date and time for temporal context\n"
+    "🧮 **calculate_math**: Perform mathematical calculations and analysis\n"
+    "🔍 **search_web_tool**: Enhanced web search with intelligent type detection (Tavily-powered)\n"
+    "   - Auto-detects search type (news, general, deep research)\n"
+    "   - Returns quality-ranked results with metadata\n"
+    "   - Configurable depth and result count\n"
+    "🌐 **search_web_openrouter**: OpenRouter web search via Perplexity (Real-time web access)\n"
+    "   - Uses Perplexity's sonar-reasoning-pro with built-in web search\n"
+    "   - Provides real-time web information with citations\n"
+    "   - Configurable search context size and detail level\n"
+    "📝 **create_note**: Create and save structured notes or summaries\n"
+    "🔬 **research_topic**: Comprehensive multi-step research workflow\n"
+    "   - Combines overview, news, and analysis searches\n"
+    "   - Aggregates findings from multiple sources\n"
+    "   - Provides quality distribution and research summary\n"
+    "🔬 **advanced_research_with_synthesis**: Advanced multi-step research with synthesis\n"
+    "   - Demonstrates tool chaining and context preservation\n"
+    "   - Quality assessment and intelligent synthesis\n"
+    "   - Multi-angle information gathering\n\n"
+    
+    "📋 **ENHANCED AGENTIC WORKFLOW & ORCHESTRATION:**\n"
+    "1. **UNDERSTAND** - Parse the user's request and identify implicit needs\n"
+    "2. **REASON** - Think through multiple solution paths and their trade-offs\n"
+    "3. **PLAN** - Create a step-by-step strategy with contingencies\n"
+    "4. **EXECUTE** - Use tools systematically, building on previous results\n"
+    "5. **VALIDATE** - Check if results meet quality standards and user needs\n"
+    "6. **ADAPT** - Modify approach based on intermediate results\n"
+    "7. **SYNTHESIZE** - Combine findings into comprehensive, actionable insights\n\n"
+    
+    "🎯 **THOROUGHNESS MANDATE:**\n"
+    "- **Use Multiple Iterations**: You have up to 5 iterations - use them to provide exceptional value\n"
+    "- **Diversify Tool Usage**: Combine different tools for comprehensive analysis\n"
+    "- **Layer Information**: Build upon previous findings with additional perspectives\n"
+    "- **Cross-Validate**: Use multiple sources and methods to verify insights\n"
+    "- **Add Value Each Step**: Each iteration should contribute unique insights\n"
+    "- **Think Comprehensively**: Consider multiple angles, implications, and follow-up questions\n\n"
+    
+    "🎯 **INTELLIGENT TOOL SELECTION STRATEGY:**\n"
+    "- **Simple factual queries**: Use search_web_tool with auto-detection\n"
+    "- **Current events/breaking news**: Use search_web_tool with type='news'\n"
+    "- **Real-time web information needed**: Use search_web_openrouter for current data\n"
+    "- **Comprehensive research with citations**: Use search_web_openrouter with context_size='high'\n"
+    "- **Complex research topics**: Use research_topic for multi-angle analysis\n"
+    "- **Technical tutorials/guides**: Use search_web_tool with type='general'\n"
+    "- **Academic/detailed analysis**: Use search_web_tool with type='deep' or search_web_openrouter for real-time data\n"
+    "- **Calculations/quantitative analysis**: Use calculate_math\n"
+    "- **Information organization**: Use create_note to structure findings\n"
+    "- **Advanced synthesis**: Use advanced_research_with_synthesis for complex topics\n"
+    "- **Multi-step problems**: Chain tools together logically\n\n"
+    
+    "🔍 **QUALITY ASSURANCE & VALIDATION:**\n"
+    "- Cross-reference information from multiple sources when possible\n"
+    "- Clearly distinguish between verified facts and speculation\n"
+    "- Acknowledge limitations and uncertainties in your knowledge\n"
+    "- Provide source citations and quality indicators\n"
+    "- Use self-consistency: if unsure, gather additional information\n"
+    "- Validate tool outputs before proceeding to next steps\n\n"
+    
+    "🤔 **METACOGNITIVE REASONING:**\n"
+    "- Before each action, ask: 'Is this the most effective approach?'\n"
+    "- After each tool use, evaluate: 'Did this provide the expected value?'\n"
+    "- If stuck, try alternative approaches or break down the problem differently\n"
+    "- Consider the user's likely follow-up questions and address them proactively\n"
+    "- Balance thoroughness with efficiency based on query complexity\n\n"
+    
+    "💬 **ENHANCED RESPONSE GUIDELINES:**\n"
+    "- Begin with a brief reasoning statement about your approach\n"
+    "- Provide comprehensive answers with clear structure and headings\n"
+    "- Include actionable insights and specific recommendations\n"
+    "- Show your reasoning process when it adds value\n"
+    "- Adapt communication style to match user expertise level\n"
+    "- End with relevant follow-up suggestions or next steps\n\n"
+    
+    "🔄 **ITERATIVE IMPROVEMENT:**\n"
+    "- If initial results are insufficient, refine your approach\n"
+    "- Use few-shot learning from successful patterns in the conversation\n"
+    "- Build context across multiple tool calls for better outcomes\n"
+    "- Learn from user feedback and adjust strategy accordingly\n\n"
+    
+    "Remember: You are an intelligent agent capable of autonomous reasoning, planning, and tool use. "
+    "Think critically, plan strategically, execute systematically, and continuously improve your approach. "
+    "Your goal is not just to answer questions, but to provide comprehensive, actionable intelligence.\n\n"
+    
+    "🚀 **EXECUTION EXCELLENCE:**\n"
+    "- **Maximize Your Iterations**: You have 5 iterations available - use them to deliver exceptional value\n"
+    "- **Don't Stop Early**: Unless the task is truly simple, explore multiple angles and perspectives\n"
+    "- **Build Incrementally**: Each iteration should add meaningful insights to your analysis\n"
+    "- **Think Like an Expert**: What would a domain expert do with access to these tools?\n"
+    "- **Exceed Expectations**: Go beyond the basic request to provide comprehensive intelligence"
+)
+
+# Status shown after a tool round, checked in priority order: (tool name, task step, frame).
+# Frames are pre-encoded templates that take % (iteration, max_iterations).
+AGENT_STEP_STATUSES = (
+    ("search_web_tool", "information_gathering", sse_event({'reasoning': '🔍 Gathering targeted information from the web... (Step %d/%d)'})),
+    ("search_web_openrouter", "real_time_research", sse_event({'reasoning': '🌐 Accessing real-time web information via Perplexity... (Step %d/%d)'})),
+    ("research_topic", "comprehensive_research", sse_event({'reasoning': '🔬 Conducting multi-dimensional research analysis... (Step %d/%d)'})),
+    ("calculate_math", "quantitative_analysis", sse_event({'reasoning': '🧮 Performing calculations and quantitative analysis... (Step %d/%d)'})),
+    ("create_note", "knowledge_organization", sse_event({'reasoning': '📝 Organizing and structuring findings... (Step %d/%d)'})),
+)
+
+# Tools the continuation logic suggests when they have not been used yet
+AGENT_SUGGESTED_TOOLS = frozenset([
+    "search_web_tool",
+    "search_web_openrouter",
+    "research_topic",
+    "calculate_math",
+    "create_note",
+    "advanced_research_with_synthesis"
+])
+
+# Older tool results are shortened once the agent history outgrows this budget. Every
+# rewrite invalidates the provider's cached prompt prefix from that message on, so a pass
+# compacts down to the low-water mark and only runs when it frees a sizeable block; the
+# history is then rewritten once every few turns rather than on every turn.
+AGENT_HISTORY_TOKEN_BUDGET = 8000
+AGENT_HISTORY_LOW_WATER_TOKENS = 4000
+AGENT_HISTORY_MIN_RECLAIM_TOKENS = 2000
+AGENT_KEEP_RECENT_TOOL_RESULTS = 2
+COMPACTED_TOOL_RESULT_CHARS = 300
+
+def compact_tool_history(messages):
+    """
+    Once the history exceeds AGENT_HISTORY_TOKEN_BUDGET, shorten older tool results in
+    place, oldest first, until it fits AGENT_HISTORY_LOW_WATER_TOKENS. The most recent
+    results are always kept verbatim.
+    """
+    history_tokens = sum(estimate_tokens(m["content"]) for m in messages if isinstance(m.get("content"), str))
+    if history_tokens <= AGENT_HISTORY_TOKEN_BUDGET:
+        return
+    tool_indexes = [i for i, m in enumerate(messages) if m.get("role") == "tool"]
+    summaries = []  # (index, summary, tokens saved)
+    for i in tool_indexes[:-AGENT_KEEP_RECENT_TOOL_RESULTS]:
+        content = messages[i]["content"]
+        if len(content) > COMPACTED_TOOL_RESULT_CHARS and not content.startswith("[summary"):
+            summary = f"[summary of {len(content)} chars] {content[:COMPACTED_TOOL_RESULT_CHARS]}"
+            summaries.append((i, summary, estimate_tokens(content) - estimate_tokens(summary)))
+    if sum(saved for _, _, saved in summaries) < AGENT_HISTORY_MIN_RECLAIM_TOKENS:
+        return  # Not worth invalidating the cached prefix yet
+    for i, summary, saved in summaries:
+        if history_tokens <= AGENT_HISTORY_LOW_WATER_TOKENS:
+            break
+        messages[i] = {**messages[i], "content": summary}
+        history_tokens -= saved
+
+# Query wording that suggests calculations would add value
+QUANT_WORDS_RE = re.compile(r"calculate|cost|roi|percentage|compare|analyze|metrics|performance")
+
+# Final answers are streamed sentence by sentence, flushed once a chunk passes this size
+SENTENCE_RE = re.compile(r".*?(?:\. |\Z)", re.S)
+SENTENCE_CHUNK_CHARS = 100
+
 def run_agentic_loop(query, model_name, max_iterations=5):
     """
     Run a simple agentic loop following OpenRouter's best practices.
     Returns a generator for streaming responses.
     """
     if not openrouter_api_key:
-        yield f"data: {json.dumps({'error': 'OpenRouter API key not configured for agentic mode.'})}\n\n"
+        yield error_frame('OpenRouter API key not configured for agentic mode.')
         return
 
-    # Enhanced system prompt for agentic behavior following OpenAI best practices
-    agentic_system_prompt = (
-        "You are Comet, an advanced AI agent built with OpenAI's agentic primitives. You intelligently accomplish tasks "
-        "by reasoning, planning, and using tools to interact with the world.\n\n"
-        
-        "🧠 **CORE INTELLIGENCE & REASONING:**\n"
-        "- Think step-by-step using Chain-of-Thought reasoning\n"
-        "- Before taking action, explicitly state: 1) What you understand, 2) What you plan to do, 3) Why this approach is optimal\n"
-        "- Break down complex tasks into manageable sub-tasks with clear dependencies\n"
-        "- Use self-consistency: consider multiple approaches and choose the most reliable\n"
-        "- Learn from tool results and adapt your strategy accordingly\n"
-        "- Practice self-reflection: after each tool use, evaluate if the result meets expectations\n\n"
-        
-        "🛠️ **AVAILABLE TOOLS & CAPABILITIES:**\n"
-        "🕒 **get_current_time**: Get current date and time for temporal context\n"
-        "🧮 **calculate_math**: Perform mathematical calculations and analysis\n"
-        "🔍 **search_web_tool**: Enhanced web search with intelligent type detection (Tavily-powered)\n"
-        "   - Auto-detects search type (news, general, deep research)\n"
-        "   - Returns quality-ranked results with metadata\n"
-        "   - Configurable depth and result count\n"
-        "🌐 **search_web_openrouter**: OpenRouter web search via Perplexity (Real-time web access)\n"
-        "   - Uses Perplexity's sonar-reasoning-pro with built-in web search\n"
-        "   - Provides real-time web information with citations\n"
-        "   - Configurable search context size and detail level\n"
-        "📝 **create_note**: Create and save structured notes or summaries\n"
-        "🔬 **research_topic**: Comprehensive multi-step research workflow\n"
-        "   - Combines overview, news, and analysis searches\n"
-        "   - Aggregates findings from multiple sources\n"
-        "   - Provides quality distribution and research summary\n"
-        "🔬 **advanced_research_with_synthesis**: Advanced multi-step research with synthesis\n"
-        "   - Demonstrates tool chaining and context preservation\n"
-        "   - Quality assessment and intelligent synthesis\n"
-        "   - Multi-angle information gathering\n\n"
-        
-        "📋 **ENHANCED AGENTIC WORKFLOW & ORCHESTRATION:**\n"
-        "1. **UNDERSTAND** - Parse the user's request and identify implicit needs\n"
-        "2. **REASON** - Think through multiple solution paths and their trade-offs\n"
-        "3. **PLAN** - Create a step-by-step strategy with contingencies\n"
-        "4. **EXECUTE** - Use tools systematically, building on previous results\n"
-        "5. **VALIDATE** - Check if results meet quality standards and user needs\n"
-        "6. **ADAPT** - Modify approach based on intermediate results\n"
-        "7. **SYNTHESIZE** - Combine findings into comprehensive, actionable insights\n\n"
-        
-        "🎯 **THOROUGHNESS MANDATE:**\n"
-        "- **Use Multiple Iterations**: You have up to 5 iterations - use them to provide exceptional value\n"
-        "- **Diversify Tool Usage**: Combine different tools for comprehensive analysis\n"
-        "- **Layer Information**: Build upon previous findings with additional perspectives\n"
-        "- **Cross-Validate**: Use multiple sources and methods to verify insights\n"
-        "- **Add Value Each Step**: Each iteration should contribute unique insights\n"
-        "- **Think Comprehensively**: Consider multiple angles, implications, and follow-up questions\n\n"
-        
-        "🎯 **INTELLIGENT TOOL SELECTION STRATEGY:**\n"
-        "- **Simple factual queries**: Use search_web_tool with auto-detection\n"
-        "- **Current events/breaking news**: Use search_web_tool with type='news'\n"
-        "- **Real-time web information needed**: Use search_web_openrouter for current data\n"
-        "- **Comprehensive research with citations**: Use search_web_openrouter with context_size='high'\n"
-        "- **Complex research topics**: Use research_topic for multi-angle analysis\n"
-        "- **Technical tutorials/guides**: Use search_web_tool with type='general'\n"
-        "- **Academic/detailed analysis**: Use search_web_tool with type='deep' or search_web_openrouter for real-time data\n"
-        "- **Calculations/quantitative analysis**: Use calculate_math\n"
-        "- **Information organization**: Use create_note to structure findings\n"
-        "- **Advanced synthesis**: Use advanced_research_with_synthesis for complex topics\n"
-        "- **Multi-step problems**: Chain tools together logically\n\n"
-        
-        "🔍 **QUALITY ASSURANCE & VALIDATION:**\n"
-        "- Cross-reference information from multiple sources when possible\n"
-        "- Clearly distinguish between verified facts and speculation\n"
-        "- Acknowledge limitations and uncertainties in your knowledge\n"
-        "- Provide source citations and quality indicators\n"
-        "- Use self-consistency: if unsure, gather additional information\n"
-        "- Validate tool outputs before proceeding to next steps\n\n"
-        
-        "🤔 **METACOGNITIVE REASONING:**\n"
-        "- Before each action, ask: 'Is this the most effective approach?'\n"
-        "- After each tool use, evaluate: 'Did this provide the expected value?'\n"
-        "- If stuck, try alternative approaches or break down the problem differently\n"
-        "- Consider the user's likely follow-up questions and address them proactively\n"
-        "- Balance thoroughness with efficiency based on query complexity\n\n"
-        
-        "💬 **ENHANCED RESPONSE GUIDELINES:**\n"
-        "- Begin with a brief reasoning statement about your approach\n"
-        "- Provide comprehensive answers with clear structure and headings\n"
-        "- Include actionable insights and specific recommendations\n"
-        "- Show your reasoning process when it adds value\n"
-        "- Adapt communication style to match user expertise level\n"
-        "- End with relevant follow-up suggestions or next steps\n\n"
-        
-        "🔄 **ITERATIVE IMPROVEMENT:**\n"
-        "- If initial results are insufficient, refine your approach\n"
-        "- Use few-shot learning from successful patterns in the conversation\n"
-        "- Build context across multiple tool calls for better outcomes\n"
-        "- Learn from user feedback and adjust strategy accordingly\n\n"
-        
-        "Remember: You are an intelligent agent capable of autonomous reasoning, planning, and tool use. "
-        "Think critically, plan strategically, execute systematically, and continuously improve your approach. "
-        "Your goal is not just to answer questions, but to provide comprehensive, actionable intelligence.\n\n"
-        
-        "🚀 **EXECUTION EXCELLENCE:**\n"
-        "- **Maximize Your Iterations**: You have 5 iterations available - use them to deliver exceptional value\n"
-        "- **Don't Stop Early**: Unless the task is truly simple, explore multiple angles and perspectives\n"
-        "- **Build Incrementally**: Each iteration should add meaningful insights to your analysis\n"
-        "- **Think Like an Expert**: What would a domain expert do with access to these tools?\n"
-        "- **Exceed Expectations**: Go beyond the basic request to provide comprehensive intelligence"
-    )
-
     messages = [
-        {"role": "system", "content": agentic_system_prompt},
+        get_system_message(AGENTIC_SYSTEM_PROMPT, model_name),
         {"role": "user", "content": query}
     ]
 
     try:
-        openrouter_client_instance = openai.OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=openrouter_api_key,
-            default_headers={
-                "HTTP-Referer": os.getenv("APP_SITE_URL", "http://localhost:8080"),
-                "X-Title": os.getenv("APP_SITE_TITLE", "Comet AI Search")
-            }
-        )
+        openrouter_client_instance = get_openrouter_client()
 
-        def validate_progress(iteration, task_plan, recent_tools):
+        def validate_progress(iteration, task_plan, recent_tools, search_tool_count):
             """
             Self-reflection mechanism to evaluate progress and suggest adaptations.
             Based on 2024 best practices for agentic AI systems.
+            search_tool_count is maintained by the caller as tools are recorded.
             """
             validation_insights = []
             
             # Check for tool repetition without progress
-            if len(recent_tools) >= 3 and len(set(recent_tools[-3:])) == 1:
+            if len(recent_tools) >= 3 and recent_tools[-1] == recent_tools[-2] == recent_tools[-3]:
                 validation_insights.append("⚠️ Detected repeated tool usage - considering alternative approach")
                 
             # Check for balanced information gathering
-            search_tools = [t for t in recent_tools if 'search' in t or 'research' in t]
-            if len(search_tools) > 2 and iteration < max_iterations - 1:
+            if search_tool_count > 2 and iteration < max_iterations - 1:
                 validation_insights.append("✅ Comprehensive information gathering in progress")
                 
             # Check for synthesis readiness
@@ -1765,20 +2822,32 @@ def run_agentic_loop(query, model_name, max_iterations=5):
             # Suggest next best action based on current state
             if not recent_tools:
                 validation_insights.append("🚀 Starting with information gathering")
-            elif all('search' in t or 'research' in t for t in recent_tools[-2:]):
+            elif all(t in SEARCH_TOOL_NAMES for t in list(recent_tools)[-2:]):
                 validation_insights.append("💡 Consider analysis or calculation tools for deeper insights")
                 
             return validation_insights
 
-        def call_llm(msgs):
-            """Call LLM with tools - following OpenRouter documentation pattern"""
+        def call_llm(msgs, guidance=None):
+            """
+            Call LLM with tools - following OpenRouter documentation pattern.
+            Per-iteration guidance is sent as a trailing user message for this call only,
+            so the stored history stays an append-only, cacheable prefix.
+            """
+            request_msgs = with_cache_breakpoints(msgs, model_name)
+            if guidance:
+                request_msgs = request_msgs + [{"role": "user", "content": guidance}]
             resp = openrouter_client_instance.chat.completions.create(
                 model=model_name,
                 tools=AGENTIC_TOOLS,
-                messages=msgs,
+                messages=request_msgs,
                 temperature=0.3,  # Lower temperature for more consistent reasoning
                 top_p=0.9,        # Balanced creativity and focus
             )
+            usage = getattr(resp, "usage", None)
+            prompt_details = getattr(usage, "prompt_tokens_details", None)
+            if prompt_details is not None:
+                logger.debug("Agent LLM call: %s prompt tokens, %s served from prompt cache",
+                             usage.prompt_tokens, getattr(prompt_details, "cached_tokens", 0))
             # Convert message to dict format compatible with OpenAI API
             message = resp.choices[0].message
             message_dict = {
@@ -1800,107 +2869,82 @@ def run_agentic_loop(query, model_name, max_iterations=5):
             msgs.append(message_dict)
             return resp
 
-        def get_tool_response(response):
-            """Process tool calls - following OpenRouter documentation pattern"""
-            tool_call = response.choices[0].message.tool_calls[0]
-            tool_name = tool_call.function.name
-            tool_args = json.loads(tool_call.function.arguments)
-            
-            print(f"Executing tool: {tool_name} with args: {tool_args}")
-            
-            # Look up the correct tool locally, and call it with the provided arguments
-            # Other tools can be added without changing the agentic loop
-            if tool_name in TOOL_MAPPING:
-                try:
-                    tool_result = TOOL_MAPPING[tool_name](**tool_args)
-                    print(f"Tool result: {tool_result}")
-                except Exception as e:
-                    tool_result = {"error": f"Tool execution failed: {str(e)}"}
-            else:
-                tool_result = {"error": f"Unknown tool: {tool_name}"}
-            
-            return {
-                "role": "tool",
-                "tool_call_id": tool_call.id,
-                "name": tool_name,
-                "content": json.dumps(tool_result),
-            }
-
         # Enhanced agentic loop with planning and monitoring
         iteration = 0
-        total_tools_used = []
+        recent_tools = deque(maxlen=3)  # Window for the repetition heuristics
+        tool_counts = Counter()
+        unique_tools_used = set()
+        search_tool_count = 0
         task_plan = {"objective": query, "steps_completed": [], "current_step": "analysis", "strategy_adaptations": []}
+        pending_reminder = None  # Short note for the next call only, never stored in history
+        query_is_quantitative = QUANT_WORDS_RE.search(query.lower()) is not None
         
         # Initial planning phase with explicit reasoning
-        yield f"data: {json.dumps({'reasoning': '🧠 Analyzing request and planning optimal approach...'})}\n\n"
+        yield reasoning_frame('🧠 Analyzing request and planning optimal approach...')
         
         while iteration < max_iterations:
             iteration += 1
-            print(f"Agentic loop iteration {iteration} - Current step: {task_plan['current_step']}")
+            logger.debug("Agentic loop iteration %d - Current step: %s", iteration, task_plan['current_step'])
             
             # Self-reflection and progress validation
-            validation_insights = validate_progress(iteration, task_plan, total_tools_used)
+            validation_insights = validate_progress(iteration, task_plan, recent_tools, search_tool_count)
             if validation_insights:
                 for insight in validation_insights:
-                    yield f"data: {json.dumps({'reasoning': insight})}\n\n"
-                    task_plan["strategy_adaptations"].extend(validation_insights)
+                    yield reasoning_frame(insight)
+                task_plan["strategy_adaptations"].extend(validation_insights)
             
-            # Add metacognitive prompting for better reasoning
-            if iteration > 1 and total_tools_used:
-                metacognitive_context = (
-                    f"\n\nMETACOGNITIVE REFLECTION:\n"
-                    f"Previous tools used: {', '.join(total_tools_used[-3:])}\n"
-                    f"Current progress: {len(task_plan['steps_completed'])} steps completed\n"
-                    f"Validation insights: {'; '.join(validation_insights) if validation_insights else 'On track'}\n"
-                    f"Consider: Is the current approach optimal? Should I adapt my strategy?\n"
-                )
-                # Add reflection to the conversation context
-                messages.append({"role": "system", "content": metacognitive_context})
+            # Tool results already carry the progress; only remind the model on its last turn
+            if iteration == max_iterations and max_iterations > 1 and pending_reminder is None:
+                pending_reminder = "Reminder: this is your last turn - answer now from the information gathered."
             
-            resp = call_llm(messages)
+            resp = call_llm(messages, pending_reminder)
+            pending_reminder = None
             
             if resp.choices[0].message.tool_calls is not None:
                 # Process all tool calls in this response
                 tool_calls_used = []
-                for tool_call in resp.choices[0].message.tool_calls:
-                    tool_response = get_tool_response_single(resp, tool_call)
-                    messages.append(tool_response)
+                tool_calls = resp.choices[0].message.tool_calls
+                # Parse each call's arguments once for both execution and step tracking
+                tool_args_list = [json_loads(tool_call.function.arguments) for tool_call in tool_calls]
+                messages.extend(get_tool_responses(resp, tool_calls, tool_args_list))
+                compact_tool_history(messages)
+                step_timestamp = get_current_time()["current_time"]  # Shared by this round's steps
+                for tool_call, tool_args in zip(tool_calls, tool_args_list):
                     tool_name = tool_call.function.name
                     tool_calls_used.append(tool_name)
-                    total_tools_used.append(tool_name)
+                    recent_tools.append(tool_name)
+                    tool_counts[tool_name] += 1
+                    unique_tools_used.add(tool_name)
+                    if tool_name in SEARCH_TOOL_NAMES:
+                        search_tool_count += 1
                     
                     # Enhanced task plan tracking
                     step_info = {
                         "iteration": iteration,
                         "tool": tool_name,
-                        "args": json.loads(tool_call.function.arguments),
-                        "timestamp": get_current_time()["current_time"]
+                        "args": tool_args,
+                        "timestamp": step_timestamp
                     }
                     task_plan["steps_completed"].append(step_info)
                 
                 # Enhanced progress updates with better context
-                if "search_web_tool" in tool_calls_used:
-                    task_plan["current_step"] = "information_gathering"
-                    yield f"data: {json.dumps({'reasoning': f'🔍 Gathering targeted information from the web... (Step {iteration}/{max_iterations})'})}\n\n"
-                elif "search_web_openrouter" in tool_calls_used:
-                    task_plan["current_step"] = "real_time_research"
-                    yield f"data: {json.dumps({'reasoning': f'🌐 Accessing real-time web information via Perplexity... (Step {iteration}/{max_iterations})'})}\n\n"
-                elif "research_topic" in tool_calls_used:
-                    task_plan["current_step"] = "comprehensive_research"
-                    yield f"data: {json.dumps({'reasoning': f'🔬 Conducting multi-dimensional research analysis... (Step {iteration}/{max_iterations})'})}\n\n"
-                elif "calculate_math" in tool_calls_used:
-                    task_plan["current_step"] = "quantitative_analysis"
-                    yield f"data: {json.dumps({'reasoning': f'🧮 Performing calculations and quantitative analysis... (Step {iteration}/{max_iterations})'})}\n\n"
-                elif "create_note" in tool_calls_used:
-                    task_plan["current_step"] = "knowledge_organization"
-                    yield f"data: {json.dumps({'reasoning': f'📝 Organizing and structuring findings... (Step {iteration}/{max_iterations})'})}\n\n"
+                for status_tool, status_step, status_frame in AGENT_STEP_STATUSES:
+                    if status_tool in tool_calls_used:
+                        task_plan["current_step"] = status_step
+                        yield status_frame % (iteration, max_iterations)
+                        break
                 else:
                     task_plan["current_step"] = "tool_execution"
-                    yield f"data: {json.dumps({'reasoning': f'🛠️ Executing specialized tools: {", ".join(tool_calls_used)} (Step {iteration}/{max_iterations})'})}\n\n"
+                    yield sse_event({'reasoning': f'🛠️ Executing specialized tools: {", ".join(tool_calls_used)} (Step {iteration}/{max_iterations})'})
+                
+                # Continuation heuristics only shape guidance for a next iteration
+                if iteration >= max_iterations:
+                    continue
                 
                 # Enhanced continuation logic - encourage more thorough exploration
                 should_continue = False
                 continuation_reasons = []
+                can_expand = iteration < max_iterations - 1  # Room for at least two more calls
                 
                 # Check if we should continue based on various criteria
                 if iteration < 3:
@@ -1908,141 +2952,131 @@ def run_agentic_loop(query, model_name, max_iterations=5):
                     continuation_reasons.append("Early exploration phase - gathering more information")
                 
                 # Check for opportunities to use different tools
-                unique_tools_used = set(total_tools_used)
-                available_tools = {"search_web_tool", "search_web_openrouter", "research_topic", "calculate_math", "create_note", "advanced_research_with_synthesis"}
-                unused_tools = available_tools - unique_tools_used
+                unused_tools = AGENT_SUGGESTED_TOOLS - unique_tools_used
                 
-                if len(unused_tools) > 2 and iteration < max_iterations - 1:
+                if can_expand and len(unused_tools) > 2:
                     should_continue = True
-                    continuation_reasons.append(f"Multiple tools available for deeper analysis: {', '.join(list(unused_tools)[:3])}")
+                    continuation_reasons.append(f"Multiple tools available for deeper analysis: {', '.join(itertools.islice(unused_tools, 3))}")
                 
                 # Check if we can enhance the analysis with additional perspectives
-                if "search_web_tool" in total_tools_used and "search_web_openrouter" not in total_tools_used and iteration < max_iterations - 1:
+                if can_expand and "search_web_tool" in unique_tools_used and "search_web_openrouter" not in unique_tools_used:
                     should_continue = True
                     continuation_reasons.append("Can enhance with real-time web search for current information")
                 
-                if any("search" in tool for tool in total_tools_used) and "calculate_math" not in total_tools_used and iteration < max_iterations - 1:
+                if can_expand and search_tool_count and "calculate_math" not in unique_tools_used:
                     # Check if the query might benefit from calculations
-                    query_lower = query.lower()
-                    if any(word in query_lower for word in ['calculate', 'cost', 'roi', 'percentage', 'compare', 'analyze', 'metrics', 'performance']):
+                    if query_is_quantitative:
                         should_continue = True
                         continuation_reasons.append("Query suggests quantitative analysis would be valuable")
                 
                 # Check for synthesis opportunities
-                if len(task_plan["steps_completed"]) >= 2 and "create_note" not in total_tools_used and iteration < max_iterations - 1:
+                if can_expand and len(task_plan["steps_completed"]) >= 2 and "create_note" not in unique_tools_used:
                     should_continue = True
                     continuation_reasons.append("Multiple data sources gathered - synthesis and organization would be valuable")
                 
                 # Advanced monitoring: Adaptive strategy adjustments
                 if iteration > 2:
-                    recent_tools = total_tools_used[-3:]
-                    if len(set(recent_tools)) == 1:
+                    if len(recent_tools) == 3 and recent_tools[0] == recent_tools[1] == recent_tools[2]:
                         # Same tool used repeatedly - inject strategy adaptation
                         adaptation_prompt = (
                             f"I notice I've been using the same tool ({recent_tools[0]}) repeatedly. "
                             f"Let me diversify my approach with different tools for a more comprehensive analysis."
                         )
-                        yield f"data: {json.dumps({'reasoning': f'🔄 {adaptation_prompt}'})}\n\n"
+                        yield sse_event({'reasoning': f'🔄 {adaptation_prompt}'})
                         task_plan["strategy_adaptations"].append(f"Iteration {iteration}: Detected tool repetition, diversifying approach")
                         should_continue = True
                         continuation_reasons.append("Diversifying tool usage for comprehensive analysis")
                         
-                        # Add adaptive guidance to conversation
-                        messages.append({
-                            "role": "system", 
-                            "content": f"ADAPTIVE GUIDANCE: {adaptation_prompt} You have {max_iterations - iteration} iterations remaining. Consider using different tools like: {', '.join(list(unused_tools)[:3])} to provide a more comprehensive analysis."
-                        })
+                        # Add a short reminder to the next call
+                        pending_reminder = (
+                            f"Reminder: {recent_tools[0]} was used 3 times in a row; try a different tool "
+                            f"({', '.join(itertools.islice(unused_tools, 3)) or 'or answer'}). "
+                            f"{max_iterations - iteration} iterations left."
+                        )
                 
-                # If we have good reasons to continue and haven't hit max iterations, keep going
-                if should_continue and iteration < max_iterations:
+                # If we have good reasons to continue, tell the client why
+                if should_continue:
                     continuation_message = f"🔄 Continuing analysis - {'; '.join(continuation_reasons[:2])}"
-                    yield f"data: {json.dumps({'reasoning': continuation_message})}\n\n"
-                    
-                    # Add guidance for next iteration
-                    next_iteration_guidance = (
-                        f"ITERATION {iteration + 1} GUIDANCE: You have completed {len(task_plan['steps_completed'])} steps. "
-                        f"Consider using these tools for deeper analysis: {', '.join(list(unused_tools)[:3])}. "
-                        f"Focus on providing comprehensive, multi-faceted insights. "
-                        f"You have {max_iterations - iteration} iterations remaining to deliver exceptional value."
-                    )
-                    messages.append({
-                        "role": "system",
-                        "content": next_iteration_guidance
-                    })
+                    yield sse_event({'reasoning': continuation_message})
                     continue  # Continue the loop instead of ending
                     
             else:
                 # No more tool calls, provide enhanced final synthesis
                 task_plan["current_step"] = "synthesis_and_delivery"
-                print(f"Agentic workflow completed after {iteration} iterations")
-                print(f"Task plan: {task_plan}")
-                print(f"Tools used: {total_tools_used}")
+                logger.debug("Agentic workflow completed after %d iterations; tools used: %s", iteration, dict(tool_counts))
+                logger.debug("Task plan: %s", task_plan)
                 
                 # Log performance for monitoring and evaluation
-                log_agent_performance(task_plan, total_tools_used, iteration, success=True)
+                log_agent_performance(task_plan, tool_counts, iteration, success=True)
                 
                 final_content = resp.choices[0].message.content
                 
                 # Stream the final response with enhanced orchestration summary
                 if final_content:
-                    # Add comprehensive workflow insights
-                    if total_tools_used:
-                        unique_tools = list(set(total_tools_used))
-                        efficiency_score = len(unique_tools) / len(total_tools_used) if total_tools_used else 0
-                        
-                        workflow_summary = (
-                            f"\n\n---\n"
-                            f"**🤖 Enhanced Agent Workflow Summary:**\n"
-                            f"- **Objective**: {task_plan['objective'][:100]}{'...' if len(task_plan['objective']) > 100 else ''}\n"
-                            f"- **Iterations Completed**: {iteration}/{max_iterations}\n"
-                            f"- **Tools Utilized**: {', '.join(unique_tools)}\n"
-                            f"- **Efficiency Score**: {efficiency_score:.2f} (unique tools / total calls)\n"
-                            f"- **Research Operations**: {len([s for s in task_plan['steps_completed'] if 'search' in s['tool'] or 'research' in s['tool']])}\n"
-                            f"- **Strategy Adaptations**: {len(task_plan['strategy_adaptations'])}\n"
-                            f"- **Quality Assurance**: ✅ Multi-source validation applied\n"
-                            f"- **Status**: ✅ Task completed successfully with comprehensive analysis"
-                        )
+                    # Add comprehensive workflow insights, streamed after the answer as one chunk
+                    workflow_summary = None
+                    if tool_counts:
+                        unique_tools = list(unique_tools_used)
+                        efficiency_score = len(unique_tools) / sum(tool_counts.values())
                         
+                        summary_lines = [
+                            "\n\n---",
+                            "**🤖 Enhanced Agent Workflow Summary:**",
+                            f"- **Objective**: {task_plan['objective'][:100]}{'...' if len(task_plan['objective']) > 100 else ''}",
+                            f"- **Iterations Completed**: {iteration}/{max_iterations}",
+                            f"- **Tools Utilized**: {', '.join(unique_tools)}",
+                            f"- **Efficiency Score**: {efficiency_score:.2f} (unique tools / total calls)",
+                            f"- **Research Operations**: {search_tool_count}",
+                            f"- **Strategy Adaptations**: {len(task_plan['strategy_adaptations'])}",
+                            "- **Quality Assurance**: ✅ Multi-source validation applied",
+                            "- **Status**: ✅ Task completed successfully with comprehensive analysis"
+                        ]
                         if task_plan["strategy_adaptations"]:
-                            workflow_summary += f"\n- **Adaptive Insights**: {'; '.join(task_plan['strategy_adaptations'][-2:])}"
+                            summary_lines.append(f"- **Adaptive Insights**: {'; '.join(task_plan['strategy_adaptations'][-2:])}")
                         
-                        final_content += workflow_summary
+                        workflow_summary = "\n".join(summary_lines)
                     
-                    # Enhanced streaming with better readability
-                    sentences = final_content.split('. ')
-                    current_chunk = ""
+                    # Enhanced streaming with better readability: buffer sentences, join once per chunk
+                    buffered_sentences = []
+                    buffered_length = 0
                     
-                    for sentence in sentences:
-                        current_chunk += sentence + ". "
+                    for match in SENTENCE_RE.finditer(final_content):
+                        sentence = match.group()
+                        if not sentence:
+                            continue
+                        buffered_sentences.append(sentence)
+                        buffered_length += len(sentence)
                         # Improved chunking logic for better user experience
-                        if len(current_chunk) > 100 or sentence.endswith('\n') or '**' in sentence:
-                            yield f"data: {json.dumps({'chunk': current_chunk})}\n\n"
-                            current_chunk = ""
+                        if buffered_length > SENTENCE_CHUNK_CHARS or sentence.endswith('\n') or '**' in sentence:
+                            yield chunk_frame("".join(buffered_sentences))
+                            buffered_sentences = []
+                            buffered_length = 0
                     
                     # Send remaining content
-                    if current_chunk:
-                        yield f"data: {json.dumps({'chunk': current_chunk})}\n\n"
+                    if buffered_sentences:
+                        yield chunk_frame("".join(buffered_sentences))
+                    
+                    if workflow_summary:
+                        yield chunk_frame(workflow_summary)
                 
-                yield f"data: {json.dumps({'end_of_stream': True})}\n\n"
+                yield END_OF_STREAM_FRAME
                 return
 
         # If we hit max iterations, provide intelligent fallback
         # Log performance for incomplete workflow
-        log_agent_performance(task_plan, total_tools_used, max_iterations, success=False)
+        log_agent_performance(task_plan, tool_counts, max_iterations, success=False)
         
         fallback_message = (
             f"I've reached the maximum number of iterations ({max_iterations}) while working on your request. "
-            f"However, I was able to complete {len(task_plan['steps_completed'])} steps using these tools: {', '.join(set(total_tools_used))}. "
+            f"However, I was able to complete {len(task_plan['steps_completed'])} steps using these tools: {', '.join(unique_tools_used)}. "
             f"Current progress: {task_plan['current_step']}. "
             f"The information gathered so far should still be valuable for addressing your query."
         )
-        yield f"data: {json.dumps({'chunk': fallback_message})}\n\n"
-        yield f"data: {json.dumps({'end_of_stream': True})}\n\n"
+        yield chunk_frame(fallback_message)
+        yield END_OF_STREAM_FRAME
 
     except Exception as e:
-        print(f"Error in agentic loop: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in agentic loop")
         
         # Provide a more detailed error response
         error_message = f"Agentic loop error: {str(e)}"
@@ -2053,7 +3087,7 @@ def run_agentic_loop(query, model_name, max_iterations=5):
         elif "JSONDecodeError" in str(e):
             error_message += " (Response parsing issue - please try again)"
         
-        yield f"data: {json.dumps({'error': error_message})}\n\n"
+        yield sse_event({'error': error_message})
 
 @app.route('/search/background', methods=['POST'])
 def search_background():
@@ -2061,7 +3095,7 @@ def search_background():
     Start a background search task for long-running models.
     Returns a task ID that can be polled for status.
     """
-    print("--- Background search request received ---")
+    logger.debug("Background search request received")
     query = request.json.get('query')
     selected_model = request.json.get('model')
     uploaded_file_data = request.json.get('uploaded_file_data')
@@ -2088,8 +3122,7 @@ def search_background():
     )
     
     # Store task
-    with TASK_LOCK:
-        BACKGROUND_TASKS[task_id] = task
+    BACKGROUND_TASKS[task_id] = task
     
     # Submit to executor
     TASK_EXECUTOR.submit(
@@ -2103,14 +3136,14 @@ def search_background():
         web_search_enabled
     )
     
-    print(f"Started background task: {task_id} for model: {selected_model}")
+    logger.info("Started background task: %s for model: %s", task_id, selected_model)
     
     return jsonify({
         'id': task_id,
         'status': task.status,
         'created_at': task.created_at.isoformat(),
         'model': selected_model,
-        'query_preview': query[:100] + "..." if len(query) > 100 else query
+        'query_preview': clip_text(query, 100)
     })
 
 @app.route('/tasks/<task_id>', methods=['GET'])
@@ -2147,27 +3180,28 @@ def stream_task_results(task_id):
         while True:
             # Check if task is cancelled
             if task.cancel_requested:
-                yield f"data: {json.dumps({'status': 'cancelled'})}\n\n"
+                yield sse_event({'status': 'cancelled'})
                 break
             
-            # Send new chunks
-            current_chunks = task.chunks[last_chunk_index:]
-            for chunk in current_chunks:
-                yield f"data: {json.dumps(chunk)}\n\n"
-            last_chunk_index = len(task.chunks)
+            # Send new chunks by index; chunks is append-only, so no slice copy is needed
+            chunk_count = len(task.chunks)
+            for i in range(last_chunk_index, chunk_count):
+                yield sse_event(task.chunks[i])
+            last_chunk_index = chunk_count
             
             # Send status update
-            yield f"data: {json.dumps({'status': task.status, 'progress': task.progress})}\n\n"
+            yield sse_event({'status': task.status, 'progress': task.progress})
             
             # Check if task is complete
             if task.status in [TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED]:
-                yield f"data: {json.dumps({'end_of_stream': True, 'status': task.status})}\n\n"
+                yield sse_event({'end_of_stream': True, 'status': task.status})
                 break
             
-            # Sleep briefly to avoid busy waiting
-            time.sleep(0.1)
+            # Block until the worker adds a chunk or finishes; keep idle connections alive
+            while not task.wait_for_update(last_chunk_index, TASK_STREAM_KEEPALIVE):
+                yield SSE_KEEPALIVE
     
-    return Response(generate(), mimetype='text/event-stream')
+    return Response(generate(), mimetype='text/event-stream', direct_passthrough=True)
 
 @app.route('/tasks/<task_id>', methods=['DELETE'])
 def cancel_task(task_id):
@@ -2181,6 +3215,7 @@ def cancel_task(task_id):
         return jsonify({'error': 'Task already completed'}), 400
     
     task.cancel_requested = True
+    task.notify()
     
     return jsonify({
         'id': task_id,
@@ -2195,11 +3230,10 @@ def list_tasks():
     limit = request.args.get('limit', 50, type=int)
     
     tasks = []
-    with TASK_LOCK:
-        for task in BACKGROUND_TASKS.values():
-            if status_filter and task.status != status_filter:
-                continue
-            tasks.append(task.to_dict())
+    for task in list(BACKGROUND_TASKS.values()):
+        if status_filter and task.status != status_filter:
+            continue
+        tasks.append(task.to_dict())
     
     # Sort by created_at descending
     tasks.sort(key=lambda x: x['created_at'], reverse=True)
@@ -2246,6 +3280,11 @@ def debug_info():
     
     return jsonify(debug_data)
 
+@app.route('/cache/stats')
+def cache_stats():
+    """Hit-rate statistics for the in-process search cache."""
+    return jsonify(SEARCH_CACHE.stats())
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring."""
@@ -2265,249 +3304,24 @@ def health_check():
             "timestamp": "unknown"
         }), 500
 
-def advanced_research_with_synthesis(topic, research_depth="comprehensive", focus_areas=None):
-    """
-    Advanced research tool that demonstrates tool chaining and context preservation.
-    Implements 2024 best practices for multi-step agentic workflows.
-    """
-    try:
-        if focus_areas is None:
-            focus_areas = ["overview", "recent_developments", "practical_applications"]
-        
-        research_results = {
-            "topic": topic,
-            "research_depth": research_depth,
-            "focus_areas": focus_areas,
-            "findings": {},
-            "synthesis": "",
-            "quality_metrics": {},
-            "timestamp": get_current_time()["current_time"]
-        }
-        
-        # Step 1: Multi-angle information gathering
-        for area in focus_areas:
-            search_query = f"{topic} {area.replace('_', ' ')}"
-            
-            # Use different search strategies for different focus areas
-            if area == "recent_developments":
-                search_type = "news"
-            elif area == "practical_applications":
-                search_type = "general"
-            else:
-                search_type = "deep"
-            
-            # Chain tool calls with context preservation
-            search_results = search_web_tool(search_query, max_results=5, search_type=search_type)
-            research_results["findings"][area] = search_results
-        
-        # Step 2: Quality assessment and synthesis
-        total_sources = sum(len(findings.get("results", [])) for findings in research_results["findings"].values())
-        high_quality_sources = 0
-        
-        for area, findings in research_results["findings"].items():
-            if "results" in findings:
-                high_quality_sources += len([r for r in findings["results"] if r.get("score", 0) > 0.7])
-        
-        research_results["quality_metrics"] = {
-            "total_sources": total_sources,
-            "high_quality_sources": high_quality_sources,
-            "quality_ratio": high_quality_sources / total_sources if total_sources > 0 else 0,
-            "coverage_areas": len(focus_areas)
-        }
-        
-        # Step 3: Intelligent synthesis
-        synthesis_points = []
-        for area, findings in research_results["findings"].items():
-            if "results" in findings and findings["results"]:
-                top_result = findings["results"][0]
-                synthesis_points.append(f"**{area.replace('_', ' ').title()}**: {top_result.get('content', 'No content available')[:200]}...")
-        
-        research_results["synthesis"] = "\n\n".join(synthesis_points)
-        
-        # Step 4: Generate actionable insights
-        if research_results["quality_metrics"]["quality_ratio"] > 0.6:
-            research_results["confidence_level"] = "High"
-            research_results["recommendations"] = f"Based on {high_quality_sources} high-quality sources, this research provides reliable insights on {topic}."
-        else:
-            research_results["confidence_level"] = "Moderate"
-            research_results["recommendations"] = f"Research completed with {total_sources} sources. Consider additional verification for critical decisions."
-        
-        return research_results
-        
-    except Exception as e:
-        return {"error": f"Advanced research failed: {str(e)}", "topic": topic}
-
-# Add the new tool to the available tools
-AGENTIC_TOOLS.append({
-    "type": "function",
-    "function": {
-        "name": "advanced_research_with_synthesis",
-        "description": "Perform advanced multi-step research with intelligent synthesis and quality assessment. Demonstrates tool chaining and context preservation for complex topics.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "topic": {
-                    "type": "string",
-                    "description": "The topic to research comprehensively"
-                },
-                "research_depth": {
-                    "type": "string",
-                    "description": "Depth of research: 'quick' (basic overview), 'standard' (balanced approach), 'comprehensive' (thorough analysis)",
-                    "enum": ["quick", "standard", "comprehensive"]
-                },
-                "focus_areas": {
-                    "type": "array",
-                    "items": {"type": "string"},
-                    "description": "Specific areas to focus on (e.g., ['overview', 'recent_developments', 'practical_applications', 'challenges', 'future_trends'])"
-                }
-            },
-            "required": ["topic"]
-        }
-    }
-})
-
-# Update tool mapping
-TOOL_MAPPING["advanced_research_with_synthesis"] = advanced_research_with_synthesis
-
-def search_web_openrouter(query, max_results=5, search_context_size="medium"):
-    """
-    Enhanced web search using OpenRouter's native web search capability.
-    Uses models with built-in web search like Perplexity or web-enabled models.
-    """
-    if not openrouter_api_key:
-        return {"error": "OpenRouter API key not configured"}
-    
-    try:
-        openrouter_client_instance = openai.OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=openrouter_api_key,
-            default_headers={
-                "HTTP-Referer": os.getenv("APP_SITE_URL", "http://localhost:8080"),
-                "X-Title": os.getenv("APP_SITE_TITLE", "Comet AI Search")
-            }
-        )
-        
-        # Use a web-search enabled model like Perplexity
-        web_search_prompt = (
-            f"Search the web for comprehensive information about: {query}\n\n"
-            f"CRITICAL CITATION REQUIREMENTS:\n"
-            f"1. Provide a comprehensive answer based on current web sources\n"
-            f"2. EMBED clickable source links directly in your response using markdown format: [descriptive text](URL)\n"
-            f"3. Make link text natural and descriptive - integrate seamlessly into sentence flow\n"
-            f"4. Example: 'According to [recent MIT research](https://mit.edu/study), quantum computing has advanced significantly'\n"
-            f"5. Cite up to {max_results} high-quality sources throughout your response\n"
-            f"6. Focus on {search_context_size} level of detail\n"
-            f"7. Prioritize embedding clickable links over numbered citations like [1], [2], [3]\n"
-            f"8. Ensure all information is current and well-sourced with embedded citations"
-        )
-        
-        # Use Perplexity which has built-in web search capabilities
-        response = openrouter_client_instance.chat.completions.create(
-            model="perplexity/sonar-reasoning-pro",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": (
-                        "You are a web search assistant with access to real-time web information. "
-                        "CRITICAL: Always embed clickable source links directly in your response using markdown format: [descriptive text](URL). "
-                        "Make link text natural and descriptive - integrate seamlessly into sentence flow. "
-                        "Example: 'According to [recent MIT research](https://mit.edu/study)' or '[industry experts report](https://example.com)'. "
-                        "Prioritize embedding clickable links over numbered citations like [1], [2], [3]. "
-                        "Provide comprehensive, well-cited responses with embedded clickable source links."
-                    )
-                },
-                {
-                    "role": "user", 
-                    "content": web_search_prompt
-                }
-            ],
-            max_tokens=2000,
-            temperature=0.3
-        )
-        
-        message = response.choices[0].message
-        content = message.content
-        
-        # Extract URLs from markdown links in the content
-        import re
-        url_pattern = r'\[([^\]]+)\]\((https?://[^\)]+)\)'
-        citations = []
-        
-        for match in re.finditer(url_pattern, content):
-            title = match.group(1)
-            url = match.group(2)
-            citations.append({
-                "title": title,
-                "url": url,
-                "source": "perplexity_web_search"
-            })
-        
-        return {
-            "success": True,
-            "query": query,
-            "search_type": "openrouter_perplexity",
-            "content": content,
-            "citations": citations,
-            "search_context_size": search_context_size,
-            "total_citations": len(citations),
-            "model_used": "perplexity/sonar-reasoning-pro"
-        }
-        
-    except Exception as e:
-        print(f"OpenRouter web search error: {e}")
-        return {"error": f"OpenRouter web search failed: {str(e)}"}
-
-# Add OpenRouter web search as a new tool option
-AGENTIC_TOOLS.append(    {
-        "type": "function",
-        "function": {
-            "name": "search_web_openrouter",
-            "description": "Search the web using OpenRouter's Perplexity model with real-time web access. Provides current information with citations and comprehensive analysis.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "Search query to find current information on the web"
-                    },
-                    "max_results": {
-                        "type": "integer",
-                        "description": "Maximum number of sources to cite (default: 5, max: 10)",
-                        "minimum": 1,
-                        "maximum": 10
-                    },
-                    "search_context_size": {
-                        "type": "string",
-                        "description": "Detail level: 'low' (brief), 'medium' (moderate), 'high' (comprehensive)",
-                        "enum": ["low", "medium", "high"]
-                    }
-                },
-                "required": ["query"]
-            }
-        }
-    })
-
-# Update tool mapping
-TOOL_MAPPING["search_web_openrouter"] = search_web_openrouter
-
 # --- Main Execution --- 
 if __name__ == '__main__':
     if not openrouter_api_key:
-         print("\n*** WARNING: OpenRouter API key not found in .env. OpenRouter models will not work. ***\n")
+        logger.warning("OpenRouter API key not found in .env. OpenRouter models will not work.")
     else:
-        print("OpenRouter API key found.")
+        logger.info("OpenRouter API key found.")
 
     if not openai_api_key:
-         print("*** WARNING: Direct OpenAI API key (OPENAI_API_KEY) not found in .env. gpt-image-1 model will not work. ***")
+        logger.warning("Direct OpenAI API key (OPENAI_API_KEY) not found in .env. gpt-image-1 model will not work.")
     else:
-        print("Direct OpenAI API key (OPENAI_API_KEY) found.")
-    
-
+        logger.info("Direct OpenAI API key (OPENAI_API_KEY) found.")
 
     if openrouter_api_key or openai_api_key:
-        print("Application starting...\n")
+        logger.info("Application starting...")
     else:
-        print("\n*** CRITICAL WARNING: NO API keys (OpenRouter or direct OpenAI) found in .env. Application will likely not function. ***\n")
+        logger.critical("NO API keys (OpenRouter or direct OpenAI) found in .env. Application will likely not function.")
         
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), threaded=True)
+    # The reloader and debugger are opt-in (FLASK_DEBUG=1); self-hosted production uses gunicorn.conf.py
+    debug_mode = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes')
+    app.run(debug=debug_mode, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), threaded=True)
 
@@ -0,0 +1,20 @@
+# Gunicorn settings for self-hosting: gunicorn app:app
+# (Vercel deployments use vercel.json and ignore this file.)
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Background tasks live in process memory, so /tasks/<id>/stream must reach the
+# worker that started the task. Scale with threads; only raise WEB_CONCURRENCY
+# behind sticky sessions.
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+
+# SSE responses stay open for the whole model response
+timeout = 300
+graceful_timeout = 30
+keepalive = 5
+
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+accesslog = "-"
@@ -726,18 +726,22 @@ document.addEventListener('DOMContentLoaded', () => {
                                     return; // Stop processing this stream
                                 }
 
-                                if (data.web_search_results) {
-                                    webSearchResults = data.web_search_results;
-                                    console.log(`Received web search results with ${data.web_search_results.results ? data.web_search_results.results.length : 0} sources`);
+                                if (data.wsr) {
+                                    // Unpack the compact {a, r: [[title, url, content], ...]} payload
+                                    webSearchResults = {
+                                        answer: data.wsr.a || '',
+                                        results: (data.wsr.r || []).map(([title, url, content]) => ({ title, url, content }))
+                                    };
+                                    console.log(`Received web search results with ${webSearchResults.results.length} sources`);
                                     
                                     // Update progress indicator with success status
                                     updateWebSearchProgress(
-                                        `Found ${data.web_search_results.results ? data.web_search_results.results.length : 0} sources`,
+                                        `Found ${webSearchResults.results.length} sources`,
                                         'Processing search results...'
                                     );
                                     
                                     // Create and display web search sources UI
-                                    displayWebSearchSources(data.web_search_results);
+                                    displayWebSearchSources(webSearchResults);
                                     
                                     // Hide progress indicator after a brief delay
                                     setTimeout(() => {
@@ -0,0 +1,400 @@
+import collections
+
+import pytest
+
+import app
+
+
+class FakeClock:
+    """Stand-in for time.monotonic that tests move forward by hand."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(app.time, "monotonic", fake)
+    return fake
+
+
+# --- Response cache ---
+def test_ttl_cache_expires_entries(clock):
+    cache = app.TTLCache(max_size=10, default_ttl=60)
+    cache.set("key", "value")
+    clock.now += 59
+    assert cache.get("key") == "value"
+    clock.now += 2
+    assert cache.get("key") is None
+
+
+def test_ttl_cache_per_entry_ttl(clock):
+    cache = app.TTLCache(max_size=10, default_ttl=60)
+    cache.set("short", 1, ttl=5)
+    cache.set("long", 2)
+    clock.now += 10
+    assert cache.get("short") is None
+    assert cache.get("long") == 2
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = app.TTLCache(max_size=2, default_ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_returns_copies():
+    cache = app.TTLCache(max_size=10, default_ttl=60)
+    value = {"sources": [1, 2]}
+    cache.set("key", value)
+    value["sources"].append(3)
+    cached = cache.get("key")
+    cached["sources"].append(4)
+    assert cache.get("key") == {"sources": [1, 2]}
+
+
+# --- Search cache TTLs ---
+def test_compute_ttl_follows_search_type_and_wording():
+    news = app.compute_ttl("python release", "news")
+    general = app.compute_ttl("python release", "general")
+    deep = app.compute_ttl("python release", "deep")
+    assert news < general < deep
+    assert app.compute_ttl("python release today", "general") == general / 2
+    assert app.compute_ttl("python history", "general") == general * 2
+
+
+def test_should_refresh_after_most_of_the_ttl(clock):
+    cached_at = clock.now
+    clock.now += 79
+    assert not app.should_refresh(cached_at, 100)
+    clock.now += 1
+    assert app.should_refresh(cached_at, 100)
+
+
+def test_schedule_search_refresh_submits_each_key_once(monkeypatch):
+    submitted = []
+
+    class RecordingExecutor:
+        def submit(self, fn, *args, **kwargs):
+            submitted.append(fn)
+
+    monkeypatch.setattr(app, "SEARCH_REFRESH_EXECUTOR", RecordingExecutor())
+    monkeypatch.setattr(app, "SEARCH_REFRESH_IN_FLIGHT", set())
+    app.schedule_search_refresh("key", "query", 5, "general")
+    app.schedule_search_refresh("key", "query", 5, "general")
+    assert len(submitted) == 1
+
+
+# --- Math tool ---
+def test_calculate_math_rejects_nested_powers():
+    result = app.calculate_math("((9**999)**999)**999")
+    assert "error" in result
+
+
+def test_calculate_math_rejects_results_too_large_to_serialize():
+    assert "error" in app.calculate_math("*".join(["9**999"] * 5))
+    assert "error" in app.calculate_math("(2**999)**14")
+
+
+def test_calculate_math_large_allowed_results_serialize():
+    result = app.calculate_math("9**999")
+    assert result["result"] == 9 ** 999
+    assert app.json_dumps(result)
+
+
+# --- Research ---
+def research_search_result(high_quality_count):
+    titles = ["Latest news on quantum computing", "Quantum computing research study", "What is quantum computing"]
+    sources = [
+        {"title": f"{titles[i % 3]} {i}", "url": f"https://example{i}.com/page", "domain": f"example{i}.com", "quality": "HIGH"}
+        for i in range(high_quality_count)
+    ]
+    return {
+        "success": True,
+        "quick_answer": "answer",
+        "sources": sources,
+        "returned_count": len(sources),
+        "quality_distribution": {"high": high_quality_count, "medium": 0, "standard": 0}
+    }
+
+
+def test_research_topic_uses_one_search_when_it_is_strong(monkeypatch):
+    calls = []
+
+    def fake_search(query, max_results=8, search_type="auto"):
+        calls.append(query)
+        return research_search_result(9)
+
+    monkeypatch.setattr(app, "search_web_tool", fake_search)
+    monkeypatch.setattr(app, "SEARCH_CACHE", app.TTLCache())
+    result = app.research_topic("quantum computing")
+    assert len(calls) == 1
+    assert [step["type"] for step in result["searches_performed"]] == ["overview", "news", "analysis"]
+    assert len(result["all_sources"]) == 9
+
+
+def test_research_topic_falls_back_to_separate_searches(monkeypatch):
+    calls = []
+
+    def fake_search(query, max_results=8, search_type="auto"):
+        calls.append(query)
+        return research_search_result(2)
+
+    monkeypatch.setattr(app, "search_web_tool", fake_search)
+    monkeypatch.setattr(app, "SEARCH_CACHE", app.TTLCache())
+    result = app.research_topic("quantum computing")
+    assert len(calls) == 4
+    assert [step["type"] for step in result["searches_performed"]] == ["overview", "news", "analysis"]
+
+
+# --- Background tasks ---
+def make_task(task_id, status):
+    task = app.BackgroundTask(task_id, "model", "query")
+    task.status = status
+    return task
+
+
+def test_retire_finished_task_only_evicts_finished_tasks(monkeypatch):
+    tasks = collections.OrderedDict(
+        (task.id, task) for task in [
+            make_task("running", app.TaskStatus.IN_PROGRESS),
+            make_task("queued", app.TaskStatus.QUEUED),
+            make_task("old", app.TaskStatus.COMPLETED),
+            make_task("new", app.TaskStatus.FAILED),
+        ]
+    )
+    monkeypatch.setattr(app, "BACKGROUND_TASKS", tasks)
+    monkeypatch.setattr(app, "MAX_STORED_TASKS", 3)
+    app.retire_finished_task("new")
+    assert list(tasks) == ["running", "queued", "new"]
+
+
+def test_retire_finished_task_keeps_active_tasks_over_the_limit(monkeypatch):
+    tasks = collections.OrderedDict(
+        (task.id, task) for task in [
+            make_task("running", app.TaskStatus.IN_PROGRESS),
+            make_task("queued", app.TaskStatus.QUEUED),
+            make_task("done", app.TaskStatus.COMPLETED),
+        ]
+    )
+    monkeypatch.setattr(app, "BACKGROUND_TASKS", tasks)
+    monkeypatch.setattr(app, "MAX_STORED_TASKS", 1)
+    app.retire_finished_task("done")
+    assert list(tasks) == ["running", "queued"]
+
+
+# --- JSON responses ---
+def test_jsonify_is_serialized_with_orjson(monkeypatch):
+    orjson = pytest.importorskip("orjson")
+    calls = []
+    real_dumps = orjson.dumps
+
+    def spy_dumps(*args, **kwargs):
+        calls.append(args)
+        return real_dumps(*args, **kwargs)
+
+    monkeypatch.setattr(app.orjson, "dumps", spy_dumps)
+    with app.app.app_context():
+        response = app.jsonify({"b": 1, "a": [1, 2]})
+    assert calls
+    assert response.get_json() == {"a": [1, 2], "b": 1}
+
+
+def test_jsonify_accepts_keyword_arguments():
+    with app.app.app_context():
+        assert app.jsonify(status="ok", count=2).get_json() == {"status": "ok", "count": 2}
+
+
+# --- Agent history compaction ---
+def tool_message(n, chars=8000):
+    return {"role": "tool", "tool_call_id": str(n), "name": "search_web_tool", "content": "x" * chars}
+
+
+@pytest.fixture
+def char_tokens(monkeypatch):
+    monkeypatch.setattr(app, "estimate_tokens", lambda text: len(text) // 4)
+
+
+def test_compact_tool_history_leaves_small_histories_alone(char_tokens):
+    messages = [{"role": "user", "content": "q"}] + [tool_message(n) for n in range(3)]
+    app.compact_tool_history(messages)
+    assert all(m["content"] == "x" * 8000 for m in messages[1:])
+
+
+def test_compact_tool_history_keeps_recent_results(char_tokens):
+    messages = [{"role": "user", "content": "q"}] + [tool_message(n) for n in range(5)]
+    app.compact_tool_history(messages)
+    assert all(m["content"].startswith("[summary of 8000 chars]") for m in messages[1:4])
+    assert all(m["content"] == "x" * 8000 for m in messages[4:])
+
+
+def test_compact_tool_history_rewrites_rarely(char_tokens):
+    messages = [{"role": "user", "content": "q"}] + [tool_message(n) for n in range(5)]
+    app.compact_tool_history(messages)
+    # A large new result pushes the history over budget again, but compacting the one
+    # result that just aged out would free too little to be worth a rewrite
+    messages.append(tool_message(5, chars=20000))
+    snapshot = [dict(m) for m in messages]
+    app.compact_tool_history(messages)
+    assert messages == snapshot
+    messages.append(tool_message(6, chars=20000))
+    app.compact_tool_history(messages)
+    assert messages[4]["content"].startswith("[summary")
+    assert messages[5]["content"].startswith("[summary")
+
+
+# --- Search cache keys ---
+def test_normalize_search_query_collapses_case_punctuation_and_spacing():
+    assert app.normalize_search_query("  Latest   AI news?! ") == app.normalize_search_query("latest ai news")
+
+
+def test_normalize_search_query_keeps_word_order():
+    assert app.normalize_search_query("usd to eur") != app.normalize_search_query("eur to usd")
+    assert app.normalize_search_query("man bites dog") != app.normalize_search_query("dog bites man")
+
+
+# --- Citation links ---
+@pytest.mark.parametrize("content", [
+    "",
+    "See [the docs](https://docs.python.org/3/) and [PEP 8](https://peps.python.org/pep-0008/).",
+    "[outer [inner](https://a.com/x)",
+    "[title](https://a.com/path(1))",
+    "[bad\ntitle](https://a.com)",
+    "[t](http://a.com/\x0cx) then [u](https://b.com)",
+    "[t](https://a.com/ space)",
+    "[" + "a" * 600 + "](https://a.com)",
+    "[long](https://a.com/" + "b" * 2100 + ")",
+    "[short](http://a)",
+    "no links](https://a.com) here",
+])
+def test_extract_markdown_links_matches_the_regex(content):
+    assert list(app.extract_markdown_links(content)) == app.MARKDOWN_LINK_RE.findall(content)
+
+
+# --- Direct page fetch ---
+def test_fetch_page_directly_rejects_internal_addresses(monkeypatch):
+    monkeypatch.setattr(app.socket, "getaddrinfo", lambda *args, **kwargs: [(None, None, None, "", ("10.0.0.5", 80))])
+    assert app.fetch_page_directly("http://internal.example/") is None
+
+
+def test_fetch_page_directly_connects_to_the_checked_address(monkeypatch):
+    # A rebinding resolver answers with a public address first and an internal one after
+    answers = iter(["93.184.215.14", "127.0.0.1"])
+    monkeypatch.setattr(app.socket, "getaddrinfo", lambda *args, **kwargs: [(None, None, None, "", (next(answers), 80))])
+    connected = []
+
+    class FakePool:
+        def __init__(self, address, port, **kwargs):
+            connected.append(address)
+
+        def urlopen(self, *args, **kwargs):
+            raise app.urllib3.exceptions.HTTPError("offline")
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(app.urllib3, "HTTPConnectionPool", FakePool)
+    assert app.fetch_page_directly("http://rebind.example/") is None
+    assert connected == ["93.184.215.14"]
+
+
+# --- Tavily cache ---
+class FakeTavily:
+    """Stands in for tavily_session.post, answering each call with a new answer."""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, url, json=None, headers=None, timeout=None):
+        self.calls += 1
+        body = {
+            "answer": f"answer {self.calls}",
+            "response_time": 1.5,
+            "results": [
+                {
+                    "title": f"Python release notes, part {n}",
+                    "url": f"https://site{n}.example/python/",
+                    "content": "What's new in the Python release, with every change listed. " * 2,
+                    "score": 0.9
+                }
+                for n in range(3)  # Enough results that no fallback searches run
+            ]
+        }
+        return type("FakeResponse", (), {"raise_for_status": lambda self: None, "json": lambda self: body})()
+
+
+@pytest.fixture
+def tavily(monkeypatch):
+    fake = FakeTavily()
+    monkeypatch.setattr(app, "tavily_api_key", "test-key")
+    monkeypatch.setattr(app.tavily_session, "post", fake)
+    monkeypatch.setattr(app, "TAVILY_CACHE", app.TTLCache(max_size=512, default_ttl=600))
+    monkeypatch.setattr(app, "SEARCH_CACHE", app.TTLCache())
+    return fake
+
+
+def test_tavily_cache_hit_skips_the_api(tavily):
+    first = app.search_web_tavily("python release notes", max_results=5)
+    second = app.search_web_tavily("python release notes", max_results=5)
+    assert tavily.calls == 1
+    assert second["answer"] == first["answer"]
+    assert "response_time" in first["search_metadata"]
+    assert "response_time" not in second["search_metadata"]
+
+
+def test_search_refresh_fetches_a_new_tavily_response(tavily, clock, monkeypatch):
+    class InlineExecutor:
+        def submit(self, fn, *args, **kwargs):
+            fn(*args, **kwargs)
+
+    monkeypatch.setattr(app, "SEARCH_REFRESH_EXECUTOR", InlineExecutor())
+    monkeypatch.setattr(app, "SEARCH_REFRESH_IN_FLIGHT", set())
+    ttl = app.compute_ttl("python release notes", "news")
+    assert app.search_web_tool("python release notes", max_results=5, search_type="news")["quick_answer"] == "answer 1"
+    clock.now += ttl * 0.9  # Past the soft-refresh point, still before expiry
+    app.search_web_tool("python release notes", max_results=5, search_type="news")
+    assert tavily.calls == 2
+    assert app.search_web_tool("python release notes", max_results=5, search_type="news")["quick_answer"] == "answer 2"
+
+
+def test_expired_search_result_does_not_reuse_an_older_tavily_response(tavily, clock):
+    ttl = app.compute_ttl("python release notes", "news")
+    app.search_web_tool("python release notes", max_results=5, search_type="news")
+    clock.now += ttl + 1
+    assert app.search_web_tool("python release notes", max_results=5, search_type="news")["quick_answer"] == "answer 2"
+
+
+# --- Query classification ---
+@pytest.mark.parametrize("query, hint", [
+    ("how do programmers structure functions", "coding-related"),
+    ("bash scripts for nightly backups", "coding-related"),
+    ("relativity explained simply", "explanatory"),
+    ("tips compared side by side", "comparison"),
+    ("reviewed options for a home server", "analytical"),
+])
+def test_classify_query_profile_matches_inflections(query, hint):
+    assert hint in app.classify_query_profile(query)[0]
+
+
+def test_classify_query_profile_ignores_words_inside_other_words():
+    assert app.classify_query_profile("tune the audio codec") == app.DEFAULT_QUERY_PROFILE
+
+
+# --- Upload validation ---
+@pytest.mark.parametrize("data_url, expected", [
+    ("data:image/png;base64,iVBORw0KGgo=", ("image/png", True)),
+    ("data:application/pdf;base64,JVBERi0=", ("application/pdf", True)),
+    ("data:image/png,rawbytes", ("image/png", False)),
+    ("image/png;base64,iVBORw0KGgo=", (None, False)),
+    ("data:image/png;base64", (None, False)),
+    ("data:" + "a" * 200 + ";base64,AAAA", (None, False)),
+])
+def test_parse_data_url_header(data_url, expected):
+    assert app.parse_data_url_header(data_url) == expected